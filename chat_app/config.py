@@ -1,44 +1,185 @@
+from __future__ import annotations
+
 import os
 from dataclasses import dataclass
 
+_TRUE_VALUES = ("1", "true", "yes", "y", "on")
+_FALSE_VALUES = ("0", "false", "no", "n", "off", "")
+
 
 def _getenv_bool(name: str, default: bool = False) -> bool:
     raw = os.getenv(name)
     if raw is None:
         return default
-    return str(raw).strip().lower() in ("1", "true", "yes", "y", "on")
+    value = str(raw).strip().lower()
+    if value in _TRUE_VALUES:
+        return True
+    if value in _FALSE_VALUES:
+        return False
+    raise ValueError(f"{name} must be a boolean flag, got {raw!r}")
+
+
+def _getenv_int(name: str, default: int, *, minimum: int = 0) -> int:
+    raw = os.getenv(name)
+    if raw is None or not raw.strip():
+        return default
+    try:
+        value = int(raw.strip())
+    except ValueError as exc:
+        raise ValueError(f"{name} must be an integer, got {raw!r}") from exc
+    if value < minimum:
+        raise ValueError(f"{name} must be >= {minimum}, got {value}")
+    return value
+
+
+def _getenv_choice(name: str, default: str, choices: tuple[str, ...]) -> str:
+    value = (os.getenv(name) or "").strip().lower() or default
+    if value not in choices:
+        raise ValueError(f"{name} must be one of {choices}, got {value!r}")
+    return value
+
 
+def _require_url(name: str, value: str, schemes: tuple[str, ...]) -> str:
+    value = value.strip()
+    if not value.startswith(schemes):
+        raise ValueError(f"{name} must start with one of {schemes}, got {value!r}")
+    return value
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class Settings:
     """
-    Simple settings holder for the chat service.
+    Immutable settings holder for the chat service.
 
-    Values are read from environment variables with sensible defaults.
+    Окружение читается ровно один раз в Settings.load() при импорте модуля;
+    некорректные значения приводят к ошибке старта, а не к молчаливым дефолтам.
     """
 
-    redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-    retrieval_url: str = os.getenv("RETRIEVAL_URL", "http://localhost:8001")
-    scenario_storage_path: str = os.getenv("SCENARIO_STORAGE_PATH", "data")
+    redis_url: str
+    retrieval_url: str
+    scenario_storage_path: str
+
+    # Сколько последних сообщений истории читаем для промптов/summary (полная история — только /history).
+    history_tail_limit: int
+    # Скользящее окно dialog_tail в промпте ответа (предыдущие сообщения; остальное покрывает summary).
+    prompt_tail_messages: int
+
+    # Полная pydantic-валидация данных, прочитанных из Redis (по умолчанию — доверенное чтение).
+    validate_redis_reads: bool
+
+    # Лимиты in-memory фоллбека памяти диалогов (LRU по количеству и примерному объёму).
+    in_memory_max_conversations: int
+    in_memory_max_bytes: int
+
+    # Размер пула потоков (default executor asyncio + лимитер AnyIO для to_thread/run_in_threadpool).
+    thread_pool_size: int
 
     # Настройки LLM-провайдера с OpenAI-совместимым API (например, OpenRouter).
     # Переменные называются OPENAI_* только ради совместимости с SDK.
-    llm_api_key: str | None = os.getenv("OPENAI_API_KEY")
-    llm_base_url: str = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-    llm_model: str = os.getenv("LLM_MODEL", "gpt-4.1-mini")
+    llm_api_key: str | None
+    llm_base_url: str
+    llm_model: str
+
+    # Максимум одновременных LLM-запросов на процесс (все роли и пайплайны).
+    llm_max_concurrency: int
+    # Лимит токенов в минуту (оценка входных токенов, окно 60 с); 0 — без лимита.
+    llm_tpm_limit: int
+    # Ограничения каждого LLM-вызова: max_tokens по умолчанию и таймаут запроса.
+    # Повторы SDK выключены (max_retries=0) — их заменяет ротация ключей.
+    llm_max_output_tokens: int
+    llm_timeout_s: int
+    # Exact-match кэш ответов LLM в процессе (TTL в секундах, 0 — выключен; размер в записях).
+    # Только для вызовов с temperature=0: сэмплированные ответы не кэшируются.
+    llm_response_cache_ttl_s: int
+    llm_response_cache_size: int
+    # Режим structured output для chat_json: auto — json_schema → json_object → текст с
+    # запоминанием рабочего режима для каждой модели; иначе всегда только указанный режим.
+    llm_json_mode: str
+
+    # Summary пересчитывается, только если история выросла хотя бы на столько сообщений.
+    summary_delta_threshold: int
+    # v0.1: ответ и обновлённое summary одним LLM-запросом (JSON {answer, summary}).
+    fused_summary: bool
+    # v1.0: черновик ответа и самопроверка одним LLM-запросом; judge вызывается, только если
+    # самопроверка вернула revise (или ответ не разобрался).
+    self_judge: bool
+    # v1.0: judge при action=revise сразу возвращает исправленный ответ (revised_answer),
+    # отдельный revise-запрос — только если поле пустое.
+    judge_inline_revise: bool
+    # v1.0: решения по всем условным блокам хода — одним LLM-запросом вместо запроса на блок.
+    conditions_batch: bool
+    # v1.0: сжатие нескольких сценариев в imperative-инструкции — одним LLM-запросом.
+    scenario_imperatives_batch: bool
 
     # Модели по ролям (если не заданы — используем LLM_MODEL).
-    condition_model: str = os.getenv("CONDITION_MODEL", "") or llm_model
-    judge_model: str = os.getenv("JUDGE_MODEL", "") or llm_model
-    revise_model: str = os.getenv("REVISE_MODEL", "") or judge_model
-    summary_model: str = os.getenv("SUMMARY_MODEL", "") or llm_model
+    condition_model: str
+    judge_model: str
+    revise_model: str
+    summary_model: str
 
     # Версия пайплайна чат-агента (0.1 — текущая линейная реализация).
-    agent_pipeline_version: str = os.getenv("AGENT_PIPELINE_VERSION", "0.1")
+    agent_pipeline_version: str
 
     # SGR converter (plain text -> ScenarioDefinition)
-    sgr_model: str = os.getenv("SGR_MODEL", "") or llm_model
-    sgr_log_prompts: bool = _getenv_bool("SGR_LOG_PROMPTS", False)
+    sgr_model: str
+    sgr_log_prompts: bool
+    # TTL кэша результатов /sgr/convert в Redis (0 — кэш выключен).
+    sgr_cache_ttl_s: int
+
+    @classmethod
+    def load(cls) -> "Settings":
+        llm_model = os.getenv("LLM_MODEL", "gpt-4.1-mini").strip()
+        if not llm_model:
+            raise ValueError("LLM_MODEL must not be empty")
+        judge_model = os.getenv("JUDGE_MODEL", "").strip() or llm_model
+
+        return cls(
+            redis_url=_require_url(
+                "REDIS_URL",
+                os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+                ("redis://", "rediss://", "unix://"),
+            ),
+            retrieval_url=_require_url(
+                "RETRIEVAL_URL",
+                os.getenv("RETRIEVAL_URL", "http://localhost:8001"),
+                ("http://", "https://"),
+            ),
+            scenario_storage_path=os.getenv("SCENARIO_STORAGE_PATH", "data"),
+            history_tail_limit=_getenv_int("HISTORY_TAIL_LIMIT", 16, minimum=1),
+            prompt_tail_messages=_getenv_int("PROMPT_TAIL_MESSAGES", 4, minimum=0),
+            validate_redis_reads=_getenv_bool("VALIDATE_REDIS_READS", False),
+            in_memory_max_conversations=_getenv_int("IN_MEMORY_MAX_CONVERSATIONS", 10_000, minimum=1),
+            in_memory_max_bytes=_getenv_int("IN_MEMORY_MAX_BYTES", 256 * 1024 * 1024, minimum=1),
+            thread_pool_size=_getenv_int("THREAD_POOL_SIZE", 40, minimum=1),
+            llm_api_key=os.getenv("OPENAI_API_KEY"),
+            llm_base_url=_require_url(
+                "OPENAI_BASE_URL",
+                os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+                ("http://", "https://"),
+            ),
+            llm_model=llm_model,
+            llm_max_concurrency=_getenv_int("LLM_MAX_CONCURRENCY", 16, minimum=1),
+            llm_tpm_limit=_getenv_int("LLM_TPM_LIMIT", 0, minimum=0),
+            llm_max_output_tokens=_getenv_int("LLM_MAX_OUTPUT_TOKENS", 2048, minimum=1),
+            llm_timeout_s=_getenv_int("LLM_TIMEOUT_S", 60, minimum=1),
+            llm_response_cache_ttl_s=_getenv_int("LLM_RESPONSE_CACHE_TTL_S", 300, minimum=0),
+            llm_response_cache_size=_getenv_int("LLM_RESPONSE_CACHE_SIZE", 1024, minimum=1),
+            llm_json_mode=_getenv_choice("LLM_JSON_MODE", "auto", ("auto", "json_schema", "json_object", "text")),
+            summary_delta_threshold=_getenv_int("SUMMARY_DELTA_THRESHOLD", 4, minimum=1),
+            fused_summary=_getenv_bool("FUSED_SUMMARY", False),
+            self_judge=_getenv_bool("SELF_JUDGE", False),
+            judge_inline_revise=_getenv_bool("JUDGE_INLINE_REVISE", False),
+            conditions_batch=_getenv_bool("CONDITIONS_BATCH", False),
+            scenario_imperatives_batch=_getenv_bool("SCENARIO_IMPERATIVES_BATCH", False),
+            condition_model=os.getenv("CONDITION_MODEL", "").strip() or llm_model,
+            judge_model=judge_model,
+            revise_model=os.getenv("REVISE_MODEL", "").strip() or judge_model,
+            summary_model=os.getenv("SUMMARY_MODEL", "").strip() or llm_model,
+            agent_pipeline_version=os.getenv("AGENT_PIPELINE_VERSION", "0.1").strip() or "0.1",
+            sgr_model=os.getenv("SGR_MODEL", "").strip() or llm_model,
+            sgr_log_prompts=_getenv_bool("SGR_LOG_PROMPTS", False),
+            sgr_cache_ttl_s=_getenv_int("SGR_CACHE_TTL_S", 86400, minimum=0),
+        )
 
 
-settings = Settings()
+settings = Settings.load()
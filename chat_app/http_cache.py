@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import logging
+from typing import Awaitable, Callable, Dict, Tuple
+
+from cachetools import TTLCache
+from fastapi import Request
+from fastapi.responses import Response
+
+
+logger = logging.getLogger("chat_app.http_cache")
+
+# Функция, возвращающая "версию" ресурса для запроса (ревизия диалога, реестра и т.п.).
+TagFn = Callable[[Request], Awaitable[str]]
+
+_CachedResponse = Tuple[int, bytes, str]
+
+
+class ResponseCache:
+    """
+    Process-local cache for idempotent GET endpoints.
+
+    Для каждого зарегистрированного пути вычисляется тег версии ресурса (например,
+    ревизия диалога в Redis). ETag = W/"<tag>": совпадение с If-None-Match → 304 без вызова
+    обработчика; иначе тело отдаётся из TTLCache, если для этого тега оно уже было построено.
+    """
+
+    def __init__(self, *, maxsize: int = 10_000, ttl: float = 5.0) -> None:
+        self._tag_fns: Dict[str, TagFn] = {}
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def register(self, path: str, tag_fn: TagFn) -> None:
+        self._tag_fns[path] = tag_fn
+
+    async def __call__(self, request: Request, call_next):  # noqa: ANN001
+        tag_fn = self._tag_fns.get(request.url.path)
+        if request.method != "GET" or tag_fn is None:
+            return await call_next(request)
+
+        try:
+            tag = await tag_fn(request)
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("http_cache_tag_failed path=%s error=%r", request.url.path, exc)
+            return await call_next(request)
+
+        etag = f'W/"{tag}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        key = (request.url.path, request.url.query, tag)
+        cached: _CachedResponse | None = self._cache.get(key)
+        if cached is not None:
+            status_code, body, media_type = cached
+            return Response(
+                content=body,
+                status_code=status_code,
+                media_type=media_type,
+                headers={"ETag": etag, "X-Cache": "HIT"},
+            )
+
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        media_type = response.headers.get("content-type") or "application/json"
+        self._cache[key] = (response.status_code, body, media_type)
+        headers = {k: v for k, v in response.headers.items() if k.lower() != "content-length"}
+        headers["ETag"] = etag
+        headers["X-Cache"] = "MISS"
+        return Response(content=body, status_code=response.status_code, headers=headers, media_type=media_type)
@@ -0,0 +1,508 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import email.utils
+import hashlib
+import json
+import logging
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, Tuple
+
+import httpx
+from cachetools import TTLCache
+from openai import APIStatusError, AsyncOpenAI, BadRequestError, RateLimitError
+
+from chat_app.config import settings
+from chat_app.runtime_config import (
+    choose_openai_api_key_async,
+    get_effective_openai_api_keys_async,
+    mark_openai_api_key_rate_limited_async,
+)
+
+try:
+    import aiohttp  # type: ignore
+    # openai[aiohttp]: транспорт httpx поверх aiohttp (без head-of-line blocking httpcore
+    # при сотнях параллельных запросов, см. openai/openai-python#1596).
+    from httpx_aiohttp import AiohttpTransport  # type: ignore
+except Exception:  # noqa: BLE001
+    aiohttp = None  # type: ignore[assignment]
+    AiohttpTransport = None  # type: ignore[assignment,misc]
+
+try:
+    import orjson  # type: ignore
+except Exception:  # noqa: BLE001
+    orjson = None  # type: ignore[assignment]
+
+
+logger = logging.getLogger("chat_app.llm_client")
+
+# Один пул соединений на (api_key, base_url): все роли (condition/judge/revise/summary/sgr)
+# ходят в одного и того же провайдера, поэтому TLS и keep-alive соединения переиспользуются.
+_MAX_CONNECTIONS = 1024
+_MAX_KEEPALIVE_CONNECTIONS = 256
+_TIMEOUT = httpx.Timeout(float(settings.llm_timeout_s), connect=5.0)
+_KEEPALIVE_EXPIRY_S = 5.0
+# Не больше стольких клиентов (пар api_key/base_url) одновременно; вытесненный закрывается
+# не сразу, а через таймаут запроса, чтобы не оборвать уже начатые через него вызовы.
+_MAX_ASYNC_CLIENTS = 32
+_EVICTED_CLIENT_CLOSE_DELAY_S = float(settings.llm_timeout_s)
+# Дефолтный буфер чтения aiohttp (64 KiB) на длинных ответах (SGR, judge/revise JSON)
+# упирается в backpressure; 4 MiB убирает этот эффект.
+_READ_BUFSIZE = 4 * 1024 * 1024
+
+# Экспоненциальный backoff с jitter между попытками после 429.
+_BACKOFF_BASE_S = 0.5
+_BACKOFF_CAP_S = 8.0
+
+# Окно учёта токенов для LLM_TPM_LIMIT.
+_TPM_WINDOW_S = 60.0
+
+_llm_semaphore: asyncio.Semaphore | None = None
+_token_window: "TokenWindow | None" = None
+_response_cache: TTLCache | None = None
+# LRU клиентов get_async_client и вытесненные, но ещё не закрытые (закрываются на shutdown).
+_async_clients: "collections.OrderedDict[Tuple[str, str], AsyncOpenAI]" = collections.OrderedDict()
+_evicted_clients: Dict[AsyncOpenAI, "asyncio.Task[None] | None"] = {}
+
+
+def get_llm_semaphore() -> asyncio.Semaphore:
+    """Process-wide semaphore bounding concurrent LLM requests (LLM_MAX_CONCURRENCY)."""
+    global _llm_semaphore  # noqa: PLW0603
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(settings.llm_max_concurrency)
+    return _llm_semaphore
+
+
+class TokenWindow:
+    """
+    Sliding one-minute window of admitted (estimated) tokens.
+
+    admit() ждёт, пока в окне не освободится место под запрос. Запрос крупнее всего лимита
+    пропускается при пустом окне, чтобы не ждать вечно.
+    """
+
+    def __init__(self, limit: int, window_s: float = _TPM_WINDOW_S) -> None:
+        self._limit = limit
+        self._window_s = window_s
+        self._entries: Deque[Tuple[float, int]] = collections.deque()
+        self._total = 0
+
+    def _purge(self, now: float) -> None:
+        while self._entries and now - self._entries[0][0] >= self._window_s:
+            _, tokens = self._entries.popleft()
+            self._total -= tokens
+
+    async def admit(self, tokens: int) -> None:
+        while True:
+            now = time.monotonic()
+            self._purge(now)
+            if not self._entries or self._total + tokens <= self._limit:
+                self._entries.append((now, tokens))
+                self._total += tokens
+                return
+            delay = self._window_s - (now - self._entries[0][0])
+            logger.info("llm_tpm_wait tokens=%d window_total=%d delay_s=%.2f", tokens, self._total, delay)
+            await asyncio.sleep(max(delay, 0.05))
+
+
+def get_token_window() -> TokenWindow | None:
+    global _token_window  # noqa: PLW0603
+    if settings.llm_tpm_limit <= 0:
+        return None
+    if _token_window is None:
+        _token_window = TokenWindow(settings.llm_tpm_limit)
+    return _token_window
+
+
+def estimate_tokens(messages: Iterable[Dict[str, Any]]) -> int:
+    # Грубая оценка: ~4 символа на токен.
+    return sum(len(str(m.get("content") or "")) for m in messages) // 4 + 1
+
+
+@contextlib.asynccontextmanager
+async def llm_call_slot(messages: Iterable[Dict[str, Any]]) -> AsyncIterator[None]:
+    """
+    Admission for a single LLM request: TPM window (if LLM_TPM_LIMIT) + global semaphore.
+
+    Оборачивает только сам сетевой вызов: backoff между попытками идёт вне слота.
+    """
+    window = get_token_window()
+    if window is not None:
+        await window.admit(estimate_tokens(messages))
+    async with get_llm_semaphore():
+        yield
+
+
+def get_response_cache() -> TTLCache | None:
+    """Process-wide exact-match cache of LLM completions (None when LLM_RESPONSE_CACHE_TTL_S=0)."""
+    global _response_cache  # noqa: PLW0603
+    if settings.llm_response_cache_ttl_s <= 0:
+        return None
+    if _response_cache is None:
+        _response_cache = TTLCache(
+            maxsize=settings.llm_response_cache_size,
+            ttl=settings.llm_response_cache_ttl_s,
+        )
+    return _response_cache
+
+
+def response_cache_key(payload: Dict[str, Any]) -> str:
+    """Hash of the full request payload (model, messages, sampling params), key order independent."""
+    if orjson is not None:
+        raw = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)
+    else:
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def retry_after_seconds(exc: Exception) -> float | None:
+    """Parses Retry-After / retry-after-ms from a provider error response, if present."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    raw_ms = headers.get("retry-after-ms")
+    if raw_ms:
+        try:
+            return max(0.0, float(raw_ms) / 1000.0)
+        except ValueError:
+            pass
+    raw = headers.get("retry-after")
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    try:
+        # Retry-After может быть HTTP-датой.
+        retry_at = email.utils.parsedate_to_datetime(raw)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except Exception:  # noqa: BLE001
+        return None
+
+
+def backoff_delay_s(attempt: int, retry_after: float | None = None) -> float:
+    if retry_after is not None:
+        return min(_BACKOFF_CAP_S, retry_after)
+    return min(_BACKOFF_CAP_S, _BACKOFF_BASE_S * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+async def handle_rate_limit(exc: Exception, *, api_key: str, attempt: int, attempts: int) -> None:
+    """
+    Shared 429 handling for the key-rotation loops.
+
+    Ключ уходит на кулдаун (Retry-After), ротация переключается на следующий, и перед
+    следующей попыткой делается пауза с jitter — чтобы не сжечь все ключи за миллисекунды.
+    """
+    retry_after = retry_after_seconds(exc)
+    await mark_openai_api_key_rate_limited_async(api_key, retry_after_s=retry_after)
+    if attempt + 1 >= attempts:
+        return
+    delay = backoff_delay_s(attempt, retry_after)
+    logger.warning(
+        "llm_rate_limited attempt=%d retry_after=%s delay_s=%.2f",
+        attempt,
+        retry_after,
+        delay,
+    )
+    await asyncio.sleep(delay)
+
+
+async def create_chat_completion(payload: Dict[str, Any], *, base_url: str | None = None) -> Any:
+    """
+    chat.completions.create with key rotation — the one loop shared by all LLM roles.
+
+    Ключ выбирается round-robin (choose_openai_api_key), запрос идёт через общий AsyncOpenAI
+    на (api_key, base_url) под llm_call_slot. На 429 ключ уходит на кулдаун и берётся
+    следующий; минимум две попытки, даже с одним ключом. Остальные ошибки пробрасываются.
+    """
+    keys = await get_effective_openai_api_keys_async()
+    if not keys:
+        raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
+
+    base_url = base_url or settings.llm_base_url
+    messages = payload.get("messages") or []
+    last_exc: Exception | None = None
+    attempts = max(2, len(keys))
+    for attempt in range(attempts):
+        api_key = await choose_openai_api_key_async()
+        if not api_key:
+            raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
+
+        try:
+            client = get_async_client(api_key, base_url)
+            async with llm_call_slot(messages):
+                return await client.chat.completions.create(**payload)
+        except RateLimitError as exc:
+            last_exc = exc
+        except APIStatusError as exc:
+            if getattr(exc, "status_code", None) != 429:
+                raise
+            last_exc = exc
+        # backoff — вне слота, чтобы не держать семафор во время сна.
+        await handle_rate_limit(last_exc, api_key=api_key, attempt=attempt, attempts=attempts)
+
+    assert last_exc is not None
+    raise last_exc
+
+
+# Режимы structured output по убыванию строгости.
+_JSON_MODES: Tuple[str, ...] = ("json_schema", "json_object", "text")
+# model -> первый режим, который провайдер принял для этой модели (LLM_JSON_MODE=auto).
+_json_mode_by_model: Dict[str, str] = {}
+
+
+def _json_response_format(mode: str, name: str, schema: Dict[str, Any]) -> Dict[str, Any] | None:
+    if mode == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+async def chat_json_completion(
+    chat: Callable[[Dict[str, Any] | None], Awaitable[str]],
+    *,
+    model: str,
+    schema: Dict[str, Any],
+    name: str,
+) -> Dict[str, Any]:
+    """
+    Structured-output call: chat(response_format) -> parsed JSON object ({} if nothing parsed).
+
+    Начинаем с режима, который уже сработал для модели, поэтому на провайдере с json_schema
+    это ровно один запрос. Следующий режим пробуется, только если провайдер отклонил
+    response_format (400 — режим запоминается как неподдерживаемый), запрос упал или ответ
+    не разобрался как JSON. LLM_JSON_MODE, отличный от auto, фиксирует единственный режим.
+    """
+    if settings.llm_json_mode != "auto":
+        modes: Tuple[str, ...] = (settings.llm_json_mode,)
+    else:
+        start = _json_mode_by_model.get(model, _JSON_MODES[0])
+        modes = _JSON_MODES[_JSON_MODES.index(start) :]
+
+    raw = ""
+    for i, mode in enumerate(modes):
+        is_last = i == len(modes) - 1
+        try:
+            raw = await chat(_json_response_format(mode, name, schema))
+        except BadRequestError as exc:
+            if is_last:
+                raise
+            _json_mode_by_model[model] = modes[i + 1]
+            logger.info("llm_json_mode_unsupported model=%s mode=%s error=%r", model, mode, exc)
+            continue
+        except Exception:  # noqa: BLE001
+            if is_last:
+                raise
+            continue
+
+        if settings.llm_json_mode == "auto":
+            _json_mode_by_model.setdefault(model, mode)
+        data = extract_json_object(raw or "")
+        if data is not None or is_last:
+            return data or {}
+    return {}
+
+
+def _json_object_span(text: str, begin: int) -> int | None:
+    # End of the balanced {...} starting at text[begin] (None if it never closes).
+    # Один проход со счётчиком глубины; скобки внутри строковых литералов не считаются.
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(begin, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def extract_json_object(text: str) -> Dict[str, Any] | None:
+    """
+    Best-effort: the first balanced {...} span of an LLM reply that parses as a JSON object.
+
+    Замена жадной регулярки r"\\{.*\\}" с DOTALL: один проход на кандидата, а мусорные
+    скобки перед JSON (например, "{note}" или незакрытая "{note: \"x}") не ломают разбор —
+    кандидатом становится следующая "{".
+    """
+    begin = text.find("{")
+    while begin >= 0:
+        end = _json_object_span(text, begin)
+        if end is not None:
+            try:
+                data = json.loads(text[begin:end])
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                return data
+        begin = text.find("{", begin + 1)
+    return None
+
+
+class LazyJson:
+    """
+    Serializes the wrapped object only when the log record is actually formatted.
+
+    Используется для логирования payload'ов LLM: при выключенном DEBUG json не строится.
+    tail_messages ограничивает payload["messages"]: первое system-сообщение + N последних.
+    """
+
+    __slots__ = ("_obj", "_tail_messages")
+
+    def __init__(self, obj: Any, *, tail_messages: int | None = None) -> None:
+        self._obj = obj
+        self._tail_messages = tail_messages
+
+    def _capped(self) -> Any:
+        obj = self._obj
+        tail = self._tail_messages
+        if tail is None or not isinstance(obj, dict):
+            return obj
+        messages = obj.get("messages")
+        if not isinstance(messages, list) or len(messages) <= tail + 1:
+            return obj
+        head = messages[:1] if messages[0].get("role") == "system" else []
+        kept = messages[-tail:] if tail else []
+        omitted = len(messages) - len(head) - len(kept)
+        capped = dict(obj)
+        capped["messages"] = [*head, {"role": "...", "content": f"<{omitted} messages omitted>"}, *kept]
+        return capped
+
+    def __str__(self) -> str:
+        try:
+            obj = self._capped()
+            if orjson is not None:
+                return orjson.dumps(obj).decode("utf-8")
+            return json.dumps(obj, ensure_ascii=False)
+        except Exception:  # noqa: BLE001
+            return "<unserializable>"
+
+
+def _new_aiohttp_session() -> "aiohttp.ClientSession":
+    # Вызывается транспортом лениво, уже внутри запущенного event loop. Готовую сессию транспорт
+    # использует как есть, поэтому SSL-контекст (SSL_CERT_FILE/SSL_CERT_DIR) и прокси из
+    # окружения (HTTPS_PROXY, trust_env) задаём здесь — как у штатного httpx-клиента.
+    connector = aiohttp.TCPConnector(
+        limit=_MAX_CONNECTIONS,
+        keepalive_timeout=_KEEPALIVE_EXPIRY_S,
+        ssl=httpx.create_ssl_context(),
+    )
+    return aiohttp.ClientSession(connector=connector, read_bufsize=_READ_BUFSIZE, trust_env=True)
+
+
+def _build_http_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=_MAX_CONNECTIONS,
+        max_keepalive_connections=_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=_KEEPALIVE_EXPIRY_S,
+    )
+    if AiohttpTransport is not None:
+        return httpx.AsyncClient(
+            transport=AiohttpTransport(limits=limits, client=_new_aiohttp_session),
+            timeout=_TIMEOUT,
+        )
+    # Fallback: штатный транспорт httpcore (HTTP/2 через пакет h2).
+    return httpx.AsyncClient(limits=limits, http2=True, timeout=_TIMEOUT)
+
+
+def get_async_client(api_key: str, base_url: str) -> AsyncOpenAI:
+    """
+    Returns a process-wide AsyncOpenAI client for the given key/base_url pair.
+
+    Клиент создаётся один раз и живёт до вытеснения из LRU (_MAX_ASYNC_CLIENTS) или до
+    aclose_async_clients() (shutdown приложения).
+    """
+    key = (api_key, base_url)
+    client = _async_clients.get(key)
+    if client is not None:
+        _async_clients.move_to_end(key)
+        return client
+
+    http_client = _build_http_client()
+    logger.info(
+        "llm_async_client_created base_url=%s transport=%s",
+        base_url,
+        "aiohttp" if AiohttpTransport is not None else "httpx",
+    )
+    # Повторы делает наш цикл ротации ключей; встроенные ретраи SDK умножали бы задержку.
+    client = AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=http_client,
+        timeout=_TIMEOUT,
+        max_retries=0,
+    )
+    _async_clients[key] = client
+    while len(_async_clients) > _MAX_ASYNC_CLIENTS:
+        _, evicted = _async_clients.popitem(last=False)
+        _schedule_close(evicted)
+    return client
+
+
+def _schedule_close(client: AsyncOpenAI) -> None:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Вне event loop закрыть нечем: клиент закроется в aclose_async_clients().
+        _evicted_clients[client] = None
+        return
+    _evicted_clients[client] = loop.create_task(_close_evicted(client))
+
+
+async def _close_evicted(client: AsyncOpenAI) -> None:
+    await asyncio.sleep(_EVICTED_CLIENT_CLOSE_DELAY_S)
+    _evicted_clients.pop(client, None)
+    try:
+        await client.close()
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("llm_client_close_failed error=%r", exc)
+
+
+async def warm_up_async_clients(api_keys: Iterable[str], base_url: str, *, timeout_s: float = 10.0) -> None:
+    """
+    Opens connections for every (api_key, base_url) pair ahead of the first chat.
+
+    Лёгкий GET /models прогревает DNS, TLS и пул соединений; ошибки только логируются.
+    """
+
+    async def _one(api_key: str) -> None:
+        try:
+            await asyncio.wait_for(get_async_client(api_key, base_url).models.list(), timeout_s)
+            logger.info("llm_warmup_ok base_url=%s", base_url)
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("llm_warmup_failed base_url=%s error=%r", base_url, exc)
+
+    await asyncio.gather(*(_one(key) for key in dict.fromkeys(api_keys)))
+
+
+async def aclose_async_clients() -> None:
+    """Closes all cached and evicted clients (их пулы привязаны к event loop приложения)."""
+    clients = [*_async_clients.values(), *_evicted_clients]
+    for task in _evicted_clients.values():
+        if task is not None:
+            task.cancel()
+    _async_clients.clear()
+    _evicted_clients.clear()
+    for client in clients:
+        try:
+            await client.close()
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("llm_client_close_failed error=%r", exc)
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+
+_LOG_FORMAT = "%(asctime)s %(levelname)s:%(name)s:%(message)s"
+_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Сообщения длиннее этого порога (после подстановки args) обрезаются.
+MAX_MESSAGE_CHARS = 2048
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+class TruncatingFilter(logging.Filter):
+    """
+    Truncates oversized log messages (LLM payloads, prompts) to MAX_MESSAGE_CHARS.
+
+    Сообщение форматируется один раз; при превышении лимита msg заменяется обрезанной
+    строкой, а args обнуляются, чтобы handler не форматировал запись повторно.
+    """
+
+    def __init__(self, max_chars: int = MAX_MESSAGE_CHARS) -> None:
+        super().__init__()
+        self._max_chars = max_chars
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        if len(message) > self._max_chars:
+            omitted = len(message) - self._max_chars
+            record.msg = f"{message[: self._max_chars]}...<{omitted} chars omitted>"
+            record.args = None
+        return True
+
+
+def setup_logging(level: int = logging.INFO) -> None:
+    """
+    Configures root logging: QueueHandler in the caller, real I/O in a QueueListener thread.
+
+    Запись в stderr (под lock'ом handler'а) уходит в фоновый поток и не блокирует event loop.
+    """
+    global _listener  # noqa: PLW0603
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(_LOG_FORMAT, datefmt=_DATE_FORMAT))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(TruncatingFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
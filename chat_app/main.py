@@ -1,9 +1,15 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
 
-from fastapi import BackgroundTasks, Depends, FastAPI, Header, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse, Response
+import anyio.to_thread
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 
 from openai import (
     APIConnectionError,
@@ -14,6 +20,9 @@ from openai import (
 )
 
 from .config import settings
+from .http_cache import ResponseCache
+from .llm_client import aclose_async_clients, warm_up_async_clients
+from .logging_setup import setup_logging
 from .memory import BaseConversationMemory, InMemoryConversationMemory, RedisConversationMemory
 from .retriever import KBRetriever
 from .scenario_registry import registry as scenario_registry
@@ -30,15 +39,11 @@ from .schemas import (
 from .tools.user_data import get_user_data
 from .tools.registry import list_tool_specs
 from .sgr.schemas import SgrConvertRequest, SgrConvertResponse
-from .sgr.converter import sgr_convert_text
+from .sgr.cache import sgr_convert_text_cached
 from .sgr.langchain_chain.pipeline import SgrConvertError
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s:%(name)s:%(message)s",
-    datefmt="%Y-%m-%dT%H:%M:%S",
-)
+setup_logging(logging.INFO)
 
 app = FastAPI(title="Chat Agent Service")
 
@@ -46,10 +51,8 @@ logger = logging.getLogger("chat_app.api")
 
 from .pipelines.v0_1.orchestrator_v0_1 import ChatOrchestrator as ChatOrchestratorV01
 from .pipelines.v0_1.scenario_runner_v0_1 import ScenarioToolRunner
-from .pipelines.v0_1.summarizer_v0_1 import Summarizer as SummarizerV01
 from .pipelines.v1_0.graph_pipeline import GraphChatPipelineV10 as ChatOrchestratorV10
-from .pipelines.v1_0.summarizer_v1_0 import Summarizer as SummarizerV10
-from .runtime_config import get_effective_agent_pipeline_version
+from .runtime_config import get_effective_agent_pipeline_version_async, get_effective_openai_api_keys
 
 
 # Пытаемся использовать Redis как основное хранилище.
@@ -71,35 +74,91 @@ _orchestrator_v10 = ChatOrchestratorV10(
     retriever=_retriever,
     scenario_registry=scenario_registry,
 )
-_summarizer_v01 = SummarizerV01()
-_summarizer_v10 = SummarizerV10()
 
 _orchestrators = {
     "0.1": _orchestrator_v01,
     "1.0": _orchestrator_v10,
 }
-_summarizers = {
-    "0.1": _summarizer_v01,
-    "1.0": _summarizer_v10,
-}
 
 
 @app.on_event("startup")
 async def startup_event() -> None:
-    # Load default scenario definition from disk (if present).
-    scenario_registry.load_default_from_disk()
+    # Пулы потоков: default executor asyncio и лимитер AnyIO (run_in_threadpool, to_thread).
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=settings.thread_pool_size, thread_name_prefix="chat_app")
+    )
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.thread_pool_size
+
+    # Load default scenario definition from disk (if present); чтение файла — вне event loop.
+    await run_in_threadpool(scenario_registry.load_default_from_disk)
+
+    # Прогрев соединений: первый /chat не должен платить за TCP/TLS к Redis и LLM-провайдеру.
+    # Все роли (condition/judge/revise/summary) используют один base_url, поэтому греем
+    # по одному клиенту на каждый ключ из ротации.
+    try:
+        await _memory.ping()
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("memory_warmup_failed error=%r", exc)
+    try:
+        api_keys = await run_in_threadpool(get_effective_openai_api_keys)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("llm_warmup_keys_failed error=%r", exc)
+        api_keys = [settings.llm_api_key] if settings.llm_api_key else []
+    await warm_up_async_clients(api_keys, settings.llm_base_url)
+
 
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    await aclose_async_clients()
 
-def get_memory() -> BaseConversationMemory:
+
+async def get_memory() -> BaseConversationMemory:
+    # async-зависимость: FastAPI не гоняет её через пул потоков на каждый запрос.
     return _memory
 
 
-def _normalize_pipeline_version(version: str | None) -> str:
-    v = (version or "").strip()
-    if v in _orchestrators:
-        return v
-    effective_default = get_effective_agent_pipeline_version()
-    return effective_default if effective_default in _orchestrators else "0.1"
+_VERSION_LOOKUP: dict[str, str] = {v: v for v in _orchestrators}
+
+# Версия по умолчанию может меняться через runtime config (Redis, UI); чтение overrides
+# кэшируется в runtime_config на пару секунд, поэтому Redis не читается на каждый запрос.
+async def _default_pipeline_version() -> str:
+    return _VERSION_LOOKUP.get(await get_effective_agent_pipeline_version_async(), "0.1")
+
+
+async def _normalize_pipeline_version(version: str | None) -> str:
+    return _VERSION_LOOKUP.get((version or "").strip()) or await _default_pipeline_version()
+
+
+# Кэш ответов для идемпотентных GET (UI их часто опрашивает): ETag/304 + TTL-кэш тел.
+# _BOOT_ID в теге не даёт клиенту получить 304 на ревизию из прошлого запуска процесса.
+_BOOT_ID = uuid.uuid4().hex[:8]
+_response_cache = ResponseCache(maxsize=10_000, ttl=5.0)
+
+
+async def _conversation_tag(request: Request) -> str:
+    conversation_id = request.query_params["conversation_id"]
+    revision = await _memory.get_revision(conversation_id)
+    return f"conv-{_BOOT_ID}-{revision}"
+
+
+async def _config_tag(request: Request) -> str:
+    return f"config-{_BOOT_ID}-{await _default_pipeline_version()}"
+
+
+async def _tools_tag(request: Request) -> str:
+    return f"tools-{_BOOT_ID}"
+
+
+async def _scenarios_tag(request: Request) -> str:
+    return f"scenarios-{_BOOT_ID}-{scenario_registry.revision}"
+
+
+_response_cache.register("/history", _conversation_tag)
+_response_cache.register("/summary", _conversation_tag)
+_response_cache.register("/config", _config_tag)
+_response_cache.register("/tools", _tools_tag)
+_response_cache.register("/scenarios", _scenarios_tag)
+app.middleware("http")(_response_cache)
 
 
 @app.get("/health")
@@ -113,7 +172,7 @@ async def get_config() -> dict[str, object]:
     Runtime config for UI.
     Returns the default pipeline version used when request header is absent.
     """
-    default_version = _normalize_pipeline_version(None)
+    default_version = await _normalize_pipeline_version(None)
     return {
         "default_pipeline_version": default_version,
         "supported_pipeline_versions": sorted(list(_orchestrators.keys())),
@@ -131,32 +190,42 @@ async def list_tools() -> list[ToolSpec]:
     response_model_exclude_none=True,
     response_model_exclude_defaults=True,
 )
-async def sgr_convert(request: SgrConvertRequest) -> Response:
+async def sgr_convert(
+    request: SgrConvertRequest,
+    response: Response,
+    fresh: bool = Query(default=False, description="Игнорировать кэш и выполнить конвертацию заново."),
+) -> Response:
     """
     Convert plain-language SGR text into a ScenarioDefinition + diagnostics.
     Does NOT upsert into ScenarioRegistry (caller can POST /scenarios).
+    Results (including 422) are cached by input hash; X-Cache: HIT|MISS, ?fresh=1 bypasses.
     """
     tools = list_tool_specs()
     logger.info("sgr_convert_request chars=%d name_hint=%r strict=%s", len(request.text or ""), request.name_hint, request.strict)
     try:
-        scenario, diagnostics, questions = await sgr_convert_text(
+        (scenario, diagnostics, questions), cache_hit = await sgr_convert_text_cached(
             text=request.text,
             available_tools=tools,
             name_hint=request.name_hint,
             strict=request.strict,
             return_diagnostics=request.return_diagnostics,
+            fresh=fresh,
         )
+        cache_status = "HIT" if cache_hit else "MISS"
         logger.info(
-            "sgr_convert_result name=%r code_len=%d questions=%d trace_id=%r",
+            "sgr_convert_result name=%r code_len=%d questions=%d trace_id=%r cache=%s",
             scenario.name,
             len(scenario.code or []),
             len(questions or []),
             (diagnostics or {}).get("trace_id"),
+            cache_status,
         )
+        response.headers["X-Cache"] = cache_status
         return SgrConvertResponse(scenario=scenario, diagnostics=diagnostics, questions=questions)
     except SgrConvertError as exc:
         # Contract: return HTTP 422 with a flat JSON body (no "detail") and no scenario.
-        return JSONResponse(status_code=422, content=exc.to_422())
+        cache_status = "HIT" if getattr(exc, "cache_hit", False) else "MISS"
+        return JSONResponse(status_code=422, content=exc.to_422(), headers={"X-Cache": cache_status})
     except RateLimitError as exc:
         raise HTTPException(status_code=429, detail=f"LLM rate limited: {exc}") from exc
     except AuthenticationError as exc:
@@ -179,7 +248,7 @@ async def get_graph(
     Debug endpoint: визуализация LangGraph-графа (v1.0).
     format=mermaid|png, xray=0|1 (раскрывает subgraph-узлы).
     """
-    version = _normalize_pipeline_version(pipeline_version)
+    version = await _normalize_pipeline_version(pipeline_version)
     orchestrator = _orchestrators[version]
     if not hasattr(orchestrator, "export_graph_mermaid"):
         raise HTTPException(status_code=404, detail="Graph is not available for this pipeline version")
@@ -195,23 +264,41 @@ async def get_graph(
 @app.post("/chat", response_model=ChatResponse)
 async def chat(
     request: ChatRequest,
-    memory: BaseConversationMemory = Depends(get_memory),
-    background_tasks: BackgroundTasks = None,  # type: ignore[assignment]
     pipeline_version: str | None = Header(default=None, alias="X-Agent-Pipeline-Version"),
 ) -> ChatResponse:
-    version = _normalize_pipeline_version(pipeline_version)
+    version = await _normalize_pipeline_version(pipeline_version)
+    orchestrator = _orchestrators[version]
+
+    # Суммаризация запускается самим пайплайном в фоне после записи хода (SummaryScheduler).
+    return await orchestrator.handle_chat(request)
+
+
+@app.post("/chat/stream")
+async def chat_stream(
+    request: ChatRequest,
+    pipeline_version: str | None = Header(default=None, alias="X-Agent-Pipeline-Version"),
+) -> StreamingResponse:
+    """
+    Same as /chat, but streams the answer as plain text while the model generates it.
+
+    v0.1 отдаёт токены по мере генерации; v1.0 (judge может переписать ответ) отдаёт
+    готовый ответ одним фрагментом. Чанки KB и last_step_scenario здесь не возвращаются.
+    """
+    version = await _normalize_pipeline_version(pipeline_version)
     orchestrator = _orchestrators[version]
-    summarizer = _summarizers[version]
 
-    response = await orchestrator.handle_chat(request)
-    # v1.0: суммаризация запускается внутри графа как fire-and-forget (launch_summary).
-    # v0.1: запускаем как FastAPI BackgroundTasks (как раньше).
-    if version != "1.0":
-        if background_tasks is not None:
-            background_tasks.add_task(summarizer.update_summary, memory, request.conversation_id)
-        else:
-            await summarizer.update_summary(memory, request.conversation_id)
-    return response
+    if version == "1.0":
+        response = await orchestrator.handle_chat(request)
+
+        async def body() -> AsyncIterator[str]:
+            yield response.answer
+
+        return StreamingResponse(body(), media_type="text/plain; charset=utf-8")
+
+    # Ход готовится до StreamingResponse: ошибки state/KB/сценариев не прячутся за уже
+    # отправленным статусом 200.
+    deltas = await orchestrator.handle_chat_stream(request)
+    return StreamingResponse(deltas, media_type="text/plain; charset=utf-8")
 
 
 @app.get("/history", response_model=HistoryResponse)
@@ -219,7 +306,7 @@ async def get_history(
     conversation_id: str,
     memory: BaseConversationMemory = Depends(get_memory),
 ) -> HistoryResponse:
-    return memory.get_history(conversation_id)
+    return await memory.get_history(conversation_id)
 
 
 @app.get("/summary", response_model=SummaryResponse)
@@ -228,12 +315,13 @@ async def get_summary(
     memory: BaseConversationMemory = Depends(get_memory),
 ) -> SummaryResponse:
     # Для отладки проблем с summary логируем наличие истории и самого summary.
-    history = memory.get_history(conversation_id)
-    summary = memory.get_summary(conversation_id)
+    # Длину истории берём через LLEN, а не чтением всего списка.
+    history_len = await memory.get_history_len(conversation_id)
+    summary = await memory.get_summary(conversation_id)
     logger.info(
         "get_summary conversation_id=%s history_len=%d summary_present=%s",
         conversation_id,
-        len(history.history),
+        history_len,
         bool(summary.summary),
     )
     return summary
@@ -247,9 +335,9 @@ async def add_scenario(definition: ScenarioDefinition) -> ScenarioUpsertResponse
 
 
 @app.get("/scenarios", response_model=list[ScenarioDefinition])
-async def list_scenarios() -> list[ScenarioDefinition]:
-    """Return all currently registered scenarios."""
-    return list(scenario_registry.all().values())
+async def list_scenarios() -> tuple[ScenarioDefinition, ...]:
+    """Return all currently registered scenarios (ETag/304 — see _response_cache)."""
+    return scenario_registry.snapshot()
 
 
 @app.delete("/scenarios/{name}", response_model=ScenarioUpsertResponse)
@@ -1,15 +1,49 @@
 from __future__ import annotations
 
+import itertools
 import json
-from typing import Dict, List
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
 
 try:
-    import redis  # type: ignore
+    from redis import asyncio as aioredis  # type: ignore
 except Exception:  # noqa: BLE001
-    redis = None  # type: ignore[assignment]
+    aioredis = None  # type: ignore[assignment]
+
+try:
+    import orjson  # type: ignore
+except Exception:  # noqa: BLE001
+    orjson = None  # type: ignore[assignment]
 
 from .config import settings
-from .schemas import ConversationState, HistoryItem, HistoryResponse, SummaryResponse
+from .schemas import ConversationState, HistoryItem, HistoryResponse, MessageRole, SummaryResponse, UserProfile
+
+
+def _loads(raw: str) -> Any:
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _trusted_history_item(raw: str) -> HistoryItem:
+    # Данные записаны этим же сервисом: собираем модель без валидации (model_construct),
+    # вручную приводя только enum и datetime.
+    data = _loads(raw)
+    return HistoryItem.model_construct(
+        role=MessageRole(data["role"]),
+        content=data["content"],
+        timestamp=datetime.fromisoformat(data["timestamp"]),
+    )
+
+
+def _trusted_state(raw: str) -> ConversationState:
+    data = _loads(raw)
+    profile = data.get("user_profile") or {}
+    data["user_profile"] = UserProfile.model_construct(
+        name=profile.get("name"),
+        age=profile.get("age"),
+        extra=profile.get("extra") or {},
+    )
+    return ConversationState.model_construct(**data)
 
 
 class BaseConversationMemory:
@@ -19,56 +53,172 @@ class BaseConversationMemory:
     Concrete implementations may use Redis, a database or in-memory storage.
     """
 
-    def get_state(self, conversation_id: str) -> ConversationState:
+    async def get_state(self, conversation_id: str) -> ConversationState:
+        raise NotImplementedError
+
+    async def save_state(self, state: ConversationState) -> None:
+        raise NotImplementedError
+
+    async def append_history(self, conversation_id: str, item: HistoryItem) -> None:
         raise NotImplementedError
 
-    def save_state(self, state: ConversationState) -> None:
+    async def save_state_and_append(self, state: ConversationState, *items: HistoryItem) -> None:
+        """Persist state and append history items in order (implementations may batch all writes)."""
+        for item in items:
+            await self.append_history(state.conversation_id, item)
+        await self.save_state(state)
+
+    async def load(
+        self,
+        conversation_id: str,
+        history_limit: int | None = None,
+    ) -> Tuple[ConversationState, List[HistoryItem]]:
+        """State and (the tail of) history in one call; implementations may pipeline both reads."""
+        state = await self.get_state(conversation_id)
+        history = (await self.get_history(conversation_id, limit=history_limit)).history
+        return state, history
+
+    async def get_history(self, conversation_id: str, limit: int | None = None) -> HistoryResponse:
+        """
+        Returns conversation history.
+
+        limit — вернуть только последние N сообщений; None — всю историю.
+        """
         raise NotImplementedError
 
-    def append_history(self, conversation_id: str, item: HistoryItem) -> None:
+    async def get_history_len(self, conversation_id: str) -> int:
         raise NotImplementedError
 
-    def get_history(self, conversation_id: str) -> HistoryResponse:
+    async def get_history_tail(self, conversation_id: str, limit: int) -> Tuple[List[HistoryItem], int]:
+        """Last `limit` history items and the full history length (implementations may pipeline both reads)."""
+        history = (await self.get_history(conversation_id, limit=limit)).history
+        return history, await self.get_history_len(conversation_id)
+
+    async def get_revision(self, conversation_id: str) -> int:
+        """Monotonic counter bumped on every state/history write (used for HTTP ETags)."""
         raise NotImplementedError
 
-    def get_summary(self, conversation_id: str) -> SummaryResponse:
+    async def get_summary(self, conversation_id: str) -> SummaryResponse:
         raise NotImplementedError
 
+    async def ping(self) -> None:
+        """Opens/validates the backend connection (no-op for in-process storage)."""
+        return None
+
+
+class _InMemoryConversation:
+    __slots__ = ("state", "history", "state_bytes", "history_bytes", "revision")
+
+    def __init__(self, state: ConversationState) -> None:
+        self.state = state
+        self.history: List[HistoryItem] = []
+        self.state_bytes = 0
+        self.history_bytes = 0
+        self.revision = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.state_bytes + self.history_bytes
+
 
 class InMemoryConversationMemory(BaseConversationMemory):
     """
     Simple in-memory implementation of conversation memory.
 
     Suitable for local development and tests. Can be replaced by a Redis-based
-    implementation without changing the public interface.
+    implementation without changing the public interface (методы async ради
+    единого интерфейса, но ничего не ждут).
+
+    Диалоги хранятся в LRU с ограничением по количеству и по примерному объёму
+    (длина JSON-представления state/history): при превышении вытесняются самые давние.
     """
 
-    def __init__(self) -> None:
-        self._states: Dict[str, ConversationState] = {}
-        self._history: Dict[str, List[HistoryItem]] = {}
+    def __init__(self, max_conversations: int | None = None, max_bytes: int | None = None) -> None:
+        self._max_conversations = max_conversations or settings.in_memory_max_conversations
+        self._max_bytes = max_bytes or settings.in_memory_max_bytes
+        self._conversations: "OrderedDict[str, _InMemoryConversation]" = OrderedDict()
+        self._bytes = 0
+        self._evictions = 0
+        # Ревизии общие на всё хранилище: после вытеснения и повторной записи диалог
+        # не получит номер, который уже отдавался клиенту в ETag.
+        self._revisions = itertools.count(1)
+
+    def _entry(self, conversation_id: str) -> _InMemoryConversation:
+        entry = self._conversations.get(conversation_id)
+        if entry is None:
+            entry = _InMemoryConversation(ConversationState(conversation_id=conversation_id))
+            self._conversations[conversation_id] = entry
+            self._evict(keep=conversation_id)
+        else:
+            self._conversations.move_to_end(conversation_id)
+        return entry
 
-    def get_state(self, conversation_id: str) -> ConversationState:
-        state = self._states.get(conversation_id)
-        if state is None:
-            state = ConversationState(conversation_id=conversation_id)
-            self._states[conversation_id] = state
-        return state
+    def _evict(self, keep: str) -> None:
+        while len(self._conversations) > 1 and (
+            len(self._conversations) > self._max_conversations or self._bytes > self._max_bytes
+        ):
+            oldest_id = next(iter(self._conversations))
+            if oldest_id == keep:
+                break
+            oldest = self._conversations.pop(oldest_id)
+            self._bytes -= oldest.nbytes
+            self._evictions += 1
 
-    def save_state(self, state: ConversationState) -> None:
-        self._states[state.conversation_id] = state
+    async def get_state(self, conversation_id: str) -> ConversationState:
+        return self._entry(conversation_id).state
 
-    def append_history(self, conversation_id: str, item: HistoryItem) -> None:
-        self._history.setdefault(conversation_id, []).append(item)
+    async def save_state(self, state: ConversationState) -> None:
+        entry = self._entry(state.conversation_id)
+        size = len(state.model_dump_json())
+        self._bytes += size - entry.state_bytes
+        entry.state, entry.state_bytes = state, size
+        entry.revision = next(self._revisions)
+        self._evict(keep=state.conversation_id)
 
-    def get_history(self, conversation_id: str) -> HistoryResponse:
-        items = self._history.get(conversation_id, [])
+    async def append_history(self, conversation_id: str, item: HistoryItem) -> None:
+        entry = self._entry(conversation_id)
+        size = len(item.model_dump_json())
+        entry.history.append(item)
+        entry.history_bytes += size
+        self._bytes += size
+        entry.revision = next(self._revisions)
+        self._evict(keep=conversation_id)
+
+    def _peek(self, conversation_id: str) -> _InMemoryConversation | None:
+        entry = self._conversations.get(conversation_id)
+        if entry is not None:
+            self._conversations.move_to_end(conversation_id)
+        return entry
+
+    async def get_history(self, conversation_id: str, limit: int | None = None) -> HistoryResponse:
+        entry = self._peek(conversation_id)
+        items = entry.history if entry is not None else []
+        if limit is not None:
+            items = items[-limit:] if limit > 0 else []
         return HistoryResponse(conversation_id=conversation_id, history=items)
 
-    def get_summary(self, conversation_id: str) -> SummaryResponse:
-        state = self.get_state(conversation_id)
+    async def get_history_len(self, conversation_id: str) -> int:
+        entry = self._peek(conversation_id)
+        return len(entry.history) if entry is not None else 0
+
+    async def get_revision(self, conversation_id: str) -> int:
+        entry = self._conversations.get(conversation_id)
+        return entry.revision if entry is not None else 0
+
+    async def get_summary(self, conversation_id: str) -> SummaryResponse:
+        state = await self.get_state(conversation_id)
         # Stub: summary will be updated by a dedicated summarizer component.
         return SummaryResponse(conversation_id=conversation_id, summary=state.summary)
 
+    def memory_stats(self) -> Dict[str, int]:
+        return {
+            "conversations": len(self._conversations),
+            "approx_bytes": self._bytes,
+            "max_conversations": self._max_conversations,
+            "max_bytes": self._max_bytes,
+            "evictions": self._evictions,
+        }
+
 
 class RedisConversationMemory(BaseConversationMemory):
     """
@@ -77,14 +227,24 @@ class RedisConversationMemory(BaseConversationMemory):
     Хранит:
     - состояние диалога в ключе conv:{conversation_id}:state (JSON ConversationState)
     - историю сообщений в списке conv:{conversation_id}:history (JSON HistoryItem)
+    - счётчик ревизий conv:{conversation_id}:rev (INCR на каждую запись; для ETag)
     """
 
+    _MAX_CONNECTIONS = 64
+    # Размер страницы LRANGE при чтении полной истории.
+    _HISTORY_PAGE_SIZE = 500
+
     def __init__(self, url: str | None = None) -> None:
-        if redis is None:
+        if aioredis is None:
             raise RuntimeError("redis package is not installed")
         redis_url = url or settings.redis_url
         # decode_responses=True — чтобы получать/записывать строки (а не bytes).
-        self._client = redis.Redis.from_url(redis_url, decode_responses=True)
+        # Асинхронный клиент: запросы к Redis не блокируют event loop.
+        self._client = aioredis.Redis.from_url(
+            redis_url,
+            decode_responses=True,
+            max_connections=self._MAX_CONNECTIONS,
+        )
 
     def _state_key(self, conversation_id: str) -> str:
         return f"conv:{conversation_id}:state"
@@ -92,39 +252,136 @@ class RedisConversationMemory(BaseConversationMemory):
     def _history_key(self, conversation_id: str) -> str:
         return f"conv:{conversation_id}:history"
 
-    def get_state(self, conversation_id: str) -> ConversationState:
-        raw = self._client.get(self._state_key(conversation_id))
+    def _revision_key(self, conversation_id: str) -> str:
+        return f"conv:{conversation_id}:rev"
+
+    async def get_state(self, conversation_id: str) -> ConversationState:
+        raw = await self._client.get(self._state_key(conversation_id))
         if not raw:
             return ConversationState(conversation_id=conversation_id)
         try:
-            data = json.loads(raw)
-            return ConversationState.model_validate(data)
+            return self._parse_state(raw)
         except Exception:  # noqa: BLE001
             # В случае проблем с форматом — начинаем с чистого состояния.
             return ConversationState(conversation_id=conversation_id)
 
-    def save_state(self, state: ConversationState) -> None:
-        # mode="json" гарантирует сериализацию datetime и других типов
-        # в JSON-дружественный формат.
-        data = state.model_dump(mode="json")
-        self._client.set(self._state_key(state.conversation_id), json.dumps(data, ensure_ascii=False))
+    # Сериализация/парсинг идут через pydantic-core (Rust) напрямую: без промежуточного dict
+    # и stdlib json. Формат в Redis прежний (UTF-8 JSON, datetime в ISO-строке).
+    @staticmethod
+    def _dump_state(state: ConversationState) -> str:
+        return state.model_dump_json()
+
+    @staticmethod
+    def _dump_item(item: HistoryItem) -> str:
+        return item.model_dump_json()
 
-    def append_history(self, conversation_id: str, item: HistoryItem) -> None:
-        # mode="json" конвертирует timestamp (datetime) в строку.
-        data = item.model_dump(mode="json")
-        self._client.rpush(self._history_key(conversation_id), json.dumps(data, ensure_ascii=False))
+    @staticmethod
+    def _parse_state(raw: str) -> ConversationState:
+        if not settings.validate_redis_reads:
+            try:
+                return _trusted_state(raw)
+            except Exception:  # noqa: BLE001
+                pass
+        return ConversationState.model_validate_json(raw)
 
-    def get_history(self, conversation_id: str) -> HistoryResponse:
-        raw_items = self._client.lrange(self._history_key(conversation_id), 0, -1)
+    @staticmethod
+    def _parse_items(raw_items: List[str]) -> List[HistoryItem]:
         items: List[HistoryItem] = []
+        validate = HistoryItem.model_validate_json
+        trusted = not settings.validate_redis_reads
         for raw in raw_items:
+            if trusted:
+                try:
+                    items.append(_trusted_history_item(raw))
+                    continue
+                except Exception:  # noqa: BLE001
+                    pass
             try:
-                data = json.loads(raw)
-                items.append(HistoryItem.model_validate(data))
+                items.append(validate(raw))
             except Exception:  # noqa: BLE001
                 continue
+        return items
+
+    async def save_state(self, state: ConversationState) -> None:
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.set(self._state_key(state.conversation_id), self._dump_state(state))
+            pipe.incr(self._revision_key(state.conversation_id))
+            await pipe.execute()
+
+    async def append_history(self, conversation_id: str, item: HistoryItem) -> None:
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.rpush(self._history_key(conversation_id), self._dump_item(item))
+            pipe.incr(self._revision_key(conversation_id))
+            await pipe.execute()
+
+    async def save_state_and_append(self, state: ConversationState, *items: HistoryItem) -> None:
+        # SET + RPUSH одним round trip (MULTI/EXEC).
+        async with self._client.pipeline(transaction=True) as pipe:
+            if items:
+                pipe.rpush(self._history_key(state.conversation_id), *(self._dump_item(i) for i in items))
+            pipe.set(self._state_key(state.conversation_id), self._dump_state(state))
+            pipe.incr(self._revision_key(state.conversation_id))
+            await pipe.execute()
+
+    async def load(
+        self,
+        conversation_id: str,
+        history_limit: int | None = None,
+    ) -> Tuple[ConversationState, List[HistoryItem]]:
+        if history_limit is None or history_limit <= 0:
+            return await super().load(conversation_id, history_limit)
+        # GET state + LRANGE хвоста истории одним round trip.
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.get(self._state_key(conversation_id))
+            pipe.lrange(self._history_key(conversation_id), -history_limit, -1)
+            raw_state, raw_items = await pipe.execute()
+        state = ConversationState(conversation_id=conversation_id)
+        if raw_state:
+            try:
+                state = self._parse_state(raw_state)
+            except Exception:  # noqa: BLE001
+                pass
+        return state, self._parse_items(raw_items)
+
+    async def get_history(self, conversation_id: str, limit: int | None = None) -> HistoryResponse:
+        key = self._history_key(conversation_id)
+        if limit is not None:
+            raw_items = await self._client.lrange(key, -limit, -1) if limit > 0 else []
+            return HistoryResponse(conversation_id=conversation_id, history=self._parse_items(raw_items))
+
+        # Полная история читается страницами, чтобы не тянуть огромный список одним ответом.
+        items: List[HistoryItem] = []
+        start = 0
+        page = self._HISTORY_PAGE_SIZE
+        while True:
+            raw_items = await self._client.lrange(key, start, start + page - 1)
+            items.extend(self._parse_items(raw_items))
+            if len(raw_items) < page:
+                break
+            start += page
         return HistoryResponse(conversation_id=conversation_id, history=items)
 
-    def get_summary(self, conversation_id: str) -> SummaryResponse:
-        state = self.get_state(conversation_id)
+    async def get_history_len(self, conversation_id: str) -> int:
+        return int(await self._client.llen(self._history_key(conversation_id)))
+
+    async def get_history_tail(self, conversation_id: str, limit: int) -> Tuple[List[HistoryItem], int]:
+        if limit <= 0:
+            return [], await self.get_history_len(conversation_id)
+        # LRANGE хвоста + LLEN одним round trip.
+        key = self._history_key(conversation_id)
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.lrange(key, -limit, -1)
+            pipe.llen(key)
+            raw_items, history_len = await pipe.execute()
+        return self._parse_items(raw_items), int(history_len)
+
+    async def get_revision(self, conversation_id: str) -> int:
+        raw = await self._client.get(self._revision_key(conversation_id))
+        return int(raw) if raw else 0
+
+    async def ping(self) -> None:
+        await self._client.ping()
+
+    async def get_summary(self, conversation_id: str) -> SummaryResponse:
+        state = await self.get_state(conversation_id)
         return SummaryResponse(conversation_id=conversation_id, summary=state.summary)
@@ -1,21 +1,36 @@
 from __future__ import annotations
 
+import json
 import logging
-from typing import Any, Dict, List
+from typing import Any, AsyncIterator, Dict, List, Tuple
 
-import anyio
-from openai import APIStatusError, OpenAI, RateLimitError
+from openai import APIStatusError, RateLimitError
 
 from chat_app.config import settings
-from chat_app.runtime_config import (
-    get_effective_openai_api_key,
-    get_effective_openai_api_keys,
-    mark_openai_api_key_rate_limited,
+from chat_app.llm_client import (
+    LazyJson,
+    create_chat_completion,
+    extract_json_object,
+    get_async_client,
+    get_response_cache,
+    handle_rate_limit,
+    llm_call_slot,
+    response_cache_key,
 )
+from chat_app.runtime_config import choose_openai_api_key_async, get_effective_openai_api_keys_async
 
 
 logger = logging.getLogger("chat_app.llm_v0_1")
 
+# Дописывается к system-промпту в режиме FUSED_SUMMARY.
+_FUSED_SUMMARY_INSTRUCTIONS = (
+    "\noutput_format: |\n"
+    "  Верни СТРОГО JSON без лишнего текста формата: {\"answer\": \"...\", \"summary\": \"...\"}.\n"
+    "  answer — ответ пользователю по всем правилам выше.\n"
+    "  summary — обновлённое краткое резюме всего диалога с учётом dialog_summary, dialog_tail,\n"
+    "  new_user_message и твоего ответа: 1–3 предложения на русском в форме «Вы спрашивали ..., я объяснил ...».\n"
+)
+
 
 class LLMClient:
     """
@@ -32,6 +47,7 @@ class LLMClient:
         base_url = base_url or settings.llm_base_url
         self._base_url = base_url
         self._model = model or settings.llm_model
+        self._default_max_tokens = settings.llm_max_output_tokens
 
         logger.info(
             "llm_client_init_v0_1 model=%s base_url=%s",
@@ -49,61 +65,40 @@ class LLMClient:
         """
         Execute a chat completion request and return assistant text.
 
-        Вызов выполняется в отдельном потоке, чтобы не блокировать event loop.
+        Используется общий AsyncOpenAI-клиент (см. chat_app.llm_client): запрос не занимает
+        поток из пула AnyIO и переиспользует пул соединений. При temperature=0 идентичный payload
+        в пределах LLM_RESPONSE_CACHE_TTL_S отдаётся из кэша, без выбора ключа и сетевого запроса.
         """
 
-        keys = get_effective_openai_api_keys()
-        if not keys:
-            raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
-
         kwargs: Dict[str, Any] = {
             "model": self._model,
             "messages": messages,
             "temperature": temperature,
+            "max_tokens": max_tokens or self._default_max_tokens,
         }
-        if max_tokens is not None:
-            kwargs["max_tokens"] = max_tokens
-
-        # Логируем payload, чтобы можно было воспроизвести запрос вручную.
-        try:
-            import json
 
-            logger.info(
-                "llm_chat_request_v0_1 model=%s payload=%s",
-                self._model,
-                json.dumps(kwargs, ensure_ascii=False),
-            )
-        except Exception:  # noqa: BLE001
-            logger.info("llm_chat_request_v0_1 model=%s payload=<unserializable>", self._model)
+        # Сэмплированные ответы (temperature > 0) не кэшируем: повтор сообщения не должен
+        # возвращать тот же «замороженный» текст.
+        cache = get_response_cache() if temperature <= 0 else None
+        cache_key = response_cache_key(kwargs) if cache is not None else ""
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.debug("llm_cache_hit_v0_1 model=%s key=%s", self._model, cache_key)
+                return cached
+
+        # Логируем payload, чтобы можно было воспроизвести запрос вручную (только в DEBUG).
+        logger.debug(
+            "llm_chat_request_v0_1 model=%s payload=%s",
+            self._model,
+            LazyJson(kwargs, tail_messages=2),
+        )
 
-        last_exc: Exception | None = None
-        for _attempt in range(max(1, len(keys))):
-            def _call() -> Any:
-                api_key = get_effective_openai_api_key()
-                if not api_key:
-                    raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
-                client = OpenAI(api_key=api_key, base_url=self._base_url)
-                return client.chat.completions.create(**kwargs)
-
-            try:
-                response = await anyio.to_thread.run_sync(_call)
-                break
-            except RateLimitError as exc:
-                last_exc = exc
-                mark_openai_api_key_rate_limited()
-                continue
-            except APIStatusError as exc:
-                last_exc = exc
-                if getattr(exc, "status_code", None) == 429:
-                    mark_openai_api_key_rate_limited()
-                    continue
-                raise
-            except Exception as exc:  # noqa: BLE001
-                logger.error("LLM v0.1 request failed: %s", exc)
-                raise
-        else:
-            assert last_exc is not None
-            raise last_exc
+        try:
+            response = await create_chat_completion(kwargs, base_url=self._base_url)
+        except Exception as exc:  # noqa: BLE001
+            logger.error("LLM v0.1 request failed: %s", exc)
+            raise
 
         choice = response.choices[0]
         content = getattr(choice.message, "content", None)
@@ -115,4 +110,131 @@ class LLMClient:
                 choice,
             )
 
+        if content and cache is not None:
+            cache[cache_key] = content
         return content or ""
+
+    async def complete_chat_stream(
+        self,
+        messages: List[Dict[str, str]],
+        *,
+        max_tokens: int | None = None,
+        temperature: float = 0.1,
+    ) -> AsyncIterator[str]:
+        """
+        Streaming variant of complete_chat: yields text deltas as they arrive (stream=True).
+
+        Ротация ключей и backoff — как в complete_chat, но только до первого фрагмента:
+        после начала выдачи ошибка пробрасывается вызывающему. Слот LLM (семафор/TPM)
+        занят только на время открытия потока (create): чтение фрагментов зависит от скорости
+        потребителя, и держать под ним семафор нельзя. При temperature=0 полный текст кладётся в кэш
+        ответов, а попадание в кэш отдаётся одним фрагментом.
+        """
+        kwargs: Dict[str, Any] = {
+            "model": self._model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens or self._default_max_tokens,
+        }
+
+        # Сэмплированные ответы (temperature > 0) не кэшируем: повтор сообщения не должен
+        # возвращать тот же «замороженный» текст.
+        cache = get_response_cache() if temperature <= 0 else None
+        cache_key = response_cache_key(kwargs) if cache is not None else ""
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.debug("llm_cache_hit_v0_1 model=%s key=%s", self._model, cache_key)
+                yield cached
+                return
+
+        keys = await get_effective_openai_api_keys_async()
+        if not keys:
+            raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
+
+        logger.debug(
+            "llm_chat_stream_request_v0_1 model=%s payload=%s",
+            self._model,
+            LazyJson(kwargs, tail_messages=2),
+        )
+
+        last_exc: Exception | None = None
+        attempts = max(2, len(keys))
+        for attempt in range(attempts):
+            api_key = await choose_openai_api_key_async()
+            if not api_key:
+                raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
+
+            rate_limited: Exception | None = None
+            parts: List[str] = []
+            client = get_async_client(api_key, self._base_url)
+            async with llm_call_slot(messages):
+                try:
+                    stream = await client.chat.completions.create(**kwargs, stream=True)
+                except RateLimitError as exc:
+                    rate_limited = exc
+                except APIStatusError as exc:
+                    if getattr(exc, "status_code", None) != 429:
+                        raise
+                    rate_limited = exc
+                except Exception as exc:  # noqa: BLE001
+                    logger.error("LLM v0.1 stream request failed: %s", exc)
+                    raise
+
+            if rate_limited is not None:
+                # backoff — вне слота, чтобы не держать семафор во время сна.
+                last_exc = rate_limited
+                await handle_rate_limit(rate_limited, api_key=api_key, attempt=attempt, attempts=attempts)
+                continue
+
+            # Закрываем ответ и при досрочной остановке генератора (клиент /chat/stream
+            # отключился): иначе соединение держит upstream-поток до сборки мусора.
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = getattr(chunk.choices[0].delta, "content", None)
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+
+            content = "".join(parts)
+            if not content:
+                logger.warning("llm_empty_stream_v0_1 model=%s", self._model)
+            elif cache is not None:
+                cache[cache_key] = content
+            return
+
+        assert last_exc is not None
+        raise last_exc
+
+    async def complete_answer_and_summary(
+        self,
+        messages: List[Dict[str, str]],
+        *,
+        max_tokens: int | None = None,
+        temperature: float = 0.1,
+    ) -> Tuple[str, str | None]:
+        """
+        One request for both the user-facing answer and an updated dialog summary.
+
+        Возвращает (answer, summary). Если модель не вернула JSON, весь ответ считается
+        answer, а summary = None (тогда summary обновит обычный Summarizer).
+        """
+        fused = [dict(m) for m in messages]
+        if fused and fused[0].get("role") == "system":
+            fused[0]["content"] = fused[0]["content"] + _FUSED_SUMMARY_INSTRUCTIONS
+        else:
+            fused.insert(0, {"role": "system", "content": _FUSED_SUMMARY_INSTRUCTIONS.strip()})
+
+        raw = await self.complete_chat(fused, max_tokens=max_tokens, temperature=temperature)
+        data: Any = None
+        try:
+            data = json.loads(raw.strip())
+        except ValueError:
+            data = extract_json_object(raw)
+        if not isinstance(data, dict) or not str(data.get("answer") or "").strip():
+            logger.warning("llm_fused_summary_unparsed_v0_1 model=%s chars=%d", self._model, len(raw))
+            return raw, None
+        summary = str(data.get("summary") or "").strip()
+        return str(data["answer"]).strip(), summary or None
@@ -1,21 +1,65 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Dict, List, Tuple
 
+from chat_app.config import settings
+from chat_app.llm_client import LazyJson
 from chat_app.memory import BaseConversationMemory
 from chat_app.retriever import KBRetriever
 from chat_app.scenario_registry import registry as scenario_registry
-from chat_app.schemas import ChatRequest, ChatResponse, HistoryItem, MessageRole
+from chat_app.schemas import (
+    ChatRequest,
+    ChatResponse,
+    Chunk,
+    ConversationState,
+    HistoryItem,
+    MessageRole,
+    ScenarioDefinition,
+)
+from chat_app.summary_scheduler import SummaryScheduler
 from chat_app.tools.user_data import get_user_data
 
 from .llm_client_v0_1 import LLMClient
 from .prompting_v0_1 import PromptBuilder
-from .scenario_runner_v0_1 import ScenarioRunResult, ScenarioToolRunner
+from .scenario_runner_v0_1 import ScenarioRunResult, ScenarioToolRunner, apply_state_patch
+from .summarizer_v0_1 import Summarizer
 
 
 logger = logging.getLogger("chat_app.orchestrator_v0_1")
 
 
+@dataclass
+class _Turn:
+    """Everything prepared for the LLM call of one chat turn."""
+
+    state: ConversationState
+    user_item: HistoryItem
+    kb_chunks: List[Chunk]
+    messages: List[Dict[str, str]]
+    last_step_id: str | None
+
+
+def _llm_error_answer(exc: Exception) -> str:
+    msg = str(exc).lower()
+    if any(k in msg for k in ("401", "unauthorized", "invalid api key", "authentication")):
+        reason = " Причина: проблема с токеном доступа или авторизацией."
+    elif any(k in msg for k in ("429", "rate limit", "too many requests", "quota")):
+        reason = " Причина: временное превышение лимитов запросов к LLM-сервису."
+    elif any(k in msg for k in ("timeout", "timed out", "connection", "connecterror", "network")):
+        reason = " Причина: проблемы с сетевым доступом или таймаут соединения с LLM-сервисом."
+    else:
+        reason = " Причина: внутренняя ошибка на стороне LLM-сервиса."
+
+    return (
+        "Сейчас у меня не получается получить ответ от модели."
+        f"{reason} Попробуйте, пожалуйста, повторить запрос позже."
+    )
+
+
 class ChatOrchestrator:
     """
     Версия 0.1: линейный оркестратор чат-агента.
@@ -32,57 +76,144 @@ class ChatOrchestrator:
         self._scenario_runner = scenario_runner
         self._prompt_builder = PromptBuilder()
         self._llm_client = LLMClient()
+        self._summarizer = Summarizer()
+        self._summary_scheduler = SummaryScheduler(memory, self._summarizer.update_summary, tag="v0_1")
 
-    async def handle_chat(self, request: ChatRequest) -> ChatResponse:
-        state = self._memory.get_state(request.conversation_id)
-        state.message_index += 1
+    async def _prepare_turn(self, request: ChatRequest) -> _Turn:
+        # Поиск по KB не зависит от состояния диалога: стартуем сразу и ждём только там,
+        # где чанки реально нужны.
+        kb_task = asyncio.create_task(self._retriever.search(query=request.message))
+        try:
+            # Состояние и окно истории для промпта — одним чтением.
+            state, history = await self._memory.load(
+                request.conversation_id,
+                history_limit=settings.prompt_tail_messages,
+            )
+        except BaseException:
+            kb_task.cancel()
+            raise
 
+        state.message_index += 1
         if state.message_index == 1 and (not state.user_profile.name or state.user_profile.age is None):
             user_data = get_user_data()
             state.user_profile.name = user_data.name
             state.user_profile.age = user_data.age
 
-        self._memory.append_history(
+        # Сообщение пользователя буферизуется и пишется вместе с ответом и state одной транзакцией.
+        user_item = HistoryItem(role=MessageRole.USER, content=request.message)
+        history = [*history, user_item]
+
+        if state.message_index == 1:
+            kb_chunks, scenario_context, last_step_id = await self._run_scenarios(request, state, kb_task)
+        else:
+            # Сценарии v0.1 срабатывают только на первом сообщении: на остальных ходах
+            # не планируем ни одной корутины раннера.
+            kb_chunks = await kb_task
+            scenario_context, last_step_id = "", None
+
+        prompt = self._prompt_builder.build_prompt(
+            state=state,
+            history_tail=history,
+            scenario_context=scenario_context,
+            kb_chunks=kb_chunks,
+            user_message=request.message,
+        )
+        logger.debug(
+            "conversation_id=%s built_prompt_messages_v0_1=%s",
             request.conversation_id,
-            HistoryItem(role=MessageRole.USER, content=request.message),
+            LazyJson(prompt["messages"]),
+        )
+        return _Turn(
+            state=state,
+            user_item=user_item,
+            kb_chunks=kb_chunks,
+            messages=prompt["messages"],
+            last_step_id=last_step_id,
         )
 
-        kb_chunks = await self._retriever.search(query=request.message)
+    async def _run_scenarios(
+        self,
+        request: ChatRequest,
+        state: ConversationState,
+        kb_task: "asyncio.Task[List[Chunk]]",
+    ) -> Tuple[List[Chunk], str, str | None]:
+        # Сценарии независимы: запускаем параллельно, а патчи состояния и контекст
+        # собираем после gather строго в порядке реестра. Сценарии без meta.requires_kb
+        # стартуют, не дожидаясь поиска по KB. meta.apply_only_message_index в v0.1 не учитывается
+        # (как и раньше): на первом ходе запускаются все включённые сценарии.
+        scenarios = scenario_registry.enabled_snapshot()
+        turn_ts = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        user_message_lc = request.message.lower()
 
-        scenario_context_parts: list[str] = []
-        applied_scenarios: list[str] = []
-        for scenario in scenario_registry.all().values():
-            if not getattr(scenario, "enabled", True):
-                continue
-            run_result: ScenarioRunResult = await self._scenario_runner.run(
+        def _run(scenario: ScenarioDefinition, chunks: list[Chunk]) -> Awaitable[ScenarioRunResult]:
+            return self._scenario_runner.run(
                 scenario=scenario,
                 state=state,
                 user_message=request.message,
-                kb_chunks=kb_chunks,
+                kb_chunks=chunks,
+                turn_ts=turn_ts,
+                user_message_lc=user_message_lc,
+            )
+
+        early_tasks = {
+            i: asyncio.ensure_future(_run(scenario, []))
+            for i, scenario in enumerate(scenarios)
+            if not scenario.meta.get("requires_kb")
+        }
+        try:
+            kb_chunks = await kb_task
+        except BaseException:
+            for task in early_tasks.values():
+                task.cancel()
+            raise
+        run_results: list[ScenarioRunResult] = await asyncio.gather(
+            *(
+                early_tasks[i] if i in early_tasks else _run(scenario, kb_chunks)
+                for i, scenario in enumerate(scenarios)
             )
-            state = run_result.state
+        )
+
+        scenario_context_parts: list[str] = []
+        applied_scenarios: list[str] = []
+        for scenario, run_result in zip(scenarios, run_results):
+            apply_state_patch(state, run_result.state_patch)
             if run_result.context_text:
                 scenario_context_parts.append(run_result.context_text)
                 applied_scenarios.append(scenario.name)
 
         scenario_context = "\n\n".join(scenario_context_parts)
         last_step_id = ", ".join(applied_scenarios) if applied_scenarios else None
+        return kb_chunks, scenario_context, last_step_id
 
-        history = self._memory.get_history(request.conversation_id).history
-        prompt = self._prompt_builder.build_prompt(
-            state=state,
-            history_tail=history,
-            scenario_context=scenario_context,
-            kb_chunks=kb_chunks,
-            user_message=request.message,
-        )
-        logger.info(
-            "conversation_id=%s built_prompt_messages_v0_1=%s",
-            request.conversation_id,
-            prompt["messages"],
+    async def _finish_turn(
+        self,
+        request: ChatRequest,
+        turn: _Turn,
+        answer_text: str,
+        fused_summary: str | None = None,
+    ) -> None:
+        state = turn.state
+        if fused_summary:
+            # Summary уже учитывает этот ход: +2 — сообщения пользователя и ассистента, которые сейчас допишем.
+            state.summary = fused_summary
+            state.last_summary_history_len = await self._memory.get_history_len(request.conversation_id) + 2
+
+        await self._memory.save_state_and_append(
+            state,
+            turn.user_item,
+            HistoryItem(role=MessageRole.ASSISTANT, content=answer_text),
         )
+        # Summary пересчитывается вне пути ответа (если история выросла на SUMMARY_DELTA_THRESHOLD).
+        self._summary_scheduler.schedule(request.conversation_id)
+
+    async def handle_chat(self, request: ChatRequest) -> ChatResponse:
+        turn = await self._prepare_turn(request)
+        fused_summary: str | None = None
         try:
-            answer_text = await self._llm_client.complete_chat(prompt["messages"])
+            if settings.fused_summary:
+                answer_text, fused_summary = await self._llm_client.complete_answer_and_summary(turn.messages)
+            else:
+                answer_text = await self._llm_client.complete_chat(turn.messages)
             logger.info(
                 "conversation_id=%s llm_answer_preview_v0_1=%r",
                 request.conversation_id,
@@ -94,30 +225,51 @@ class ChatOrchestrator:
                 request.conversation_id,
                 exc,
             )
-            msg = str(exc).lower()
-            if any(k in msg for k in ("401", "unauthorized", "invalid api key", "authentication")):
-                reason = " Причина: проблема с токеном доступа или авторизацией."
-            elif any(k in msg for k in ("429", "rate limit", "too many requests", "quota")):
-                reason = " Причина: временное превышение лимитов запросов к LLM-сервису."
-            elif any(k in msg for k in ("timeout", "timed out", "connection", "connecterror", "network")):
-                reason = " Причина: проблемы с сетевым доступом или таймаут соединения с LLM-сервисом."
-            else:
-                reason = " Причина: внутренняя ошибка на стороне LLM-сервиса."
+            answer_text = _llm_error_answer(exc)
 
-            answer_text = (
-                "Сейчас у меня не получается получить ответ от модели."
-                f"{reason} Попробуйте, пожалуйста, повторить запрос позже."
-            )
-
-        self._memory.append_history(
-            request.conversation_id,
-            HistoryItem(role=MessageRole.ASSISTANT, content=answer_text),
-        )
-        self._memory.save_state(state)
+        await self._finish_turn(request, turn, answer_text, fused_summary)
 
         return ChatResponse(
             conversation_id=request.conversation_id,
             answer=answer_text,
-            chunks=kb_chunks,
-            last_step_scenario=last_step_id,
+            chunks=turn.kb_chunks,
+            last_step_scenario=turn.last_step_id,
+        )
+
+    async def handle_chat_stream(self, request: ChatRequest) -> AsyncIterator[str]:
+        """
+        Same turn as handle_chat, but returns an iterator of answer text deltas.
+
+        Подготовка хода (state, KB, сценарии, prompt) выполняется до возврата итератора,
+        то есть до отправки заголовков ответа: её ошибки отдаются обычным HTTP-статусом.
+        История и state пишутся после последнего фрагмента (при обрыве клиентом ход не
+        сохраняется). FUSED_SUMMARY здесь не применяется: JSON-ответ нельзя отдавать потоком.
+        """
+        turn = await self._prepare_turn(request)
+        return self._stream_turn(request, turn)
+
+    async def _stream_turn(self, request: ChatRequest, turn: _Turn) -> AsyncIterator[str]:
+        parts: List[str] = []
+        try:
+            async for delta in self._llm_client.complete_chat_stream(turn.messages):
+                parts.append(delta)
+                yield delta
+        except Exception as exc:  # noqa: BLE001
+            logger.error(
+                "conversation_id=%s llm_stream_failed_v0_1 error=%r chars_sent=%d",
+                request.conversation_id,
+                exc,
+                sum(len(p) for p in parts),
+            )
+            if not parts:
+                fallback = _llm_error_answer(exc)
+                parts.append(fallback)
+                yield fallback
+
+        answer_text = "".join(parts)
+        logger.info(
+            "conversation_id=%s llm_answer_preview_v0_1=%r",
+            request.conversation_id,
+            answer_text[:200],
         )
+        await self._finish_turn(request, turn, answer_text)
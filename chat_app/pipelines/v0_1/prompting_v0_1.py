@@ -4,7 +4,8 @@ from typing import Any, Dict, List
 
 import logging
 
-from chat_app.schemas import Chunk, ConversationState, HistoryItem
+from chat_app.config import settings
+from chat_app.schemas import Chunk, ConversationState, HistoryItem, MessageRole
 
 
 logger = logging.getLogger("chat_app.prompting_v0_1")
@@ -29,7 +30,13 @@ class PromptBuilder:
 
         dialog_summary = state.summary or ""
 
-        tail_items = history_tail[-3:] if history_tail else []
+        # Скользящее окно последних сообщений; более ранний контекст покрывает dialog_summary.
+        # Текущее сообщение уже есть в new_user_message — в dialog_tail его не дублируем.
+        tail_items = list(history_tail or [])
+        if tail_items and tail_items[-1].role == MessageRole.USER and tail_items[-1].content == user_message:
+            tail_items = tail_items[:-1]
+        window = settings.prompt_tail_messages
+        tail_items = tail_items[-window:] if window else []
         dialog_tail_lines: List[str] = []
         for item in tail_items:
             dialog_tail_lines.append(f"  - role: {item.role.value}\n    content: {item.content!r}")
@@ -107,7 +114,7 @@ class PromptBuilder:
 
         yaml_prompt = "\n".join(yaml_parts)
 
-        logger.info("built_yaml_prompt_v0_1:\n%s", yaml_prompt)
+        logger.debug("built_yaml_prompt_v0_1:\n%s", yaml_prompt)
 
         messages: List[Dict[str, str]] = [
             {"role": "system", "content": yaml_prompt},
@@ -1,19 +1,130 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
 
+import functools
+import io
 import re
 
 from chat_app.schemas import Chunk, ConversationState, ScenarioDefinition, ScenarioNode
 
 
+_TEMPLATE_RE = re.compile(r"\{=([^=]+)=\}")
+
+# Триггеры сценария "день рождения": одна регулярка вместо цикла подстрочных поисков.
+_BIRTHDAY_TRIGGERS = (
+    "день рождения",
+    "днём рождения",
+    "с днем рождения",
+    "с днём рождения",
+    "днюха",
+    "днюху",
+    "у меня др",
+    "мой др",
+    "сегодня др",
+    "сегодня день рождения",
+    " др ",
+    " др.",
+    " др,",
+    "др ",
+    "др.",
+    "др,",
+    "др?",
+    "годиков",
+    "исполнилось",
+    "исполнится",
+)
+_BIRTHDAY_RE = re.compile("|".join(re.escape(t) for t in _BIRTHDAY_TRIGGERS))
+
+_SPECIAL_INSTRUCTIONS = (
+    "special_instructions описывает дополнительные сценарные указания.\n"
+    "- blocks: список обязательных текстов-инструкций, которые нужно учитывать при формировании ответа.\n"
+    "- blocks_with_conditions: список условных блоков. Для КАЖДОГО такого блока действуй так:\n"
+    "  1. Смотри на pair condition.description и condition.user_message. user_message — это последнее сообщение пользователя.\n"
+    "  2. Сначала реши, относится ли user_message по смыслу к теме из condition.description.\n"
+    "     - Если НЕ относится, полностью игнорируй этот блок и НЕ используй ни when_true, ни when_false.\n"
+    "  3. Если сообщение относится к той же теме:\n"
+    "     - Считай условие ИСТИННЫМ, только если из user_message явно следует, что описанная ситуация выполняется\n"
+    '       (например: "сегодня у меня день рождения").\n'
+    "     - Считай условие ЛОЖНЫМ, только если из user_message явно следует, что описанная ситуация НЕ выполняется,\n"
+    '       но тема та же (например: "день рождения был на прошлой неделе" или "мой день рождения в августе").\n'
+    "  4. Если из user_message нельзя однозначно понять, выполняется условие или нет,\n"
+    "     лучше полностью игнорировать этот блок и НЕ использовать when_false.\n"
+    "  5. Если условие ИСТИННО — учитывай в ответе только тексты из when_true.texts.\n"
+    "     Если условие ЛОЖНО — учитывай в ответе только тексты из when_false.texts.\n"
+    "  6. Не делай логических выводов сверх явно заданных текстов; просто выбирай между when_true,\n"
+    "     when_false или полным игнорированием блока.\n"
+)
+# Блок instructions не зависит от сценария — отступы проставляем один раз.
+_SPECIAL_INSTRUCTIONS_BLOCK = "".join(f"  {line}\n" for line in _SPECIAL_INSTRUCTIONS.splitlines())
+
+
+# {=dialog.<key>=}: поле состояния по ключу (один поиск в dict вместо цепочки сравнений).
+_DIALOG_ACCESSORS: Dict[str, Callable[[ConversationState], Any]] = {
+    "name": lambda state: state.user_profile.name,
+    "age": lambda state: state.user_profile.age,
+    "message_index": lambda state: state.message_index,
+}
+
+
+def _replace_match(
+    match: re.Match[str],
+    *,
+    state: ConversationState,
+    tools_results: Dict[str, Dict[str, Any]],
+) -> str:
+    """Value for a single {=...=} placeholder; unknown expressions render as "finderror"."""
+    expr = match.group(1).strip()
+    if expr.startswith("@"):
+        inner = expr[1:]
+        parts = inner.split(".")
+        if not parts:
+            return "finderror"
+        tool_name = parts[0]
+        field = parts[1] if len(parts) > 1 else None
+        tool_data = tools_results.get(tool_name) or {}
+        if field is None:
+            value = tool_data or None
+        else:
+            value = tool_data.get(field)
+        return str(value) if value is not None else "finderror"
+
+    if expr.startswith("dialog."):
+        accessor = _DIALOG_ACCESSORS.get(expr[len("dialog.") :])
+        if accessor is None:
+            return "finderror"
+        try:
+            value = accessor(state)
+            return str(value) if value is not None else "finderror"
+        except Exception:  # noqa: BLE001
+            return "finderror"
+
+    return "finderror"
+
+
 @dataclass
 class ScenarioRunResult:
     context_text: str
     last_step_id: Optional[str]
-    state: ConversationState
+    # Изменения состояния, которые сценарий хочет внести. Раннер сам state не мутирует:
+    # сценарии выполняются параллельно, патчи применяются оркестратором по порядку.
+    state_patch: Dict[str, Any] = field(default_factory=dict)
+
+
+def apply_state_patch(state: ConversationState, patch: Dict[str, Any]) -> None:
+    """
+    Applies a ScenarioRunResult.state_patch to the conversation state in place.
+
+    scenario_runs дописывается (патчи нескольких сценариев одного хода не затирают друг друга),
+    остальные ключи — обычное присваивание поля.
+    """
+    for key, value in patch.items():
+        if key == "scenario_runs":
+            state.scenario_runs.extend(value)
+        else:
+            setattr(state, key, value)
 
 
 class ScenarioToolRunner:
@@ -30,54 +141,21 @@ class ScenarioToolRunner:
         state: ConversationState,
         tools_results: Dict[str, Dict[str, Any]],
     ) -> str:
-        pattern = re.compile(r"\{=([^=]+)=\}")
-
-        def replace(match: re.Match[str]) -> str:
-            expr = match.group(1).strip()
-            if expr.startswith("@"):
-                inner = expr[1:]
-                parts = inner.split(".")
-                if not parts:
-                    return "finderror"
-                tool_name = parts[0]
-                field = parts[1] if len(parts) > 1 else None
-                tool_data = tools_results.get(tool_name) or {}
-                if field is None:
-                    value = tool_data or None
-                else:
-                    value = tool_data.get(field)
-                return str(value) if value is not None else "finderror"
-
-            if expr.startswith("dialog."):
-                key = expr[len("dialog.") :]
-                try:
-                    if key == "name":
-                        value = state.user_profile.name
-                    elif key == "age":
-                        value = state.user_profile.age
-                    elif key == "message_index":
-                        value = state.message_index
-                    else:
-                        value = None
-                    return str(value) if value is not None else "finderror"
-                except Exception:  # noqa: BLE001
-                    return "finderror"
-
-            return "finderror"
-
-        return pattern.sub(replace, text)
-
-    def _sort_key(self, node: ScenarioNode) -> List[int]:
-        parts: List[int] = []
-        for part in node.id.split("."):
-            try:
-                parts.append(int(part))
-            except ValueError:
-                parts.append(0)
-        return parts
-
-    def _indent_block(self, text: str, prefix: str) -> str:
-        return "\n".join(prefix + line if line else prefix for line in text.splitlines())
+        if "{=" not in text:
+            return text
+        return _TEMPLATE_RE.sub(functools.partial(_replace_match, state=state, tools_results=tools_results), text)
+
+    @staticmethod
+    def _write_indented(buf: io.StringIO, text: str, prefix: str) -> None:
+        # Каждая строка text с отступом prefix; блок завершается переводом строки.
+        lines = text.splitlines()
+        if not lines:
+            buf.write("\n")
+            return
+        for line in lines:
+            buf.write(prefix)
+            buf.write(line)
+            buf.write("\n")
 
     async def run(
         self,
@@ -85,45 +163,31 @@ class ScenarioToolRunner:
         state: ConversationState,
         user_message: str,
         kb_chunks: List[Chunk],
+        turn_ts: str | None = None,
+        user_message_lc: str | None = None,
     ) -> ScenarioRunResult:
+        """
+        turn_ts — общая для хода метка времени (ISO, UTC), чтобы не вычислять её в каждом сценарии.
+        user_message_lc — user_message в нижнем регистре, посчитанный оркестратором один раз на ход.
+        """
         _ = kb_chunks
 
         if state.message_index != 1:
-            return ScenarioRunResult(context_text="", last_step_id=None, state=state)
+            return ScenarioRunResult(context_text="", last_step_id=None)
 
         scenario_name = (scenario.name or "").lower()
         if "дню рожд" in scenario_name or "день рожд" in scenario_name:
-            text = user_message.lower()
-            birthday_triggers = [
-                "день рождения",
-                "днём рождения",
-                "с днем рождения",
-                "с днём рождения",
-                "днюха",
-                "днюху",
-                "у меня др",
-                "мой др",
-                "сегодня др",
-                "сегодня день рождения",
-                " др ",
-                " др.",
-                " др,",
-                "др ",
-                "др.",
-                "др,",
-                "др?",
-                "годиков",
-                "исполнилось",
-                "исполнится",
-            ]
-            if not any(trigger in text for trigger in birthday_triggers):
-                return ScenarioRunResult(context_text="", last_step_id=None, state=state)
+            if user_message_lc is None:
+                user_message_lc = user_message.lower()
+            if not _BIRTHDAY_RE.search(user_message_lc):
+                return ScenarioRunResult(context_text="", last_step_id=None)
 
         tools_results: Dict[str, Dict[str, Any]] = {}
         text_blocks: List[str] = []
         conditional_blocks: List[Dict[str, Any]] = []
 
-        nodes = sorted(scenario.code, key=self._sort_key)
+        # Узлы отсортированы один раз при регистрации сценария.
+        nodes = scenario.sorted_code
 
         def ensure_tool_data(tool_name: str) -> None:
             if tool_name in tools_results:
@@ -192,71 +256,53 @@ class ScenarioToolRunner:
                 continue
 
         if not text_blocks and not conditional_blocks:
-            return ScenarioRunResult(context_text="", last_step_id=None, state=state)
-
-        instructions = (
-            "special_instructions описывает дополнительные сценарные указания.\n"
-            "- blocks: список обязательных текстов-инструкций, которые нужно учитывать при формировании ответа.\n"
-            "- blocks_with_conditions: список условных блоков. Для КАЖДОГО такого блока действуй так:\n"
-            "  1. Смотри на pair condition.description и condition.user_message. user_message — это последнее сообщение пользователя.\n"
-            "  2. Сначала реши, относится ли user_message по смыслу к теме из condition.description.\n"
-            "     - Если НЕ относится, полностью игнорируй этот блок и НЕ используй ни when_true, ни when_false.\n"
-            "  3. Если сообщение относится к той же теме:\n"
-            "     - Считай условие ИСТИННЫМ, только если из user_message явно следует, что описанная ситуация выполняется\n"
-            '       (например: "сегодня у меня день рождения").\n'
-            "     - Считай условие ЛОЖНЫМ, только если из user_message явно следует, что описанная ситуация НЕ выполняется,\n"
-            '       но тема та же (например: "день рождения был на прошлой неделе" или "мой день рождения в августе").\n'
-            "  4. Если из user_message нельзя однозначно понять, выполняется условие или нет,\n"
-            "     лучше полностью игнорировать этот блок и НЕ использовать when_false.\n"
-            "  5. Если условие ИСТИННО — учитывай в ответе только тексты из when_true.texts.\n"
-            "     Если условие ЛОЖНО — учитывай в ответе только тексты из when_false.texts.\n"
-            "  6. Не делай логических выводов сверх явно заданных текстов; просто выбирай между when_true,\n"
-            "     when_false или полным игнорированием блока.\n"
-        )
+            return ScenarioRunResult(context_text="", last_step_id=None)
 
-        lines: List[str] = []
-        lines.append("instructions: |")
-        lines.append(self._indent_block(instructions, "  "))
+        buf = io.StringIO()
+        buf.write("instructions: |\n")
+        buf.write(_SPECIAL_INSTRUCTIONS_BLOCK)
 
         if text_blocks:
-            lines.append("blocks:")
+            buf.write("blocks:\n")
             for txt in text_blocks:
-                lines.append("  - text: |")
-                lines.append(self._indent_block(txt, "      "))
+                buf.write("  - text: |\n")
+                self._write_indented(buf, txt, "      ")
 
         if conditional_blocks:
-            lines.append("blocks_with_conditions:")
+            buf.write("blocks_with_conditions:\n")
             for cond in conditional_blocks:
-                lines.append("  - condition:")
-                lines.append(f'      description: "{cond["condition"]["description"]}"')
-                lines.append(f'      user_message: "{cond["condition"]["user_message"]}"')
-                lines.append("    when_true:")
-                lines.append("      texts:")
+                buf.write("  - condition:\n")
+                buf.write(f'      description: "{cond["condition"]["description"]}"\n')
+                buf.write(f'      user_message: "{cond["condition"]["user_message"]}"\n')
+                buf.write("    when_true:\n      texts:\n")
                 if cond["when_true"]["texts"]:
                     for txt in cond["when_true"]["texts"]:
-                        lines.append(f'        - "{txt}"')
+                        buf.write(f'        - "{txt}"\n')
                 else:
-                    lines.append("        # нет текстов для ветки when_true")
-                lines.append("    when_false:")
-                lines.append("      texts:")
+                    buf.write("        # нет текстов для ветки when_true\n")
+                buf.write("    when_false:\n      texts:\n")
                 if cond["when_false"]["texts"]:
                     for txt in cond["when_false"]["texts"]:
-                        lines.append(f'        - "{txt}"')
+                        buf.write(f'        - "{txt}"\n')
                 else:
-                    lines.append("        # нет текстов для ветки when_false")
+                    buf.write("        # нет текстов для ветки when_false\n")
 
-        context_text = "\n".join(lines)
+        # Каждая строка записана с "\n"; последний перевод строки не нужен.
+        context_text = buf.getvalue()[:-1]
 
-        try:
-            state.scenario_runs.append(
+        state_patch = {
+            "scenario_runs": [
                 {
                     "name": scenario.name,
                     "at_message_index": state.message_index,
                     "executed": True,
-                    "ts": datetime.utcnow().isoformat(),
+                    "ts": turn_ts or datetime.now(timezone.utc).isoformat(timespec="seconds"),
                 }
-            )
-        except Exception:  # noqa: BLE001
-            pass
+            ]
+        }
 
-        return ScenarioRunResult(context_text=context_text, last_step_id=None, state=state)
+        return ScenarioRunResult(
+            context_text=context_text,
+            last_step_id=None,
+            state_patch=state_patch,
+        )
@@ -4,23 +4,35 @@ from typing import List
 
 import logging
 
+from chat_app.config import settings
 from chat_app.memory import BaseConversationMemory
-from chat_app.schemas import HistoryItem, MessageRole
+from chat_app.schemas import MessageRole
 
 from .llm_client_v0_1 import LLMClient
 
 
 logger = logging.getLogger("chat_app.summarizer_v0_1")
 
+_SUMMARY_SYSTEM = (
+    "Ты помогаешь составлять краткое резюме диалога поддержки. "
+    "На основе истории сообщений между пользователем (user) и агентом (assistant) "
+    "сделай сжатое повествовательное резюме на русском в 1–3 предложениях. "
+    "Пиши в форме: «Вы спрашивали ..., я объяснил ...». "
+    "Не используй формат «Пользователь: ...», «Агент: ...» и не перечисляй все сообщения. "
+    "Не добавляй никаких пояснений про то, что это резюме — просто сам текст резюме."
+)
+
 
 class Summarizer:
     """
     Версия 0.1: суммаризатор истории диалога через тот же LLM.
     """
 
+    def __init__(self) -> None:
+        self._llm = LLMClient()
+
     async def update_summary(self, memory: BaseConversationMemory, conversation_id: str) -> None:
-        history_response = memory.get_history(conversation_id)
-        items: List[HistoryItem] = history_response.history
+        items, history_len = await memory.get_history_tail(conversation_id, settings.history_tail_limit)
 
         logger.info(
             "update_summary_start_v0_1 conversation_id=%s history_len=%d",
@@ -43,33 +55,22 @@ class Summarizer:
         dialog_text = "\n".join(dialog_lines)
 
         messages = [
-            {
-                "role": "system",
-                "content": (
-                    "Ты помогаешь составлять краткое резюме диалога поддержки. "
-                    "На основе истории сообщений между пользователем (user) и агентом (assistant) "
-                    "сделай сжатое повествовательное резюме на русском в 1–3 предложениях. "
-                    "Пиши в форме: «Вы спрашивали ..., я объяснил ...». "
-                    "Не используй формат «Пользователь: ...», «Агент: ...» и не перечисляй все сообщения. "
-                    "Не добавляй никаких пояснений про то, что это резюме — просто сам текст резюме."
-                ),
-            },
+            {"role": "system", "content": _SUMMARY_SYSTEM},
             {
                 "role": "user",
                 "content": f"История диалога:\n{dialog_text}",
             },
         ]
 
-        logger.info(
+        logger.debug(
             "update_summary_llm_request_v0_1 conversation_id=%s system=%r user=%r",
             conversation_id,
             messages[0]["content"],
             messages[1]["content"],
         )
 
-        llm = LLMClient()
         try:
-            summary_text = await llm.complete_chat(messages, temperature=0.1)
+            summary_text = await self._llm.complete_chat(messages, max_tokens=512, temperature=0.1)
         except Exception as exc:  # noqa: BLE001
             logger.error(
                 "update_summary_failed_v0_1 conversation_id=%s error=%r",
@@ -85,7 +86,8 @@ class Summarizer:
             summary_text,
         )
 
-        state = memory.get_state(conversation_id)
+        state = await memory.get_state(conversation_id)
         state.summary = summary_text
-        memory.save_state(state)
+        state.last_summary_history_len = history_len
+        await memory.save_state(state)
 
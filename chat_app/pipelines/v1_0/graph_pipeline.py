@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import json
 import logging
 import re
 from typing import Any, Dict, List
@@ -10,24 +9,151 @@ from langgraph.graph import END, StateGraph
 from chat_app.config import settings
 from chat_app.memory import BaseConversationMemory
 from chat_app.retriever import KBRetriever
-from chat_app.schemas import ChatRequest, ChatResponse, HistoryItem, MessageRole
+from chat_app.schemas import ChatRequest, ChatResponse, ConversationState, HistoryItem, MessageRole
 from chat_app.scenario_registry import ScenarioRegistry
-from .graph_state import AgentState, InstructionBlock, JudgeDecision, ToolsContext
-from .prompt_builder_v1 import PromptBuilderV1
+from chat_app.summary_scheduler import SummaryScheduler
+from .graph_state import (
+    AgentState,
+    InstructionBlockGroups,
+    JudgeContext,
+    JudgeDecision,
+    ToolsContext,
+    group_instruction_blocks,
+)
+from .prompt_builder_v1 import PromptBuilderV1, kb_context_text
 from .subgraphs.tools_subgraph import build_tools_subgraph
 from .summarizer_v1_0 import Summarizer
 from .tool_registry import ToolRegistry
 from chat_app.tools.registry import build_tool_function_map
 
-import anyio
-from openai import OpenAI
-from openai import APIStatusError, RateLimitError
-from chat_app.runtime_config import get_effective_openai_api_key
-from chat_app.runtime_config import get_effective_openai_api_keys, mark_openai_api_key_rate_limited
+from chat_app.llm_client import (
+    LazyJson,
+    chat_json_completion,
+    create_chat_completion,
+    get_response_cache,
+    response_cache_key,
+)
 
 
 logger = logging.getLogger("chat_app.graph_pipeline_v1_0")
 
+# Неизменяемые system-промпты judge/revise идут первым сообщением, данные хода — после них:
+# одинаковый префикс запроса позволяет провайдеру переиспользовать prompt cache.
+_JUDGE_SYSTEM_STATIC = (
+    "Ты — строгий, но не занудный редактор ответа службы поддержки.\n"
+    "Твоя задача: решить, нужно ли править ответ ассистента. Не переписывай без необходимости.\n"
+    "Проверяй два типа проблем:\n"
+    "1) фактологические: ответ не должен утверждать то, чего нет в context/tools_context;\n"
+    "2) сценарные: ответ должен соблюдать rules и не применять ветки без оснований.\n"
+    "Также проверь стиль:\n"
+    "- Запрещены эмодзи/смайлики.\n"
+    "- Запрещены обещания будущих действий/обновлений/уведомлений (например: «мы обязательно сообщим», «передали разработчикам», «в следующем обновлении»), если этого нет в context.\n"
+    "Если правка нужна — верни JSON строго формата:\n"
+    '{"action":"revise","reasons":["..."],"patch_instructions":"..."}\n'
+    "Если правка не нужна — верни JSON:\n"
+    '{"action":"pass","reasons":["ok"],"patch_instructions":""}\n'
+    "Ограничение: не предлагай более 1-2 точечных правок. Без фанатизма.\n"
+)
+_REVISE_SYSTEM_STATIC = (
+    "Ты правишь ответ службы поддержки строго по инструкциям редактора.\n"
+    "Не добавляй новых фактов, которых нет в исходном ответе или в context (если он передан).\n"
+    "Сделай минимальные правки.\n"
+    "Верни только финальный текст ответа, без списков изменений и без пояснений.\n"
+    "Нельзя удалять обязательные требования из must_keep, если они не противоречат context.\n"
+    "Не используй эмодзи/смайлики; если они есть в исходном тексте — убери.\n"
+    "Не добавляй обещания будущих действий/обновлений/уведомлений, если этого нет в context.\n"
+)
+# JUDGE_INLINE_REVISE: решение и правка одним запросом; статичный префикс по-прежнему первый.
+_JUDGE_SYSTEM_INLINE_REVISE = _JUDGE_SYSTEM_STATIC + (
+    "В ответе всегда есть ещё поле revised_answer.\n"
+    "При action=revise revised_answer — черновик, исправленный по твоим patch_instructions минимальными правками:\n"
+    "без новых фактов вне context, без эмодзи и обещаний будущих действий, с сохранением требований\n"
+    "из required_instructions_summary. Только финальный текст ответа, без пояснений.\n"
+    'При action=pass revised_answer — пустая строка "".\n'
+)
+_JUDGE_INLINE_REVISE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["action", "reasons", "patch_instructions", "revised_answer"],
+    "properties": {
+        "action": {"type": "string", "enum": ["pass", "revise"]},
+        "reasons": {"type": "array", "items": {"type": "string"}},
+        "patch_instructions": {"type": "string"},
+        "revised_answer": {"type": "string"},
+    },
+}
+# Revise получает facts/context, только если инструкции редактора ссылаются на факты или
+# источники; для правок формы (тон, длина, эмодзи) хватает исходного ответа и must_keep.
+_REVISE_NEEDS_CONTEXT_RE = re.compile(r"факт|контекст|context|баз[аеуы] знаний|источник|фрагмент|данны", re.IGNORECASE)
+_JUDGE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["action", "reasons", "patch_instructions"],
+    "properties": {
+        "action": {"type": "string", "enum": ["pass", "revise"]},
+        "reasons": {"type": "array", "items": {"type": "string"}},
+        "patch_instructions": {"type": "string"},
+    },
+}
+
+
+def _judge_context(
+    tools_context: ToolsContext,
+    groups: InstructionBlockGroups,
+    conv_state: ConversationState,
+    context_text: str,
+) -> JudgeContext:
+    """Sections shared by the judge and revise prompts (facts, rules, required instructions, KB context)."""
+    facts_lines: List[str] = []
+    if conv_state.user_profile.name:
+        facts_lines.append(f"- user_profile.name: {conv_state.user_profile.name}")
+    if conv_state.user_profile.age is not None:
+        facts_lines.append(f"- user_profile.age: {conv_state.user_profile.age}")
+    tc_facts = tools_context.get("facts") or {}
+    if "tool:get_user_data" in tc_facts:
+        data = tc_facts.get("tool:get_user_data") or {}
+        safe = {k: data.get(k) for k in ("name", "age") if k in data}
+        facts_lines.append(f"- tool:get_user_data: {safe}")
+
+    rules = [f"- {b.text}" for b in groups.judge_rules]
+    required = [f"- {b.text}" for b in groups.agent_required]
+
+    return {
+        "context_text": context_text,
+        "rules_text": "\n".join(rules).strip(),
+        "facts_text": "\n".join(facts_lines).strip() if facts_lines else "- (нет)\n",
+        # judge видит до 50 обязательных инструкций, revise (must_keep) — до 12.
+        "required_text": "\n".join(required[:50]).strip() or "- (нет)\n",
+        "must_keep_text": "\n".join(required[:12]).strip() or "- (нет)\n",
+    }
+
+
+# SELF_JUDGE: дописывается к system-промпту генерации; judge_rules подставляются из сценариев.
+_SELF_JUDGE_INSTRUCTIONS = (
+    "\n\nФормат ответа: верни СТРОГО JSON {{\"answer\": \"...\", \"self_check\": {{\"action\": \"pass|revise\", \"reasons\": [\"...\"]}}}}.\n"
+    "answer — ответ пользователю по всем правилам выше.\n"
+    "self_check — честная проверка answer: action=revise, если answer утверждает то, чего нет в контексте,\n"
+    "нарушает правила ниже, содержит эмодзи или обещания будущих действий, которых нет в контексте; иначе pass.\n"
+    "Правила:\n{rules}\n"
+)
+_SELF_JUDGE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["answer", "self_check"],
+    "properties": {
+        "answer": {"type": "string"},
+        "self_check": {
+            "type": "object",
+            "additionalProperties": False,
+            "required": ["action", "reasons"],
+            "properties": {
+                "action": {"type": "string", "enum": ["pass", "revise"]},
+                "reasons": {"type": "array", "items": {"type": "string"}},
+            },
+        },
+    },
+}
+
 
 class _OpenRouterClient:
     def __init__(self) -> None:
@@ -40,57 +166,25 @@ class _OpenRouterClient:
         temperature: float = 0.1,
         model: str | None = None,
         response_format: Dict[str, Any] | None = None,
+        max_tokens: int | None = None,
     ) -> str:
-        keys = get_effective_openai_api_keys()
-        if not keys:
-            raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
-
         payload: Dict[str, Any] = {
             "model": model or self._model,
             "messages": messages,
             "temperature": temperature,
+            "max_tokens": max_tokens or settings.llm_max_output_tokens,
         }
         if response_format is not None:
             payload["response_format"] = response_format
-        try:
-            logger.info("llm_request_v1_0 payload=%s", json.dumps(payload, ensure_ascii=False))
-        except Exception:  # noqa: BLE001
-            logger.info("llm_request_v1_0 payload=<unserializable>")
-
-        last_exc: Exception | None = None
-        for _attempt in range(max(1, len(keys))):
-            def _call() -> Any:
-                api_key = get_effective_openai_api_key()
-                if not api_key:
-                    raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
-                client = OpenAI(api_key=api_key, base_url=settings.llm_base_url)
-                return client.chat.completions.create(**payload)
-
-            try:
-                response = await anyio.to_thread.run_sync(_call)
-                break
-            except RateLimitError as exc:
-                last_exc = exc
-                mark_openai_api_key_rate_limited()
-                continue
-            except APIStatusError as exc:
-                last_exc = exc
-                if getattr(exc, "status_code", None) == 429:
-                    mark_openai_api_key_rate_limited()
-                    continue
-                raise
-        else:
-            assert last_exc is not None
-            raise last_exc
+        # Payload сериализуется только при включённом DEBUG (и без середины длинной истории).
+        logger.debug("llm_request_v1_0 payload=%s", LazyJson(payload, tail_messages=2))
+
+        response = await create_chat_completion(payload)
 
         choice = response.choices[0]
         content = getattr(choice.message, "content", "") or ""
-        logger.info(
-            "llm_response_v1_0 model=%s chars=%d content=%s",
-            model or self._model,
-            len(content),
-            content,
-        )
+        logger.info("llm_response_v1_0 model=%s chars=%d", model or self._model, len(content))
+        logger.debug("llm_response_v1_0_content content=%s", content)
         return content
 
     async def chat_json(
@@ -102,38 +196,18 @@ class _OpenRouterClient:
         temperature: float = 0.0,
         model: str | None = None,
     ) -> Dict[str, Any]:
-        rf_schema = {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}
-        try:
-            raw = await self.chat(
-                messages,
-                temperature=temperature,
-                model=model,
-                response_format=rf_schema,
-            )
-            return json.loads((raw or "").strip())
-        except Exception:  # noqa: BLE001
-            pass
-
-        try:
-            raw = await self.chat(
+        model = model or self._model
+        return await chat_json_completion(
+            lambda response_format: self.chat(
                 messages,
                 temperature=temperature,
                 model=model,
-                response_format={"type": "json_object"},
-            )
-            return json.loads((raw or "").strip())
-        except Exception:  # noqa: BLE001
-            raw = await self.chat(messages, temperature=temperature, model=model)
-
-        # Best-effort fallback: extract first JSON object.
-        text = (raw or "").strip()
-        match = re.search(r"\{.*\}", text, flags=re.DOTALL)
-        if not match:
-            return {}
-        try:
-            return json.loads(match.group(0))
-        except Exception:  # noqa: BLE001
-            return {}
+                response_format=response_format,
+            ),
+            model=model,
+            schema=schema,
+            name=name,
+        )
 
 
 class GraphChatPipelineV10:
@@ -150,6 +224,7 @@ class GraphChatPipelineV10:
 
         self._client = _OpenRouterClient()
         self._summarizer = Summarizer()
+        self._summary_scheduler = SummaryScheduler(memory, self._summarizer.update_summary, tag="v1_0")
 
         tools = ToolRegistry()
         for name, func in build_tool_function_map().items():
@@ -172,6 +247,8 @@ class GraphChatPipelineV10:
                 temperature=0.0,
                 model=settings.condition_model,
             ),
+            batch_conditions=settings.conditions_batch,
+            batch_summaries=settings.scenario_imperatives_batch,
         )
         self._graph = self._build_graph()
 
@@ -185,35 +262,36 @@ class GraphChatPipelineV10:
         graph = StateGraph(AgentState)
 
         async def load_state(state: AgentState) -> Dict:
-            conv_state = self._memory.get_state(state["conversation_id"])
-            history = self._memory.get_history(state["conversation_id"]).history
-            return {
-                "conv_state": conv_state,
-                "history": history,
-                "judge_attempts": 0,
-                "tools_context": {
-                    "facts": {},
-                    "instruction_blocks": [],
-                    "applied": [],
-                },
-            }
+            conv_state, history = await self._memory.load(
+                state["conversation_id"],
+                history_limit=settings.history_tail_limit,
+            )
+            # judge_attempts и tools_context не инициализируем: счётчик читается как
+            # int(... or 0), а tools_context целиком пишет tools_subgraph (читатели — через "or {}").
+            return {"conv_state": conv_state, "history": history}
 
         async def append_user(state: AgentState) -> Dict:
             conv_state = state["conv_state"]
             conv_state.message_index += 1
-            self._memory.append_history(
-                state["conversation_id"],
-                HistoryItem(role=MessageRole.USER, content=state["user_message"]),
-            )
-            history = self._memory.get_history(state["conversation_id"]).history
-            return {"conv_state": conv_state, "history": history}
+            # Без записи в Redis: сообщение попадёт в историю вместе с ответом (persist_answer).
+            user_item = HistoryItem(role=MessageRole.USER, content=state["user_message"])
+            history = [*(state.get("history") or []), user_item][-settings.history_tail_limit :]
+            return {"conv_state": conv_state, "history": history, "pending_history": [user_item]}
 
         async def retrieval(state: AgentState) -> Dict:
             kb_chunks = await self._retriever.search(query=state["user_message"])
             return {"kb_chunks": kb_chunks}
 
         async def tools_subgraph_node(state: AgentState) -> Dict:
-            out = await self._tools_subgraph.ainvoke(state)
+            # Выполняется параллельно с retrieval: подграфу нужны только сообщение и состояние
+            # диалога (kb_chunks он не читает). Каждая ветка пишет свой ключ state.
+            out = await self._tools_subgraph.ainvoke(
+                {
+                    "conversation_id": state["conversation_id"],
+                    "user_message": state["user_message"],
+                    "conv_state": state["conv_state"],
+                }
+            )
             return {"tools_context": out.get("tools_context")}
 
         async def build_messages(state: AgentState) -> Dict:
@@ -222,14 +300,23 @@ class GraphChatPipelineV10:
             kb_chunks = state.get("kb_chunks") or []
             tools_context: ToolsContext = state.get("tools_context") or {}
 
+            # KB context, правила и факты считаются один раз за ход и переиспользуются
+            # generate_and_self_judge / judge_evaluate / judge_revise (в т.ч. на повторных кругах).
+            context_text = kb_context_text(kb_chunks)
+            groups = group_instruction_blocks(tools_context.get("instruction_blocks") or [])
             messages = self._prompt_builder.build_messages(
                 conv_state=conv_state,
                 history_tail=history,
                 kb_chunks=kb_chunks,
                 tools_context=tools_context,
                 user_message=state["user_message"],
+                context_text=context_text,
+                block_groups=groups,
             )
-            return {"prompt_messages": messages}
+            return {
+                "prompt_messages": messages,
+                "judge_context": _judge_context(tools_context, groups, conv_state, context_text),
+            }
 
         async def llm_generate(state: AgentState) -> Dict:
             answer_draft = await self._client.chat(
@@ -239,180 +326,163 @@ class GraphChatPipelineV10:
             )
             return {"answer_draft": (answer_draft or "").strip()}
 
+        async def generate_and_self_judge(state: AgentState) -> Dict:
+            rules = (state.get("judge_context") or {}).get("rules_text") or "- (нет)"
+            messages = [dict(m) for m in state["prompt_messages"]]
+            messages[0]["content"] += _SELF_JUDGE_INSTRUCTIONS.format(rules=rules)
+
+            data = await self._client.chat_json(
+                messages,
+                schema=_SELF_JUDGE_SCHEMA,
+                name="answer_with_self_check",
+                temperature=0.1,
+                model=settings.llm_model,
+            )
+            answer = str(data.get("answer") or "").strip() if isinstance(data, dict) else ""
+            check = data.get("self_check") if isinstance(data, dict) else None
+            if not answer or not isinstance(check, dict) or check.get("action") not in ("pass", "revise"):
+                # Модель не вернула корректный JSON — обычная генерация, дальше полный judge.
+                logger.warning("self_judge_unparsed_v1_0 conversation_id=%s", state.get("conversation_id"))
+                return await llm_generate(state)
+
+            self_check: JudgeDecision = {"action": check["action"], "reasons": check.get("reasons") or []}
+            logger.info(
+                "self_judge_v1_0 conversation_id=%s action=%s reasons=%s",
+                state.get("conversation_id"),
+                self_check["action"],
+                self_check["reasons"],
+            )
+            return {"answer_draft": answer, "self_check": self_check}
+
+        def self_judge_router(state: AgentState) -> str:
+            self_check: JudgeDecision = state.get("self_check") or {}
+            return "persist" if self_check.get("action") == "pass" else "judge"
+
         async def judge_evaluate(state: AgentState) -> Dict:
-            tools_context: ToolsContext = state.get("tools_context") or {}
-            blocks: List[InstructionBlock] = tools_context.get("instruction_blocks") or []
             answer_draft = state.get("answer") or state.get("answer_draft") or ""
-            kb_chunks = state.get("kb_chunks") or []
-            conv_state = state["conv_state"]
-
-            judge_rules = [
-                b for b in blocks if b.get("target") == "judge" and b.get("kind") == "rule" and b.get("text")
-            ]
-            rules_text = "\n".join(f"- {b.get('text','')}" for b in judge_rules).strip()
-
-            facts_lines: List[str] = []
-            if conv_state.user_profile.name:
-                facts_lines.append(f"- user_profile.name: {conv_state.user_profile.name}")
-            if conv_state.user_profile.age is not None:
-                facts_lines.append(f"- user_profile.age: {conv_state.user_profile.age}")
-
-            tc_facts = tools_context.get("facts") or {}
-            if "tool:get_user_data" in tc_facts:
-                data = tc_facts.get("tool:get_user_data") or {}
-                safe = {k: data.get(k) for k in ("name", "age") if k in data}
-                facts_lines.append(f"- tool:get_user_data: {safe}")
-
-            required_agent_blocks = [
-                b
-                for b in blocks
-                if b.get("target") == "agent" and b.get("kind") == "required" and isinstance(b.get("text"), str)
-            ]
-            required_preview = [str(b.get("text")) for b in required_agent_blocks][:50]
-            required_text = "\n".join(f"- {t}" for t in required_preview).strip()
-
-            if kb_chunks:
-                ctx_lines = ["База знаний (релевантные фрагменты):"]
-                for idx, ch in enumerate(kb_chunks, start=1):
-                    ctx_lines.append(f"[{idx}] {ch.text}")
-                context_text = "\n".join(ctx_lines)
-            else:
-                context_text = "Релевантных фрагментов базы знаний не найдено."
-            judge_system = (
-                "Ты — строгий, но не занудный редактор ответа службы поддержки.\n"
-                "Твоя задача: решить, нужно ли править ответ ассистента. Не переписывай без необходимости.\n"
-                "Проверяй два типа проблем:\n"
-                "1) фактологические: ответ не должен утверждать то, чего нет в context/tools_context;\n"
-                "2) сценарные: ответ должен соблюдать rules и не применять ветки без оснований.\n"
-                "Также проверь стиль:\n"
-                "- Запрещены эмодзи/смайлики.\n"
-                "- Запрещены обещания будущих действий/обновлений/уведомлений (например: «мы обязательно сообщим», «передали разработчикам», «в следующем обновлении»), если этого нет в context.\n"
-                "Если правка нужна — верни JSON строго формата:\n"
-                '{"action":"revise","reasons":["..."],"patch_instructions":"..."}\n'
-                "Если правка не нужна — верни JSON:\n"
-                '{"action":"pass","reasons":["ok"],"patch_instructions":""}\n'
-                "Ограничение: не предлагай более 1-2 точечных правок. Без фанатизма.\n"
-                "Учитывай правила:\n"
-                f"{rules_text}\n\n"
-                "facts_summary:\n"
-                + ("\n".join(facts_lines).strip() if facts_lines else "- (нет)\n")
-                + "\n\n"
-                "required_instructions_summary:\n"
-                + (required_text if required_text else "- (нет)\n")
-                + "\n\n"
-                f"context:\n{context_text}\n"
+            jc: JudgeContext = state.get("judge_context") or {}
+
+            judge_dynamic = "".join(
+                [
+                    "Учитывай правила:\n",
+                    jc.get("rules_text", ""),
+                    "\n\nfacts_summary:\n",
+                    jc.get("facts_text", ""),
+                    "\n\nrequired_instructions_summary:\n",
+                    jc.get("required_text", ""),
+                    "\n\ncontext:\n",
+                    jc.get("context_text", ""),
+                    "\n",
+                ]
             )
             judge_user = (
                 f"Последнее сообщение пользователя:\n{state['user_message']}\n\n"
                 f"Черновик ответа ассистента:\n{answer_draft}\n"
             )
-            schema = {
-                "type": "object",
-                "additionalProperties": False,
-                "required": ["action", "reasons", "patch_instructions"],
-                "properties": {
-                    "action": {"type": "string", "enum": ["pass", "revise"]},
-                    "reasons": {"type": "array", "items": {"type": "string"}},
-                    "patch_instructions": {"type": "string"},
-                },
-            }
-            data = await self._client.chat_json(
-                [{"role": "system", "content": judge_system}, {"role": "user", "content": judge_user}],
-                schema=schema,
-                name="judge_decision",
-                temperature=0.0,
-                model=settings.judge_model,
+            inline_revise = settings.judge_inline_revise
+            judge_messages = [
+                {"role": "system", "content": _JUDGE_SYSTEM_INLINE_REVISE if inline_revise else _JUDGE_SYSTEM_STATIC},
+                {"role": "system", "content": judge_dynamic},
+                {"role": "user", "content": judge_user},
+            ]
+            # Exact-match кэш решений judge (temperature=0): тот же черновик при тех же правилах,
+            # фактах и контексте не проверяется повторно. Кэшируются только разобранные решения.
+            cache = get_response_cache()
+            cache_key = (
+                response_cache_key({"kind": "judge_decision", "model": settings.judge_model, "messages": judge_messages})
+                if cache is not None
+                else ""
             )
-            decision: JudgeDecision = {"action": "pass", "reasons": ["ok"], "patch_instructions": ""}
-            if isinstance(data, dict) and data.get("action") in ("pass", "revise"):
-                decision = {
-                    "action": data.get("action"),
-                    "reasons": data.get("reasons") or [],
-                    "patch_instructions": data.get("patch_instructions") or "",
-                }
+            cached: JudgeDecision | None = cache.get(cache_key) if cache is not None else None
+            if cached is not None:
+                decision: JudgeDecision = {**cached, "reasons": list(cached.get("reasons") or [])}
+                logger.debug("judge_cache_hit_v1_0 conversation_id=%s", state.get("conversation_id"))
+            else:
+                data = await self._client.chat_json(
+                    judge_messages,
+                    schema=_JUDGE_INLINE_REVISE_SCHEMA if inline_revise else _JUDGE_SCHEMA,
+                    name="judge_decision",
+                    temperature=0.0,
+                    model=settings.judge_model,
+                )
+                decision = {"action": "pass", "reasons": ["ok"], "patch_instructions": ""}
+                if isinstance(data, dict) and data.get("action") in ("pass", "revise"):
+                    decision = {
+                        "action": data.get("action"),
+                        "reasons": data.get("reasons") or [],
+                        "patch_instructions": data.get("patch_instructions") or "",
+                    }
+                    if inline_revise and data.get("action") == "revise":
+                        decision["revised_answer"] = str(data.get("revised_answer") or "").strip()
+                    if cache is not None:
+                        cache[cache_key] = decision
             logger.info(
                 "judge_decision_v1_0 conversation_id=%s attempts=%s action=%s reasons=%s patch=%r",
                 state.get("conversation_id"),
-                state.get("judge_attempts"),
+                state.get("judge_attempts") or 0,
                 decision.get("action"),
                 decision.get("reasons"),
                 (decision.get("patch_instructions") or "")[:2000],
             )
+            revised = decision.get("revised_answer")
+            if decision.get("action") == "revise" and revised:
+                # Правка уже в ответе judge: отдельный judge_revise не нужен, дальше — перепроверка.
+                attempts = int(state.get("judge_attempts") or 0) + 1
+                logger.info(
+                    "judge_inline_revise_v1_0 conversation_id=%s attempt=%d before=%r after=%r",
+                    state.get("conversation_id"),
+                    attempts,
+                    answer_draft[:4000],
+                    revised[:4000],
+                )
+                return {"judge_decision": decision, "answer": revised, "judge_attempts": attempts}
             return {"judge_decision": decision}
 
         def judge_router(state: AgentState) -> str:
             decision: JudgeDecision = state.get("judge_decision") or {}
             attempts = int(state.get("judge_attempts") or 0)
-            if decision.get("action") == "revise" and attempts < 2:
-                return "revise"
-            return "persist"
+            if decision.get("action") != "revise" or attempts >= 2:
+                return "persist"
+            # revised_answer уже применён в judge_evaluate — перепроверяем, иначе отдельная правка.
+            return "recheck" if decision.get("revised_answer") else "revise"
 
         async def judge_revise(state: AgentState) -> Dict:
             decision: JudgeDecision = state.get("judge_decision") or {}
             patch = decision.get("patch_instructions") or ""
             original = state.get("answer") or state.get("answer_draft") or ""
             attempts = int(state.get("judge_attempts") or 0) + 1
-            tools_context: ToolsContext = state.get("tools_context") or {}
-            blocks: List[InstructionBlock] = tools_context.get("instruction_blocks") or []
-            kb_chunks = state.get("kb_chunks") or []
-            conv_state = state["conv_state"]
-
-            facts_lines: List[str] = []
-            if conv_state.user_profile.name:
-                facts_lines.append(f"- user_profile.name: {conv_state.user_profile.name}")
-            if conv_state.user_profile.age is not None:
-                facts_lines.append(f"- user_profile.age: {conv_state.user_profile.age}")
-            tc_facts = tools_context.get("facts") or {}
-            if "tool:get_user_data" in tc_facts:
-                data = tc_facts.get("tool:get_user_data") or {}
-                safe = {k: data.get(k) for k in ("name", "age") if k in data}
-                facts_lines.append(f"- tool:get_user_data: {safe}")
-
-            required_agent_blocks = [
-                b
-                for b in blocks
-                if b.get("target") == "agent" and b.get("kind") == "required" and isinstance(b.get("text"), str)
+            jc: JudgeContext = state.get("judge_context") or {}
+
+            parts = [
+                "Инструкции для правки:\n",
+                patch,
+                "\n\nИсходный ответ:\n",
+                original,
+                "\n\nmust_keep:\n",
+                jc.get("must_keep_text", ""),
+                "\n",
             ]
-            required_preview = [str(b.get("text")) for b in required_agent_blocks][:12]
-            must_keep_text = "\n".join(f"- {t}" for t in required_preview).strip()
-
-            if kb_chunks:
-                ctx_lines = ["База знаний (релевантные фрагменты):"]
-                for idx, ch in enumerate(kb_chunks, start=1):
-                    ctx_lines.append(f"[{idx}] {ch.text}")
-                context_text = "\n".join(ctx_lines)
-            else:
-                context_text = "Релевантных фрагментов базы знаний не найдено."
-
-            revise_system = (
-                "Ты правишь ответ службы поддержки строго по инструкциям редактора.\n"
-                "Не добавляй новых фактов, которых нет в контексте.\n"
-                "Сделай минимальные правки.\n"
-                "Верни только финальный текст ответа, без списков изменений и без пояснений.\n"
-                "Нельзя удалять обязательные требования из must_keep, если они не противоречат context.\n"
-                "Не используй эмодзи/смайлики; если они есть в исходном тексте — убери.\n"
-                "Не добавляй обещания будущих действий/обновлений/уведомлений, если этого нет в context.\n"
-            )
-            revise_user = (
-                f"Инструкции для правки:\n{patch}\n\n"
-                f"Исходный ответ:\n{original}\n"
-                "\n\nfacts_summary:\n"
-                + ("\n".join(facts_lines).strip() if facts_lines else "- (нет)\n")
-                + "\n\nmust_keep:\n"
-                + (must_keep_text if must_keep_text else "- (нет)\n")
-                + "\n\ncontext:\n"
-                + context_text
-                + "\n"
-            )
+            with_context = bool(_REVISE_NEEDS_CONTEXT_RE.search(patch))
+            if with_context:
+                parts += [
+                    "\nfacts_summary:\n",
+                    jc.get("facts_text", ""),
+                    "\n\ncontext:\n",
+                    jc.get("context_text", ""),
+                    "\n",
+                ]
+            revise_user = "".join(parts)
             revised = await self._client.chat(
-                [{"role": "system", "content": revise_system}, {"role": "user", "content": revise_user}],
+                [{"role": "system", "content": _REVISE_SYSTEM_STATIC}, {"role": "user", "content": revise_user}],
                 temperature=0.1,
                 model=settings.revise_model,
             )
             logger.info(
-                "judge_revise_v1_0 conversation_id=%s attempt=%d patch=%r before=%r after=%r",
+                "judge_revise_v1_0 conversation_id=%s attempt=%d with_context=%s prompt_chars=%d patch=%r before=%r after=%r",
                 state.get("conversation_id"),
                 attempts,
+                with_context,
+                len(revise_user),
                 patch[:2000],
                 original[:4000],
                 (revised or "").strip()[:4000],
@@ -421,58 +491,61 @@ class GraphChatPipelineV10:
 
         async def persist_answer(state: AgentState) -> Dict:
             answer = (state.get("answer") or state.get("answer_draft") or "").strip()
-            self._memory.append_history(
-                state["conversation_id"],
-                HistoryItem(role=MessageRole.ASSISTANT, content=answer),
+            assistant_item = HistoryItem(role=MessageRole.ASSISTANT, content=answer)
+            await self._memory.save_state_and_append(
+                state["conv_state"],
+                *(state.get("pending_history") or []),
+                assistant_item,
             )
-            self._memory.save_state(state["conv_state"])
-            history = self._memory.get_history(state["conversation_id"]).history
-            return {"answer": answer, "history": history}
-
-        async def launch_summary(state: AgentState) -> Dict:
-            conversation_id = state["conversation_id"]
-
-            async def _run() -> None:
-                await self._summarizer.update_summary(self._memory, conversation_id)
-
-            try:
-                import asyncio
-
-                asyncio.create_task(_run())
-                logger.info("summary_launch_v1_0 conversation_id=%s", conversation_id)
-            except Exception as exc:  # noqa: BLE001
-                logger.error("summary_launch_failed_v1_0 conversation_id=%s error=%r", conversation_id, exc)
-            return {}
+            # Summary планируется сразу после записи (иначе фоновая задача увидит старую длину
+            # истории); проверка порога и пересчёт — в фоне, под lock диалога (см. SummaryScheduler).
+            self._summary_scheduler.schedule(state["conversation_id"])
+            history = [*(state.get("history") or []), assistant_item][-settings.history_tail_limit :]
+            return {"answer": answer, "history": history, "pending_history": []}
 
         graph.add_node("load_state", load_state)
         graph.add_node("append_user", append_user)
         graph.add_node("retrieval", retrieval)
         graph.add_node("tools_subgraph", tools_subgraph_node)
         graph.add_node("build_messages", build_messages)
-        graph.add_node("llm_generate", llm_generate)
+        if settings.self_judge:
+            graph.add_node("generate_and_self_judge", generate_and_self_judge)
+        else:
+            graph.add_node("llm_generate", llm_generate)
         graph.add_node("judge_evaluate", judge_evaluate)
         graph.add_node("judge_revise", judge_revise)
         graph.add_node("persist_answer", persist_answer)
-        graph.add_node("launch_summary", launch_summary)
 
         graph.set_entry_point("load_state")
         graph.add_edge("load_state", "append_user")
+        # Fan-out/fan-in: поиск по KB и сценарии идут параллельно, build_messages ждёт обе ветки.
         graph.add_edge("append_user", "retrieval")
-        graph.add_edge("retrieval", "tools_subgraph")
-        graph.add_edge("tools_subgraph", "build_messages")
-        graph.add_edge("build_messages", "llm_generate")
-        graph.add_edge("llm_generate", "judge_evaluate")
+        graph.add_edge("append_user", "tools_subgraph")
+        graph.add_edge(["retrieval", "tools_subgraph"], "build_messages")
+        if settings.self_judge:
+            graph.add_edge("build_messages", "generate_and_self_judge")
+            graph.add_conditional_edges(
+                "generate_and_self_judge",
+                self_judge_router,
+                {
+                    "judge": "judge_evaluate",
+                    "persist": "persist_answer",
+                },
+            )
+        else:
+            graph.add_edge("build_messages", "llm_generate")
+            graph.add_edge("llm_generate", "judge_evaluate")
         graph.add_conditional_edges(
             "judge_evaluate",
             judge_router,
             {
                 "revise": "judge_revise",
+                "recheck": "judge_evaluate",
                 "persist": "persist_answer",
             },
         )
         graph.add_edge("judge_revise", "judge_evaluate")
-        graph.add_edge("persist_answer", "launch_summary")
-        graph.add_edge("launch_summary", END)
+        graph.add_edge("persist_answer", END)
 
         return graph.compile()
 
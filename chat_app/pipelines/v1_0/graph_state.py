@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Any, Dict, List, Literal, Optional, TypedDict
+from typing import Any, Dict, Iterable, List, Literal, NamedTuple, Optional, TypedDict
 
 from chat_app.schemas import Chunk, ConversationState, HistoryItem
 
@@ -10,17 +10,47 @@ class JudgeDecision(TypedDict, total=False):
     action: Literal["pass", "revise"]
     reasons: List[str]
     patch_instructions: str
+    # JUDGE_INLINE_REVISE: исправленный ответ из того же запроса judge (пусто при pass).
+    revised_answer: str
 
 
-class InstructionBlock(TypedDict, total=False):
+@dataclass(slots=True)
+class InstructionBlock:
+    """Scenario instruction for the agent or the judge (slotted: blocks are built and filtered every turn)."""
+
     id: str
     source: str
     target: Literal["agent", "judge"]
     # raw: внутренние «сырые» куски сценария, которые затем сжимаются в короткие imperative-инструкции.
     kind: Literal["required", "conditional", "rule", "raw"]
-    priority: int
-    text: str
-    payload: Dict[str, Any]
+    priority: int = 10
+    text: str = ""
+    payload: Optional[Dict[str, Any]] = None
+
+
+class InstructionBlockGroups(NamedTuple):
+    """Instruction blocks split by consumer, in original order (one pass over the list)."""
+
+    agent_required: List[InstructionBlock]
+    agent_conditional: List[InstructionBlock]
+    judge_rules: List[InstructionBlock]
+
+
+def group_instruction_blocks(blocks: Iterable[InstructionBlock]) -> InstructionBlockGroups:
+    agent_required: List[InstructionBlock] = []
+    agent_conditional: List[InstructionBlock] = []
+    judge_rules: List[InstructionBlock] = []
+    for b in blocks:
+        target = b.target
+        kind = b.kind
+        if target == "agent":
+            if kind == "required" and isinstance(b.text, str) and b.text:
+                agent_required.append(b)
+            elif kind == "conditional" and b.payload:
+                agent_conditional.append(b)
+        elif target == "judge" and kind == "rule" and b.text:
+            judge_rules.append(b)
+    return InstructionBlockGroups(agent_required, agent_conditional, judge_rules)
 
 
 class ToolsContext(TypedDict, total=False):
@@ -29,21 +59,35 @@ class ToolsContext(TypedDict, total=False):
     applied: List[Dict[str, str]]
 
 
+class JudgeContext(TypedDict, total=False):
+    # Секции промптов judge/revise; считаются один раз в build_messages.
+    context_text: str
+    rules_text: str
+    facts_text: str
+    required_text: str
+    must_keep_text: str
+
+
 class AgentState(TypedDict, total=False):
     conversation_id: str
     user_message: str
 
     conv_state: ConversationState
     history: List[HistoryItem]
+    # Сообщения этого хода, ещё не записанные в память (пишутся в persist_answer вместе со state).
+    pending_history: List[HistoryItem]
 
     kb_chunks: List[Chunk]
 
     tools_context: ToolsContext
 
     prompt_messages: List[Dict[str, str]]
+    judge_context: JudgeContext
 
     answer_draft: str
     answer: str
+    # Самопроверка генератора (SELF_JUDGE): при action == "pass" отдельный judge не вызывается.
+    self_check: JudgeDecision
 
     judge_attempts: int
     judge_decision: JudgeDecision
@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import operator
 import re
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
 
 from chat_app.pipelines.v1_0.graph_state import (
     AgentState,
@@ -9,56 +12,214 @@ from chat_app.pipelines.v1_0.graph_state import (
     ScenarioMapResult,
 )
 from chat_app.pipelines.v1_0.tool_registry import ToolRegistry
-from chat_app.schemas import ScenarioDefinition, ScenarioNode
+from chat_app.schemas import (
+    NODE_IF,
+    NODE_TEXT,
+    NODE_TOOL,
+    CompiledScenarioNode,
+    ScenarioDefinition,
+)
 
 
 _TEMPLATE_PATTERN = re.compile(r"\{=([^=]+)=\}")
 
+# Статичные части условного блока: одни и те же для всех if-узлов, блоки дальше только читаются.
+_APPLY_POLICY: Dict[str, str] = {
+    "relevance_gate": "Если сообщение не относится к теме условия — игнорируй блок полностью.",
+    "true_gate": "Считай условие TRUE только если из сообщения явно следует, что условие выполняется.",
+    "false_gate": "Считай условие FALSE только если из сообщения явно следует, что условие НЕ выполняется, но тема та же.",
+    "unknown_gate": "Если упомянута тема, но непонятно TRUE/FALSE — не применяй when_false по умолчанию и лучше игнорируй блок.",
+}
+_CONDITIONAL_JUDGE_RULE = (
+    "Проверь, что условные сценарные инструкции применены только при явном подтверждении в сообщении пользователя. "
+    "Не допускай применения when_false по умолчанию при неоднозначности."
+)
+
 
-def _sort_key(node: ScenarioNode) -> List[int]:
-    parts: List[int] = []
-    for part in node.id.split("."):
-        try:
-            parts.append(int(part))
-        except ValueError:
-            parts.append(0)
-    return parts
+# Значения tools, которые попадают в ключ кэша рендера; вложенные структуры не кэшируются.
+_KEY_SCALAR_TYPES = frozenset({str, int, float, bool, type(None)})
+
+
+def _tool_results_key(tool_results: Dict[str, Dict[str, Any]]) -> Tuple[Hashable, ...] | None:
+    """Hashable snapshot of tool results for the render cache (None if a value is not a plain scalar)."""
+    # Порядок ключей сохраняется: {=@tool=} рендерит весь dict через str(). Тип значения входит
+    # в ключ: 30 == 30.0 и True == 1 равны и для dict/lru_cache, но рендерятся по-разному.
+    key = []
+    for name, data in tool_results.items():
+        items = []
+        for field, value in data.items():
+            if type(value) not in _KEY_SCALAR_TYPES:
+                return None
+            items.append((field, type(value).__name__, value))
+        key.append((name, tuple(items)))
+    return tuple(key)
+
+
+# typed=True: name/age приходят и из tools (age может оказаться 30.0), а 30 и 30.0 рендерятся по-разному.
+@functools.lru_cache(maxsize=4096, typed=True)
+def _render_cached(
+    text: str,
+    name: Any,
+    age: Any,
+    message_index: int,
+    tool_results_key: Tuple[Hashable, ...],
+) -> str:
+    tool_results = {
+        tool_name: {field: value for field, _type, value in items} for tool_name, items in tool_results_key
+    }
+    return _render(text, name, age, message_index, tool_results)
+
+
+def _render_template(
+    text: str,
+    *,
+    state: AgentState,
+    tool_results: Dict[str, Dict[str, Any]],
+    tool_results_key: Tuple[Hashable, ...] | None = None,
+) -> str:
+    """
+    Подстановка {=...=} в текст узла сценария.
 
+    Результат — чистая функция текста, профиля, message_index и данных tools, поэтому
+    кэшируется (один и тот же сценарий рендерится заново на каждом ходе). tool_results_key —
+    снимок _tool_results_key(tool_results), если вызывающий уже его посчитал.
+    """
+    if "{=" not in text:
+        # Большинство строк сценария без подстановок: ни ключа кэша, ни сегментов.
+        return text
+    conv_state = state["conv_state"]
+    profile = conv_state.user_profile
+    if tool_results_key is None:
+        tool_results_key = _tool_results_key(tool_results)
+    try:
+        if tool_results_key is not None:
+            return _render_cached(text, profile.name, profile.age, conv_state.message_index, tool_results_key)
+    except TypeError:
+        pass
+    return _render(text, profile.name, profile.age, conv_state.message_index, tool_results)
+
+
+@functools.lru_cache(maxsize=1024, typed=True)
+def _render_branch_cached(
+    texts: Tuple[str, ...],
+    name: Any,
+    age: Any,
+    message_index: int,
+    tool_results_key: Tuple[Hashable, ...],
+) -> Tuple[str, ...]:
+    return tuple(_render_cached(text, name, age, message_index, tool_results_key) for text in texts)
+
+
+def _render_branch(
+    texts: Tuple[str, ...],
+    *,
+    state: AgentState,
+    tool_results: Dict[str, Dict[str, Any]],
+    tool_results_key: Tuple[Hashable, ...] | None = None,
+) -> List[str]:
+    """
+    Рендер всех текстов ветки if (when_true / when_false) одним обращением к кэшу.
 
-def _render_template(text: str, *, state: AgentState, tool_results: Dict[str, Dict[str, Any]]) -> str:
+    texts — CompiledScenarioNode.true_texts/false_texts: кортеж хешируемый и тот же между ходами,
+    поэтому на повторном ходе ветка целиком достаётся из кэша без поштучных подстановок.
+    """
+    if not any("{=" in text for text in texts):
+        return list(texts)
     conv_state = state["conv_state"]
+    profile = conv_state.user_profile
+    if tool_results_key is None:
+        tool_results_key = _tool_results_key(tool_results)
+    try:
+        if tool_results_key is not None:
+            return list(
+                _render_branch_cached(texts, profile.name, profile.age, conv_state.message_index, tool_results_key)
+            )
+    except TypeError:
+        pass
+    return [_render(text, profile.name, profile.age, conv_state.message_index, tool_results) for text in texts]
+
+
+# Сегменты скомпилированного шаблона: str — литерал, (_SEG_TOOL, tool, field | None) — данные
+# tool, (_SEG_DIALOG, i) — i-е поле (name, age, message_index).
+_SEG_TOOL = 0
+_SEG_DIALOG = 1
+_DIALOG_FIELDS = {"name": 0, "age": 1, "message_index": 2}
+_Segment = str | Tuple[Any, ...]
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile_template(text: str) -> Tuple[_Segment, ...]:
+    """Splits a node text into literal and placeholder segments (regex runs once per distinct text)."""
+    segments: List[_Segment] = []
+    pos = 0
+    for match in _TEMPLATE_PATTERN.finditer(text):
+        if match.start() > pos:
+            segments.append(text[pos : match.start()])
+        pos = match.end()
 
-    def replace(match: re.Match[str]) -> str:
         expr = match.group(1).strip()
         if expr.startswith("@"):
-            inner = expr[1:]
-            parts = inner.split(".")
-            if not parts:
-                return "finderror"
-            tool_name = parts[0]
-            field = parts[1] if len(parts) > 1 else None
-            tool_data = tool_results.get(tool_name) or {}
-            if field is None:
-                value = tool_data or None
-            else:
-                value = tool_data.get(field)
-            return str(value) if value is not None else "finderror"
-
-        if expr.startswith("dialog."):
-            key = expr[len("dialog.") :]
-            if key == "name":
-                value = conv_state.user_profile.name
-            elif key == "age":
-                value = conv_state.user_profile.age
-            elif key == "message_index":
-                value = conv_state.message_index
-            else:
-                value = None
-            return str(value) if value is not None else "finderror"
+            parts = expr[1:].split(".")
+            segments.append((_SEG_TOOL, parts[0], parts[1] if len(parts) > 1 else None))
+        elif expr.startswith("dialog.") and expr[len("dialog.") :] in _DIALOG_FIELDS:
+            segments.append((_SEG_DIALOG, _DIALOG_FIELDS[expr[len("dialog.") :]]))
+        else:
+            segments.append("finderror")
+    if pos < len(text):
+        segments.append(text[pos:])
+    return tuple(segments)
+
+
+def _render(
+    text: str,
+    name: Any,
+    age: Any,
+    message_index: int,
+    tool_results: Dict[str, Dict[str, Any]],
+) -> str:
+    segments = _compile_template(text)
+    dialog = (name, age, message_index)
+    out: List[str] = []
+    for seg in segments:
+        if isinstance(seg, str):
+            out.append(seg)
+            continue
+        if seg[0] == _SEG_TOOL:
+            tool_data = tool_results.get(seg[1]) or {}
+            value = (tool_data or None) if seg[2] is None else tool_data.get(seg[2])
+        else:
+            value = dialog[seg[1]]
+        out.append(str(value) if value is not None else "finderror")
+    return "".join(out)
+
+
+# Ищется по уже приведённой к нижнему регистру строке условия.
+_MESSAGE_INDEX_CONDITION_PATTERN = re.compile(r"\b(?:dialog\.)?message_index\s*(==|!=|<=|>=|<|>)\s*(\d+)\b")
+_COMPARISONS: Dict[str, Callable[[int, int], bool]] = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_message_index_condition(condition: str) -> Tuple[Callable[[int, int], bool], int] | None:
+    # Условие узла статично: разбор (в т.ч. lower() и регулярка) — один раз на строку условия.
+    text = condition.strip()
+    if not text:
+        return None
 
-        return "finderror"
+    lowered = text.lower()
+    if "сообщ" in lowered and "перв" in lowered:
+        return (operator.ne if "не перв" in lowered else operator.eq), 1
 
-    return _TEMPLATE_PATTERN.sub(replace, text)
+    match = _MESSAGE_INDEX_CONDITION_PATTERN.search(lowered)
+    if not match:
+        return None
+    return _COMPARISONS[match.group(1)], int(match.group(2))
 
 
 def _try_eval_message_index_condition(condition: str, *, message_index: int) -> Optional[bool]:
@@ -68,41 +229,11 @@ def _try_eval_message_index_condition(condition: str, *, message_index: int) ->
     This enables "program-like" branching where children may include tool/if nodes,
     e.g. wrapping the whole scenario into `if (dialog.message_index == 1) { ... }`.
     """
-    text = (condition or "").strip()
-    if not text:
-        return None
-
-    lowered = text.lower()
-    if "не перв" in lowered and "сообщ" in lowered:
-        return message_index != 1
-    if "перв" in lowered and "сообщ" in lowered:
-        return message_index == 1
-
-    match = re.search(
-        r"(?i)\b(?:dialog\.)?message_index\s*(==|!=|<=|>=|<|>)\s*(\d+)\b",
-        text,
-    )
-    if not match:
+    parsed = _parse_message_index_condition(condition or "")
+    if parsed is None:
         return None
-    op = match.group(1)
-    try:
-        rhs = int(match.group(2))
-    except Exception:  # noqa: BLE001
-        return None
-
-    if op == "==":
-        return message_index == rhs
-    if op == "!=":
-        return message_index != rhs
-    if op == "<":
-        return message_index < rhs
-    if op == "<=":
-        return message_index <= rhs
-    if op == ">":
-        return message_index > rhs
-    if op == ">=":
-        return message_index >= rhs
-    return None
+    compare, rhs = parsed
+    return compare(message_index, rhs)
 
 
 async def run_scenario_map(
@@ -112,148 +243,150 @@ async def run_scenario_map(
     tools: ToolRegistry,
 ) -> ScenarioMapResult | None:
     conv_state = state["conv_state"]
-    apply_only_index = (scenario.meta or {}).get("apply_only_message_index")
-    if apply_only_index is not None:
-        try:
-            required_idx = int(apply_only_index)
-        except Exception:  # noqa: BLE001
-            required_idx = None
-        if required_idx is not None and conv_state.message_index != required_idx:
-            return None
+    if not scenario.triggers_on(conv_state.message_index):
+        return None
 
     facts: Dict[str, Dict[str, Any]] = {}
     instruction_blocks: List[InstructionBlock] = []
-
-    async def ensure_tool_data(tool_name: str) -> None:
-        key = f"tool:{tool_name}"
-        if key in facts:
-            return
-
+    # Снимок facts для кэша рендера: пересчитывается, только когда tool добавил данные.
+    tool_results: Dict[str, Dict[str, Any]] = {}
+    tool_results_key: Tuple[Hashable, ...] | None = ()
+    # meta.parallel_tools=false — соседние tool-узлы вызываются строго по очереди
+    # (если следующий tool зависит от профиля, заполненного предыдущим).
+    parallel_tools = scenario.parallel_tools
+    # Префиксы id блоков: имя сценария форматируется один раз на прогон, а не на каждый узел.
+    text_id_prefix = f"scenario:{scenario.name}:text:"
+    if_id_prefix = f"scenario:{scenario.name}:if:"
+    judge_rule_id_prefix = f"scenario:{scenario.name}:judge_rule:if:"
+
+    def render(text: str) -> str:
+        return _render_template(text, state=state, tool_results=tool_results, tool_results_key=tool_results_key)
+
+    def render_branch(texts: Tuple[str, ...]) -> List[str]:
+        return _render_branch(texts, state=state, tool_results=tool_results, tool_results_key=tool_results_key)
+
+    def store_tool_data(tool_name: str, data: Dict[str, Any]) -> None:
+        # facts (ключи "tool:<name>") уходят в state, tool_results — в рендер шаблонов.
+        nonlocal tool_results_key
+        facts[f"tool:{tool_name}"] = data
+        tool_results[tool_name] = data
+        tool_results_key = _tool_results_key(tool_results)
+
+    async def fetch_tool_data(tool_name: str) -> Dict[str, Any]:
         if tool_name == "get_user_data":
             # v1.0: вызываем tool только при необходимости, но результат всегда доступен для шаблонов.
             profile = conv_state.user_profile
             if profile.name and profile.age is not None:
-                facts[key] = {
-                    "name": profile.name,
-                    "age": profile.age,
-                }
-                return
+                return {"name": profile.name, "age": profile.age}
+        return await tools.call(tool_name, state=state)
+
+    async def ensure_tools_data(tool_names: Tuple[str, ...]) -> None:
+        pending = [name for name in tool_names if name not in tool_results]
+        if len(pending) > 1 and parallel_tools:
+            # Независимые tools одного шага — параллельно; результаты применяются в порядке узлов.
+            results = await asyncio.gather(*(fetch_tool_data(name) for name in pending))
+            for name, data in zip(pending, results):
+                apply_tool_data(name, data)
+            return
+        for name in pending:
+            apply_tool_data(name, await fetch_tool_data(name))
 
-        facts[key] = await tools.call(tool_name, state=state)
+    def apply_tool_data(tool_name: str, data: Dict[str, Any]) -> None:
+        store_tool_data(tool_name, data)
         if tool_name == "get_user_data":
             profile = conv_state.user_profile
-            data = facts.get(key) or {}
+            data = data or {}
             if not profile.name:
                 profile.name = data.get("name")
-            if profile.age is None and data.get("age") is not None:
+            age = data.get("age")
+            if profile.age is None and age is not None:
                 try:
-                    profile.age = int(data.get("age"))
+                    profile.age = int(age)
                 except Exception:  # noqa: BLE001
-                    profile.age = data.get("age")
+                    profile.age = age
 
     def add_text_block(node_id: str, text: str) -> None:
-        rendered = _render_template(
-            text,
-            state=state,
-            tool_results={k.removeprefix("tool:"): v for k, v in facts.items()},
-        )
+        rendered = render(text)
         instruction_blocks.append(
-            {
-                "id": f"scenario:{scenario.name}:text:{node_id}",
-                "source": scenario.name,
-                "target": "agent",
-                "kind": "raw",
-                "priority": 10,
-                "text": rendered,
-                "payload": {"node_id": node_id, "node_type": "text"},
-            }
+            InstructionBlock(
+                id=text_id_prefix + node_id,
+                source=scenario.name,
+                target="agent",
+                kind="raw",
+                priority=10,
+                text=rendered,
+                payload={"node_id": node_id, "node_type": "text"},
+            )
         )
 
-    def add_conditional_program(node: ScenarioNode) -> None:
+    def add_conditional_program(compiled: CompiledScenarioNode) -> None:
+        node = compiled.node
         condition = node.condition or ""
-        true_texts: List[str] = []
-        false_texts: List[str] = []
-
-        for child in node.children or []:
-            if child.type == "text" and child.text:
-                true_texts.append(
-                    _render_template(child.text, state=state, tool_results={k.removeprefix("tool:"): v for k, v in facts.items()})
-                )
-        for child in node.else_children or []:
-            if child.type == "text" and child.text:
-                false_texts.append(
-                    _render_template(child.text, state=state, tool_results={k.removeprefix("tool:"): v for k, v in facts.items()})
-                )
+        # Тексты веток отобраны при компиляции сценария — здесь только рендер.
+        true_texts = render_branch(compiled.true_texts)
+        false_texts = render_branch(compiled.false_texts)
 
         instruction_blocks.append(
-            {
-                "id": f"scenario:{scenario.name}:if:{node.id}",
-                "source": scenario.name,
-                "target": "agent",
-                "kind": "conditional",
-                "priority": 10,
-                "payload": {
+            InstructionBlock(
+                id=if_id_prefix + node.id,
+                source=scenario.name,
+                target="agent",
+                kind="conditional",
+                priority=10,
+                payload={
                     "condition_id": node.id,
                     "condition": condition,
                     "when_true": true_texts,
                     "when_false": false_texts,
-                    "apply_policy": {
-                        "relevance_gate": "Если сообщение не относится к теме условия — игнорируй блок полностью.",
-                        "true_gate": "Считай условие TRUE только если из сообщения явно следует, что условие выполняется.",
-                        "false_gate": "Считай условие FALSE только если из сообщения явно следует, что условие НЕ выполняется, но тема та же.",
-                        "unknown_gate": "Если упомянута тема, но непонятно TRUE/FALSE — не применяй when_false по умолчанию и лучше игнорируй блок.",
-                    },
+                    "apply_policy": _APPLY_POLICY,
                     "condition_text": condition,
                 },
-            }
+            )
         )
 
         instruction_blocks.append(
-            {
-                "id": f"scenario:{scenario.name}:judge_rule:if:{node.id}",
-                "source": scenario.name,
-                "target": "judge",
-                "kind": "rule",
-                "priority": 10,
-                "text": (
-                    "Проверь, что условные сценарные инструкции применены только при явном подтверждении в сообщении пользователя. "
-                    "Не допускай применения when_false по умолчанию при неоднозначности."
-                ),
-            }
+            InstructionBlock(
+                id=judge_rule_id_prefix + node.id,
+                source=scenario.name,
+                target="judge",
+                kind="rule",
+                priority=10,
+                text=_CONDITIONAL_JUDGE_RULE,
+            )
         )
 
-    async def process_nodes(nodes: List[ScenarioNode]) -> bool:
+    async def process_nodes(program: Tuple[CompiledScenarioNode, ...]) -> None:
         """
-        Returns True if `end` encountered and scenario execution should stop.
+        Walks the program until it is exhausted or an `end` node is reached.
+
+        program уже отсортирован и разобран по видам при регистрации сценария (ScenarioDefinition.program).
+        Обход без рекурсии: стек итераторов, выбранная ветка if кладётся наверх, а после неё
+        продолжается родительский уровень.
         """
-        for node in sorted(nodes, key=_sort_key):
-            if node.type == "end":
-                return True
-            if node.type == "tool" and node.tool:
-                await ensure_tool_data(node.tool)
-                continue
-            if node.type == "text" and node.text:
-                add_text_block(node.id, node.text)
-                continue
-            if node.type == "if":
-                decided = _try_eval_message_index_condition(
-                    str(node.condition or ""),
-                    message_index=conv_state.message_index,
-                )
-                if decided is True:
-                    if await process_nodes(list(node.children or [])):
-                        return True
-                    continue
-                if decided is False:
-                    if await process_nodes(list(node.else_children or [])):
-                        return True
-                    continue
-
-                add_conditional_program(node)
-                continue
-        return False
-
-    _ = await process_nodes(list(scenario.code or []))
+        stack = [iter(program)]
+        while stack:
+            for compiled in stack[-1]:
+                kind, node = compiled.kind, compiled.node
+                if kind == NODE_TEXT:
+                    add_text_block(node.id, node.text)
+                elif kind == NODE_TOOL:
+                    await ensure_tools_data(compiled.tools)
+                elif kind == NODE_IF:
+                    decided = _try_eval_message_index_condition(
+                        str(node.condition or ""),
+                        message_index=conv_state.message_index,
+                    )
+                    if decided is None:
+                        add_conditional_program(compiled)
+                    else:
+                        stack.append(iter(compiled.children if decided else compiled.else_children))
+                        break
+                else:
+                    return
+            else:
+                stack.pop()
+
+    await process_nodes(scenario.program)
 
     if not instruction_blocks and not facts:
         return None
@@ -7,6 +7,7 @@ from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional, Tupl
 
 from langgraph.graph import END, StateGraph
 
+from chat_app.llm_client import get_response_cache, response_cache_key
 from chat_app.pipelines.v1_0.graph_state import AgentState, InstructionBlock, ScenarioMapResult, ToolsContext
 from chat_app.pipelines.v1_0.subgraphs.scenario_engine import run_scenario_map
 from chat_app.pipelines.v1_0.tool_registry import ToolRegistry
@@ -18,6 +19,169 @@ LlmChatJson = Callable[[List[Dict[str, str]], Dict[str, Any], str], Awaitable[Di
 
 logger = logging.getLogger("chat_app.tools_subgraph_v1_0")
 
+# JSON-схемы structured output не зависят от хода — строятся один раз при импорте.
+_CONDITION_DECISION_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["decision", "followup_question"],
+    "properties": {
+        "decision": {"type": "string", "enum": ["ignore", "true", "false", "unknown"]},
+        "followup_question": {"type": "string"},
+    },
+}
+_CONDITIONS_BATCH_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["results"],
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["id", "decision", "followup_question"],
+                "properties": {
+                    "id": {"type": "string"},
+                    "decision": {"type": "string", "enum": ["ignore", "true", "false", "unknown"]},
+                    "followup_question": {"type": "string"},
+                },
+            },
+        },
+    },
+}
+_SCENARIO_IMPERATIVES_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["agent_imperatives", "judge_rules"],
+    "properties": {
+        "agent_imperatives": {"type": "array", "items": {"type": "string"}},
+        "judge_rules": {"type": "array", "items": {"type": "string"}},
+    },
+}
+_SCENARIO_IMPERATIVES_BATCH_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["scenarios"],
+    "properties": {
+        "scenarios": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["source", "agent_imperatives", "judge_rules"],
+                "properties": {
+                    "source": {"type": "string"},
+                    "agent_imperatives": {"type": "array", "items": {"type": "string"}},
+                    "judge_rules": {"type": "array", "items": {"type": "string"}},
+                },
+            },
+        },
+    },
+}
+
+# Промпт решения по условному блоку: вступление и правила общие для одиночного и пакетного запроса.
+_CONDITION_DECISION_INTRO = (
+    "Ты — модуль принятия решения по условному ветвлению сценария поддержки.\n"
+    "Нужно определить, относится ли последнее сообщение пользователя к условию, и если относится — истинно оно, ложно или неоднозначно.\n"
+    "Важно: ты решаешь применимость сценарной ветки по последнему сообщению пользователя и dialog_params, а не «истинность во внешнем мире».\n"
+    "dialog_params.message_index — это порядковый номер текущего сообщения пользователя (считаются только сообщения пользователя, а не ответы ассистента). "
+    "Не пересчитывай этот номер по истории диалога, используй только значение из dialog_params.\n"
+)
+_CONDITION_DECISION_RULES = (
+    "Правила:\n"
+    "- ignore: если сообщение не относится к теме условия.\n"
+    "- true: только если из сообщения ЯВНО следует, что условие выполняется.\n"
+    "- false: только если из сообщения ЯВНО следует, что условие НЕ выполняется, но тема та же.\n"
+    "- unknown: если тема та же, но нельзя уверенно выбрать true/false.\n"
+    "- Если условие про параметры диалога (например, dialog_params.message_index или «первое сообщение пользователя») —\n"
+    "  используй dialog_params.message_index для принятия решения и НЕ выбирай ignore по причине «не по теме».\n"
+    "- Если условие про «второе/третье/четвертое сообщение пользователя» — это строгое сравнение dialog_params.message_index с 2/3/4.\n"
+    "- Если условие сформулировано как «Пользователь написал/сказал/сообщил ... что ...» — трактуй это как проверку факта высказывания в последнем сообщении.\n"
+    "  TRUE: если пользователь в последнем сообщении утверждает это.\n"
+    "  FALSE: если пользователь в последнем сообщении явно утверждает обратное.\n"
+    "  UNKNOWN: только если по последнему сообщению реально непонятно, утверждает ли он это.\n"
+    "  Не требуй внешнюю верификацию: слова пользователя достаточно для true/false.\n"
+    "- Если в сообщении пользователя явно есть указание на время (например, слово 'сегодня'), и это соответствует смыслу condition,\n"
+    "  не выбирай unknown: выбери true или false.\n"
+    "Для unknown задавай только вопрос про уточнение формулировки последнего сообщения (без запроса персональных данных).\n"
+    "Запрещено просить персональные данные или «верификацию» (например: дату рождения, паспорт, телефон, адрес, email, номер карты).\n"
+    'Для unknown сформулируй короткий уточняющий вопрос (followup_question), иначе пустую строку.\n'
+)
+_CONDITION_DECISION_SYSTEM = (
+    _CONDITION_DECISION_INTRO
+    + "Верни СТРОГО JSON без лишнего текста формата:\n"
+    '{\n'
+    '  "decision": "ignore|true|false|unknown",\n'
+    '  "followup_question": "..." \n'
+    "}\n"
+    + _CONDITION_DECISION_RULES
+)
+_CONDITIONS_BATCH_SYSTEM = (
+    _CONDITION_DECISION_INTRO
+    + "На входе — список conditions: прими решение для КАЖДОГО условия независимо, по одному и тому же сообщению пользователя.\n"
+    "Верни СТРОГО JSON без лишнего текста формата:\n"
+    '{\n'
+    '  "results": [{"id": "<id условия>", "decision": "ignore|true|false|unknown", "followup_question": "..."}]\n'
+    "}\n"
+    "В results — ровно один элемент на каждый id из conditions.\n"
+    + _CONDITION_DECISION_RULES
+)
+
+# Промпт сжатия сценария в imperative-инструкции: одиночный и пакетный варианты с общими правилами.
+_SCENARIO_IMPERATIVES_RULES = (
+    "Правила:\n"
+    "- agent_imperatives: 0..8 строк, каждая — короткая команда (imperative), без воды.\n"
+    "- judge_rules: 0..8 строк, правила для LLM-судьи (как проверять ответ), без воды.\n"
+    "- Не повторяй исходный текст сценария дословно, если он болтливый — сжимай.\n"
+    "- Не добавляй новых фактов.\n"
+    "- Если известно имя пользователя — требуй обращения по имени и укажи само имя.\n"
+    "- Не используй эмодзи.\n"
+)
+_SCENARIO_IMPERATIVES_SYSTEM = (
+    "Ты — модуль сжатия сценария поддержки в короткие imperative-инструкции для основного агента.\n"
+    "На входе: куски текста сценария (после подстановок) и контекст о пользователе.\n"
+    "На выходе: короткие обязательные инструкции, без пояснений и лишнего текста.\n"
+    "Инструкции должны сохранять смысл сценария и быть применимыми при ответе на текущее сообщение пользователя.\n"
+    "Если сценарий не добавляет ничего полезного для ответа — верни пустой список.\n"
+    "Верни СТРОГО JSON:\n"
+    '{\n'
+    '  "agent_imperatives": ["..."],\n'
+    '  "judge_rules": ["..."]\n'
+    "}\n"
+    + _SCENARIO_IMPERATIVES_RULES
+)
+_SCENARIO_IMPERATIVES_BATCH_SYSTEM = (
+    "Ты — модуль сжатия сценариев поддержки в короткие imperative-инструкции для основного агента.\n"
+    "На входе: несколько сценариев (scenarios: source и куски текста после подстановок) и общий контекст о пользователе.\n"
+    "Сожми КАЖДЫЙ сценарий отдельно и независимо: инструкции одного сценария не переносятся в другой.\n"
+    "На выходе: короткие обязательные инструкции, без пояснений и лишнего текста.\n"
+    "Инструкции должны сохранять смысл сценария и быть применимыми при ответе на текущее сообщение пользователя.\n"
+    "Если сценарий не добавляет ничего полезного для ответа — верни для него пустые списки.\n"
+    "Верни СТРОГО JSON:\n"
+    '{\n'
+    '  "scenarios": [{"source": "...", "agent_imperatives": ["..."], "judge_rules": ["..."]}]\n'
+    "}\n"
+    "В scenarios — ровно один элемент на каждый source из входа.\n"
+    + _SCENARIO_IMPERATIVES_RULES
+)
+# Пакетное сжатие — только пока суммарный объём кусков сценариев умеренный, иначе запросы по сценарию.
+_SCENARIO_IMPERATIVES_BATCH_MAX_CHARS = 12000
+
+_DECISIONS = ("ignore", "true", "false", "unknown")
+
+
+def _facts_preview(facts: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    # В промпт решения по условию идут только имя/возраст из get_user_data.
+    facts_preview = {}
+    for k, v in facts.items():
+        if k == "tool:get_user_data":
+            facts_preview[k] = {kk: v.get(kk) for kk in ("name", "age") if kk in v}
+    return facts_preview
+
+
+def _mk_block(block_id: str, source: str, target: str, kind: str, priority: int, text: str) -> InstructionBlock:
+    return InstructionBlock(id=block_id, source=source, target=target, kind=kind, priority=priority, text=text)
+
 
 def build_tools_subgraph(
     *,
@@ -25,11 +189,15 @@ def build_tools_subgraph(
     tools: ToolRegistry,
     llm_chat: LlmChat,
     llm_chat_json: LlmChatJson,
+    batch_conditions: bool = False,
+    batch_summaries: bool = False,
 ):
     class ToolsSubgraphState(AgentState, total=False):
         scenario_map_results: List[ScenarioMapResult]
         scenario_decisions: Dict[str, List[str]]
         scenario_sources_with_condition: List[str]
+        # source → (raw-тексты, ответ LLM) для сценариев без условий, сжатых до решений по условиям.
+        unconditional_imperatives: Dict[str, Tuple[List[str], Dict[str, Any]]]
 
     graph = StateGraph(ToolsSubgraphState)
 
@@ -42,39 +210,43 @@ def build_tools_subgraph(
         return {"tools_context": tools_context}
 
     async def scenario_map_node(state: ToolsSubgraphState) -> Dict:
-        scenarios = [s for s in scenario_registry.all().values() if getattr(s, "enabled", True)]
-        if not scenarios:
-            return {"scenario_map_results": []}
+        """
+        Runs every applicable scenario concurrently and merges their facts and blocks into tools_context.
+
+        Слияние — здесь же, после gather: оно дешёвое, а порядок
+        реестра сохраняется — первый сценарий выигрывает по facts, блоки идут в порядке сценариев.
+        """
+        tools_context: ToolsContext = state.get("tools_context") or {}
+        # Сценарии, чья политика исключает этот ход (apply_only_message_index), даже не планируем.
+        conv_state = state.get("conv_state")
+        scenarios = scenario_registry.enabled_snapshot()
+        if conv_state is not None:
+            scenarios = tuple(s for s in scenarios if s.triggers_on(conv_state.message_index))
 
         async def _run(scn):
             return await run_scenario_map(state=state, scenario=scn, tools=tools)
 
-        results = await asyncio.gather(*(_run(scn) for scn in scenarios))
+        results = await asyncio.gather(*(_run(scn) for scn in scenarios)) if scenarios else []
         mapped: List[ScenarioMapResult] = [r for r in results if r is not None]  # type: ignore[comparison-overlap]
-        return {"scenario_map_results": mapped}
-
-    async def scenario_reduce_node(state: ToolsSubgraphState) -> Dict:
-        tools_context: ToolsContext = state.get("tools_context") or {}
-        results: List[ScenarioMapResult] = state.get("scenario_map_results") or []
 
         facts = dict(tools_context.get("facts") or {})
         instruction_blocks: List[InstructionBlock] = list(tools_context.get("instruction_blocks") or [])
-
-        for result in results:
+        for result in mapped:
             for k, v in (result.facts or {}).items():
                 facts.setdefault(k, v)
             instruction_blocks.extend(result.instruction_blocks or [])
 
-        tools_context = {
-            "facts": facts,
-            "instruction_blocks": instruction_blocks,
-            # applied будет собран позже (после decisions + summarize), чтобы не отмечать
-            # сценарий как применённый при decision=ignore/unknown.
-            "applied": list(tools_context.get("applied") or []),
+        return {
+            "scenario_map_results": mapped,
+            "tools_context": {
+                "facts": facts,
+                "instruction_blocks": instruction_blocks,
+                # applied будет собран позже (после decisions + summarize), чтобы не отмечать
+                # сценарий как применённый при decision=ignore/unknown.
+                "applied": list(tools_context.get("applied") or []),
+            },
         }
 
-        return {"tools_context": tools_context}
-
     async def _decide_condition_via_llm(
         *,
         condition: str,
@@ -91,68 +263,39 @@ def build_tools_subgraph(
         - decision: ignore|true|false|unknown
         - followup_question: optional clarification question for unknown
         """
-        facts_preview = {}
-        for k, v in facts.items():
-            if k == "tool:get_user_data":
-                facts_preview[k] = {kk: v.get(kk) for kk in ("name", "age") if kk in v}
-
-        system = (
-            "Ты — модуль принятия решения по условному ветвлению сценария поддержки.\n"
-            "Нужно определить, относится ли последнее сообщение пользователя к условию, и если относится — истинно оно, ложно или неоднозначно.\n"
-            "Важно: ты решаешь применимость сценарной ветки по последнему сообщению пользователя и dialog_params, а не «истинность во внешнем мире».\n"
-            "dialog_params.message_index — это порядковый номер текущего сообщения пользователя (считаются только сообщения пользователя, а не ответы ассистента). "
-            "Не пересчитывай этот номер по истории диалога, используй только значение из dialog_params.\n"
-            "Верни СТРОГО JSON без лишнего текста формата:\n"
-            '{\n'
-            '  "decision": "ignore|true|false|unknown",\n'
-            '  "followup_question": "..." \n'
-            "}\n"
-            "Правила:\n"
-            "- ignore: если сообщение не относится к теме условия.\n"
-            "- true: только если из сообщения ЯВНО следует, что условие выполняется.\n"
-            "- false: только если из сообщения ЯВНО следует, что условие НЕ выполняется, но тема та же.\n"
-            "- unknown: если тема та же, но нельзя уверенно выбрать true/false.\n"
-            "- Если условие про параметры диалога (например, dialog_params.message_index или «первое сообщение пользователя») —\n"
-            "  используй dialog_params.message_index для принятия решения и НЕ выбирай ignore по причине «не по теме».\n"
-            "- Если условие про «второе/третье/четвертое сообщение пользователя» — это строгое сравнение dialog_params.message_index с 2/3/4.\n"
-            "- Если условие сформулировано как «Пользователь написал/сказал/сообщил ... что ...» — трактуй это как проверку факта высказывания в последнем сообщении.\n"
-            "  TRUE: если пользователь в последнем сообщении утверждает это.\n"
-            "  FALSE: если пользователь в последнем сообщении явно утверждает обратное.\n"
-            "  UNKNOWN: только если по последнему сообщению реально непонятно, утверждает ли он это.\n"
-            "  Не требуй внешнюю верификацию: слова пользователя достаточно для true/false.\n"
-            "- Если в сообщении пользователя явно есть указание на время (например, слово 'сегодня'), и это соответствует смыслу condition,\n"
-            "  не выбирай unknown: выбери true или false.\n"
-            "Для unknown задавай только вопрос про уточнение формулировки последнего сообщения (без запроса персональных данных).\n"
-            "Запрещено просить персональные данные или «верификацию» (например: дату рождения, паспорт, телефон, адрес, email, номер карты).\n"
-            'Для unknown сформулируй короткий уточняющий вопрос (followup_question), иначе пустую строку.\n'
-        )
+        facts_preview = _facts_preview(facts)
+        # Общий для всех условий хода контекст — в начале сообщения, само условие — в конце:
+        # одинаковый префикс запросов хода попадает в prompt cache провайдера.
         user = (
-            f"Условие:\n{condition}\n\n"
             f"dialog_params:\n{json.dumps({'message_index': message_index}, ensure_ascii=False)}\n\n"
             f"Сообщение пользователя:\n{user_message}\n\n"
             f"Факты:\n{json.dumps(facts_preview, ensure_ascii=False)}\n\n"
+            f"Условие:\n{condition}\n\n"
             f"Ветка when_true (для понимания смысла):\n{json.dumps(when_true[:5], ensure_ascii=False)}\n\n"
             f"Ветка when_false (для понимания смысла):\n{json.dumps(when_false[:5], ensure_ascii=False)}\n"
         )
-        schema = {
-            "type": "object",
-            "additionalProperties": False,
-            "required": ["decision", "followup_question"],
-            "properties": {
-                "decision": {"type": "string", "enum": ["ignore", "true", "false", "unknown"]},
-                "followup_question": {"type": "string"},
-            },
-        }
-        data = await llm_chat_json(
-            [{"role": "system", "content": system}, {"role": "user", "content": user}],
-            schema,
-            "condition_decision",
+        messages = [{"role": "system", "content": _CONDITION_DECISION_SYSTEM}, {"role": "user", "content": user}]
+        # Exact-match кэш решений (temperature=0, модель условий фиксирована на процесс): то же условие
+        # при том же сообщении, message_index и фактах повторно в LLM не уходит. Кэшируются только
+        # разобранные ответы модели.
+        cache = get_response_cache()
+        cache_key = response_cache_key({"kind": "condition_decision", "messages": messages}) if cache is not None else ""
+        cached: Tuple[Literal["ignore", "true", "false", "unknown"], Optional[str]] | None = (
+            cache.get(cache_key) if cache is not None else None
         )
+        if cached is not None:
+            logger.debug("condition_cache_hit_v1_0 decision=%s condition=%r", cached[0], condition[:160])
+            return cached
+
+        data = await llm_chat_json(messages, _CONDITION_DECISION_SCHEMA, "condition_decision")
         decision = data.get("decision") if isinstance(data, dict) else None
-        if decision not in ("ignore", "true", "false", "unknown"):
+        parsed = decision in _DECISIONS
+        if not parsed:
             decision = "unknown"
         followup = (data.get("followup_question") if isinstance(data, dict) else "") or ""
         followup_question = str(followup).strip()
+        if parsed and cache is not None:
+            cache[cache_key] = (decision, followup_question or None)
         logger.info(
             "condition_decision_v1_0 decision=%s followup_present=%s condition=%r user_message=%r",
             decision,
@@ -162,6 +305,55 @@ def build_tools_subgraph(
         )
         return decision, (followup_question or None)
 
+    async def _decide_conditions_batch(
+        *,
+        conditions: List[Tuple[str, List[str], List[str]]],
+        user_message: str,
+        message_index: Optional[int],
+        facts: Dict[str, Dict[str, Any]],
+    ) -> List[Tuple[Literal["ignore", "true", "false", "unknown"], Optional[str]]]:
+        """
+        Decisions for several conditional blocks of one turn in a single LLM request.
+
+        conditions — (condition, when_true, when_false) в порядке блоков; результат в том же порядке.
+        Условие, для которого модель не вернула элемент results, считается unknown без followup.
+        """
+        items = [
+            {"id": str(i), "condition": condition, "when_true": when_true[:5], "when_false": when_false[:5]}
+            for i, (condition, when_true, when_false) in enumerate(conditions, start=1)
+        ]
+        user = (
+            f"dialog_params:\n{json.dumps({'message_index': message_index}, ensure_ascii=False)}\n\n"
+            f"Сообщение пользователя:\n{user_message}\n\n"
+            f"Факты:\n{json.dumps(_facts_preview(facts), ensure_ascii=False)}\n\n"
+            f"conditions (when_true/when_false — для понимания смысла):\n{json.dumps(items, ensure_ascii=False)}\n"
+        )
+        data = await llm_chat_json(
+            [{"role": "system", "content": _CONDITIONS_BATCH_SYSTEM}, {"role": "user", "content": user}],
+            _CONDITIONS_BATCH_SCHEMA,
+            "conditions_decision",
+        )
+        by_id: Dict[str, Tuple[Literal["ignore", "true", "false", "unknown"], Optional[str]]] = {}
+        results = data.get("results") if isinstance(data, dict) else None
+        for item in results if isinstance(results, list) else []:
+            if not isinstance(item, dict):
+                continue
+            decision = item.get("decision")
+            if decision not in _DECISIONS:
+                decision = "unknown"
+            followup_question = str(item.get("followup_question") or "").strip()
+            by_id[str(item.get("id"))] = (decision, followup_question or None)
+
+        out = [by_id.get(str(i), ("unknown", None)) for i in range(1, len(conditions) + 1)]
+        logger.info(
+            "conditions_decision_batch_v1_0 conditions=%d returned=%d decisions=%s user_message=%r",
+            len(conditions),
+            len(by_id),
+            [d for d, _ in out],
+            user_message[:160],
+        )
+        return out
+
     async def conditions_decide_node(state: ToolsSubgraphState) -> Dict:
         tools_context: ToolsContext = state.get("tools_context") or {}
         blocks: List[InstructionBlock] = list(tools_context.get("instruction_blocks") or [])
@@ -170,108 +362,231 @@ def build_tools_subgraph(
         conv_state = state.get("conv_state")
         message_index = conv_state.message_index if conv_state is not None else None
 
-        conditional_blocks = [b for b in blocks if b.get("kind") == "conditional" and b.get("target") == "agent"]
-        scenario_sources_with_condition = sorted({(b.get("source") or "").strip() for b in conditional_blocks if (b.get("source") or "").strip()})
+        # conditional-блоки агента решаются ниже, остальные переходят в результат как есть.
+        conditional_blocks: List[InstructionBlock] = []
+        keep: List[InstructionBlock] = []
+        for b in blocks:
+            (conditional_blocks if b.kind == "conditional" and b.target == "agent" else keep).append(b)
+        scenario_sources_with_condition = sorted(
+            {src for src in (b.source.strip() for b in conditional_blocks) if src}
+        )
 
-        async def decide(block: InstructionBlock):
-            payload = block.get("payload") or {}
-            condition = str(payload.get("condition") or payload.get("condition_text") or block.get("text") or "")
-            if not condition:
-                return ("ignore", block, [])
+        def parse_condition(block: InstructionBlock) -> Tuple[str, List[str], List[str]]:
+            payload = block.payload or {}
+            condition = str(payload.get("condition") or payload.get("condition_text") or block.text)
             when_true = [str(x) for x in (payload.get("when_true") or [])]
             when_false = [str(x) for x in (payload.get("when_false") or [])]
-
-            decision, followup = await _decide_condition_via_llm(
-                condition=condition,
+            return condition, when_true, when_false
+
+        def applied_for(
+            block: InstructionBlock,
+            decision: str,
+            followup: Optional[str],
+            when_true: List[str],
+            when_false: List[str],
+        ) -> List[InstructionBlock]:
+            bid = block.id
+            src = block.source
+            pri = block.priority
+            if decision == "true":
+                return [
+                    _mk_block(f"{bid}:applied:true:{idx}", src, "agent", "raw", pri, txt)
+                    for idx, txt in enumerate(when_true, start=1)
+                ]
+            if decision == "false":
+                return [
+                    _mk_block(f"{bid}:applied:false:{idx}", src, "agent", "raw", pri, txt)
+                    for idx, txt in enumerate(when_false, start=1)
+                ]
+            if decision == "unknown" and followup:
+                # Для unknown сохраняем только уточняющий вопрос (без "безусловных" текстов сценария).
+                return [
+                    _mk_block(
+                        f"{bid}:applied:unknown:followup",
+                        src,
+                        "agent",
+                        "required",
+                        pri,
+                        "В конце ответа задай уточняющий вопрос (сначала ответь на основной вопрос пользователя):\n"
+                        f"{followup}",
+                    )
+                ]
+            return []
+
+        parsed = [parse_condition(b) for b in conditional_blocks]
+        # Блок без текста условия — ignore без запроса к LLM; одинаковые условия (с теми же ветками)
+        # решаются одним запросом.
+        keys = [(condition, tuple(when_true), tuple(when_false)) for condition, when_true, when_false in parsed]
+        pending = list(dict.fromkeys(key for key in keys if key[0]))
+        if batch_conditions and len(pending) > 1:
+            # CONDITIONS_BATCH: все условия хода — одним запросом (общий system-промпт и контекст).
+            batch = await _decide_conditions_batch(
+                conditions=[(condition, list(when_true), list(when_false)) for condition, when_true, when_false in pending],
                 user_message=user_message,
                 message_index=message_index,
-                when_true=when_true,
-                when_false=when_false,
                 facts=facts,
             )
-
-            applied_blocks: List[InstructionBlock] = []
-            if decision == "true":
-                for idx, txt in enumerate(when_true, start=1):
-                    applied_blocks.append(
-                        {
-                            "id": f"{block.get('id')}:applied:true:{idx}",
-                            "source": block.get("source") or "",
-                            "target": "agent",
-                            "kind": "raw",
-                            "priority": int(block.get("priority") or 10),
-                            "text": txt,
-                        }
+        else:
+            batch = await asyncio.gather(
+                *(
+                    _decide_condition_via_llm(
+                        condition=condition,
+                        user_message=user_message,
+                        message_index=message_index,
+                        when_true=list(when_true),
+                        when_false=list(when_false),
+                        facts=facts,
                     )
-            elif decision == "false":
-                for idx, txt in enumerate(when_false, start=1):
-                    applied_blocks.append(
-                        {
-                            "id": f"{block.get('id')}:applied:false:{idx}",
-                            "source": block.get("source") or "",
-                            "target": "agent",
-                            "kind": "raw",
-                            "priority": int(block.get("priority") or 10),
-                            "text": txt,
-                        }
-                    )
-            elif decision == "unknown" and followup:
-                # Для unknown сохраняем только уточняющий вопрос (без "безусловных" текстов сценария).
-                applied_blocks.append(
-                    {
-                        "id": f"{block.get('id')}:applied:unknown:followup",
-                        "source": block.get("source") or "",
-                        "target": "agent",
-                        "kind": "required",
-                        "priority": int(block.get("priority") or 10),
-                        "text": (
-                            "В конце ответа задай уточняющий вопрос (сначала ответь на основной вопрос пользователя):\n"
-                            f"{followup}"
-                        ),
-                    }
+                    for condition, when_true, when_false in pending
                 )
+            )
+        by_key = dict(zip(pending, batch))
+        decided = [by_key.get(key, ("ignore", None)) for key in keys]
 
-            return (decision, block, applied_blocks)
-
-        results = await asyncio.gather(*(decide(b) for b in conditional_blocks))
+        results = [
+            (decision, block, applied_for(block, decision, followup, when_true, when_false))
+            for block, (decision, followup), (_, when_true, when_false) in zip(conditional_blocks, decided, parsed)
+        ]
 
         new_blocks: List[InstructionBlock] = []
         applied_from_conditions: List[InstructionBlock] = []
         scenario_decisions: Dict[str, List[str]] = {}
         for decision, block, applied_blocks in results:
-            src = (block.get("source") or "").strip()
-            if src:
-                scenario_decisions.setdefault(src, [])
-                scenario_decisions[src].append(decision)
+            src = block.source
+            source_name = src.strip()
+            if source_name:
+                scenario_decisions.setdefault(source_name, []).append(decision)
             # Для продакшн-логики conditional блоки не нужны в промпте:
             # мы либо применяем ветку, либо игнорируем, либо просим уточнение.
             if decision != "ignore":
+                bid = block.id
                 new_blocks.append(
-                    {
-                        "id": f"{block.get('id')}:decision",
-                        "source": block.get("source") or "",
-                        "target": "judge",
-                        "kind": "rule",
-                        "priority": int(block.get("priority") or 10),
-                        "text": (
-                            f"Условный блок {block.get('id')} был оценён как decision={decision}. "
-                            "Проверь, что ответ не противоречит этому решению и не содержит утверждений из другой ветки."
-                        ),
-                    }
+                    _mk_block(
+                        f"{bid}:decision",
+                        src,
+                        "judge",
+                        "rule",
+                        block.priority,
+                        f"Условный блок {bid} был оценён как decision={decision}. "
+                        "Проверь, что ответ не противоречит этому решению и не содержит утверждений из другой ветки.",
+                    )
                 )
             applied_from_conditions.extend(applied_blocks)
 
         # Пересобираем blocks: все не-conditional + отфильтрованные conditional + применённые required.
-        keep = [b for b in blocks if not (b.get("kind") == "conditional" and b.get("target") == "agent")]
         blocks_out = keep + new_blocks + applied_from_conditions
 
-        tools_context["instruction_blocks"] = blocks_out
+        # Новый dict: scenario_summarize_unconditional параллельно читает исходный tools_context.
         return {
-            "tools_context": tools_context,
+            "tools_context": {**tools_context, "instruction_blocks": blocks_out},
             "scenario_decisions": scenario_decisions,
             "scenario_sources_with_condition": scenario_sources_with_condition,
         }
 
+    async def _summarize_scenario(state: ToolsSubgraphState, source: str, texts: List[str]) -> Dict[str, Any]:
+        """Один LLM-запрос: raw-тексты сценария source → agent_imperatives / judge_rules."""
+        name = state.get("conv_state").user_profile.name if state.get("conv_state") else ""
+        age = state.get("conv_state").user_profile.age if state.get("conv_state") else None
+
+        # Как и в решениях по условиям: общий для сценариев хода контекст — первым, сам сценарий — последним.
+        user = (
+            f"Последнее сообщение пользователя:\n{state.get('user_message') or ''}\n\n"
+            "Известные факты о пользователе:\n"
+            f"- name: {name or ''}\n"
+            f"- age: {'' if age is None else age}\n\n"
+            f"Сценарий: {source}\n"
+            "Куски сценария (после подстановок):\n"
+            + "\n".join(f"{i}. {t}" for i, t in enumerate(texts[:50], start=1))
+        )
+        data = await llm_chat_json(
+            [{"role": "system", "content": _SCENARIO_IMPERATIVES_SYSTEM}, {"role": "user", "content": user}],
+            _SCENARIO_IMPERATIVES_SCHEMA,
+            "scenario_imperatives",
+        )
+        if not isinstance(data, dict):
+            return {"agent_imperatives": [], "judge_rules": []}
+        return data
+
+    async def _summarize_scenarios_batch(
+        state: ToolsSubgraphState, by_source: Dict[str, List[str]]
+    ) -> Dict[str, Dict[str, Any]]:
+        """Один LLM-запрос на все сценарии; в ответе — только source из by_source."""
+        conv_state = state.get("conv_state")
+        name = conv_state.user_profile.name if conv_state else ""
+        age = conv_state.user_profile.age if conv_state else None
+        scenarios = [{"source": src, "texts": texts[:50]} for src, texts in by_source.items()]
+        user = (
+            f"Последнее сообщение пользователя:\n{state.get('user_message') or ''}\n\n"
+            "Известные факты о пользователе:\n"
+            f"- name: {name or ''}\n"
+            f"- age: {'' if age is None else age}\n\n"
+            f"scenarios (куски после подстановок):\n{json.dumps(scenarios, ensure_ascii=False)}\n"
+        )
+        data = await llm_chat_json(
+            [{"role": "system", "content": _SCENARIO_IMPERATIVES_BATCH_SYSTEM}, {"role": "user", "content": user}],
+            _SCENARIO_IMPERATIVES_BATCH_SCHEMA,
+            "scenario_imperatives_batch",
+        )
+        out: Dict[str, Dict[str, Any]] = {}
+        items = data.get("scenarios") if isinstance(data, dict) else None
+        for item in items if isinstance(items, list) else []:
+            if isinstance(item, dict) and str(item.get("source") or "") in by_source:
+                out.setdefault(str(item["source"]), item)
+        return out
+
+    async def _summarize_scenarios(
+        state: ToolsSubgraphState, by_source: Dict[str, List[str]]
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Ответы сжатия для каждого source из by_source.
+
+        SCENARIO_IMPERATIVES_BATCH: несколько сценариев — одним запросом (если куски в пределах
+        _SCENARIO_IMPERATIVES_BATCH_MAX_CHARS); сценарии, пропущенные моделью, — отдельными запросами.
+        """
+        out: Dict[str, Dict[str, Any]] = {}
+        if batch_summaries and len(by_source) > 1:
+            chars = sum(len(t) for texts in by_source.values() for t in texts[:50])
+            if chars <= _SCENARIO_IMPERATIVES_BATCH_MAX_CHARS:
+                out = await _summarize_scenarios_batch(state, by_source)
+                logger.info(
+                    "scenario_imperatives_batch_v1_0 sources=%d returned=%d chars=%d",
+                    len(by_source),
+                    len(out),
+                    chars,
+                )
+        missing = [src for src in by_source if src not in out]
+        if missing:
+            results = await asyncio.gather(*(_summarize_scenario(state, src, by_source[src]) for src in missing))
+            out.update(zip(missing, results, strict=False))
+        return out
+
+    async def scenario_summarize_unconditional(state: ToolsSubgraphState) -> Dict:
+        """
+        Сжимает сценарии без условных блоков параллельно с conditions_decide.
+
+        Их raw-тексты от решений по условиям не зависят, поэтому запрос к LLM не ждёт
+        conditions_decide; scenario_summarize берёт готовый результат, если тексты совпали.
+        """
+        tools_context: ToolsContext = state.get("tools_context") or {}
+        blocks: List[InstructionBlock] = list(tools_context.get("instruction_blocks") or [])
+        scenario_names = {r.scenario_name for r in (state.get("scenario_map_results") or [])}
+        with_condition = {
+            b.source.strip() for b in blocks if b.kind == "conditional" and b.target == "agent"
+        }
+
+        by_source: Dict[str, List[str]] = {}
+        for b in blocks:
+            src = b.source.strip()
+            if src not in scenario_names or src in with_condition:
+                continue
+            if b.target == "agent" and b.kind == "raw" and b.text.strip():
+                by_source.setdefault(src, []).append(b.text.strip())
+        if not by_source:
+            return {"unconditional_imperatives": {}}
+
+        summaries = await _summarize_scenarios(state, by_source)
+        return {"unconditional_imperatives": {src: (texts, summaries[src]) for src, texts in by_source.items()}}
+
     async def scenario_summarize_to_imperatives(state: ToolsSubgraphState) -> Dict:
         """
         Сжимает «сырые» блоки сценариев (kind=raw,target=agent) в короткие imperative-инструкции (kind=required).
@@ -283,131 +598,71 @@ def build_tools_subgraph(
         sources_with_condition = set(state.get("scenario_sources_with_condition") or [])
         scenario_names = [r.scenario_name for r in (state.get("scenario_map_results") or [])]
 
-        def _decisions_for(source: str) -> set[str]:
-            return set(str(x) for x in (scenario_decisions.get(source) or []) if x)
-
-        enabled_for_summarize: set[str] = set()
-        enabled_overall: set[str] = set()
-
-        has_true_blocks: Dict[str, bool] = {name: False for name in scenario_names}
-        has_false_blocks: Dict[str, bool] = {name: False for name in scenario_names}
-
+        names = set(scenario_names)
+        # Сценарии, у которых применена ветка true/false условного блока.
+        applied_branch: set[str] = set()
         for b in blocks:
-            src = (b.get("source") or "").strip()
-            if src in has_true_blocks and b.get("target") == "agent" and b.get("kind") == "raw":
-                bid = str(b.get("id") or "")
-                if ":applied:true:" in bid:
-                    has_true_blocks[src] = True
-                if ":applied:false:" in bid:
-                    has_false_blocks[src] = True
-
-        for name in scenario_names:
-            dec = _decisions_for(name)
-            if has_true_blocks.get(name):
-                enabled_for_summarize.add(name)
-                enabled_overall.add(name)
-            elif has_false_blocks.get(name):
-                enabled_for_summarize.add(name)
-                enabled_overall.add(name)
-            elif "unknown" in dec:
-                # unknown: оставляем только followup (и связанные judge rules), но не тянем "безусловные" тексты.
-                enabled_overall.add(name)
-            elif name not in sources_with_condition:
-                # сценарий без condition-узлов — разрешаем как есть.
-                enabled_for_summarize.add(name)
-                enabled_overall.add(name)
-            # ignore-only: не добавляем вообще ничего из сценария
-
-        # Сначала отфильтруем блоки по enabled_overall:
-        if scenario_names:
-            filtered: List[InstructionBlock] = []
-            for b in blocks:
-                src = (b.get("source") or "").strip()
-                if src in scenario_names and src not in enabled_overall:
-                    continue
-                # Для unknown: запрещаем "безусловные" raw-тексты сценария (они не должны попадать даже в summarize).
-                if src in scenario_names and src in enabled_overall and src not in enabled_for_summarize:
-                    if b.get("target") == "agent" and b.get("kind") == "raw":
-                        continue
-                filtered.append(b)
-            blocks = filtered
-
-        raw_blocks = [
-            b for b in blocks if b.get("target") == "agent" and b.get("kind") == "raw" and (b.get("text") or "").strip()
-        ]
-        # Если ни один scenario не должен суммаризироваться — выходим, но пересобираем applied.
-        if not raw_blocks:
-            applied_sources: List[str] = []
-            for b in blocks:
-                src = (b.get("source") or "").strip()
-                if src and src in scenario_names and b.get("target") == "agent" and b.get("kind") == "required":
-                    applied_sources.append(src)
-            tools_context["instruction_blocks"] = blocks
-            tools_context["applied"] = [{"kind": "scenario", "name": s} for s in sorted(set(applied_sources))]
-            return {"tools_context": tools_context}
-
+            src = b.source.strip()
+            if src in names and b.target == "agent" and b.kind == "raw":
+                bid = b.id
+                if ":applied:true:" in bid or ":applied:false:" in bid:
+                    applied_branch.add(src)
+
+        # unknown: оставляем только followup (и связанные judge rules), но не тянем "безусловные" тексты.
+        # Сценарий без condition-узлов разрешаем как есть; ignore-only — не добавляем ничего из сценария.
+        has_unknown = {src for src, decisions in scenario_decisions.items() if "unknown" in decisions} & names
+        no_condition = names - sources_with_condition
+        enabled_for_summarize = applied_branch | (no_condition - has_unknown)
+        enabled_overall = enabled_for_summarize | has_unknown
+
+        # Один проход по блокам: отбрасываем блоки выключенных сценариев, raw-тексты группируем
+        # по сценарию для summarize, остальное оставляем как есть.
+        keep_blocks: List[InstructionBlock] = []
         by_source: Dict[str, List[str]] = {}
-        for b in raw_blocks:
-            src = (b.get("source") or "").strip() or "unknown_scenario"
-            if scenario_names and src in scenario_names and src not in enabled_for_summarize:
+        applied_sources: set[str] = set()
+        raw_count = 0
+        for b in blocks:
+            src = b.source.strip()
+            in_names = src in names
+            if in_names and src not in enabled_overall:
                 continue
-            by_source.setdefault(src, []).append(str(b.get("text") or "").strip())
-
-        name = state.get("conv_state").user_profile.name if state.get("conv_state") else ""
-        age = state.get("conv_state").user_profile.age if state.get("conv_state") else None
+            kind, target = b.kind, b.target
+            if target == "agent" and kind == "raw":
+                # Для unknown: запрещаем "безусловные" raw-тексты сценария (они не должны попадать даже в summarize).
+                if in_names and src not in enabled_for_summarize:
+                    continue
+                text = b.text.strip()
+                if text:
+                    raw_count += 1
+                    by_source.setdefault(src or "unknown_scenario", []).append(text)
+                continue
+            keep_blocks.append(b)
+            if src and in_names and target == "agent" and kind == "required":
+                applied_sources.add(src)
 
-        async def summarize_one(source: str, texts: List[str]) -> Dict[str, Any]:
-            system = (
-                "Ты — модуль сжатия сценария поддержки в короткие imperative-инструкции для основного агента.\n"
-                "На входе: куски текста сценария (после подстановок) и контекст о пользователе.\n"
-                "На выходе: короткие обязательные инструкции, без пояснений и лишнего текста.\n"
-                "Инструкции должны сохранять смысл сценария и быть применимыми при ответе на текущее сообщение пользователя.\n"
-                "Если сценарий не добавляет ничего полезного для ответа — верни пустой список.\n"
-                "Верни СТРОГО JSON:\n"
-                '{\n'
-                '  "agent_imperatives": ["..."],\n'
-                '  "judge_rules": ["..."]\n'
-                "}\n"
-                "Правила:\n"
-                "- agent_imperatives: 0..8 строк, каждая — короткая команда (imperative), без воды.\n"
-                "- judge_rules: 0..8 строк, правила для LLM-судьи (как проверять ответ), без воды.\n"
-                "- Не повторяй исходный текст сценария дословно, если он болтливый — сжимай.\n"
-                "- Не добавляй новых фактов.\n"
-                "- Если известно имя пользователя — требуй обращения по имени и укажи само имя.\n"
-                "- Не используй эмодзи.\n"
-            )
-            user = (
-                f"Сценарий: {source}\n\n"
-                f"Последнее сообщение пользователя:\n{state.get('user_message') or ''}\n\n"
-                "Известные факты о пользователе:\n"
-                f"- name: {name or ''}\n"
-                f"- age: {'' if age is None else age}\n"
-                "Куски сценария (после подстановок):\n"
-                + "\n".join(f"{i}. {t}" for i, t in enumerate(texts[:50], start=1))
-            )
-            schema = {
-                "type": "object",
-                "additionalProperties": False,
-                "required": ["agent_imperatives", "judge_rules"],
-                "properties": {
-                    "agent_imperatives": {"type": "array", "items": {"type": "string"}},
-                    "judge_rules": {"type": "array", "items": {"type": "string"}},
-                },
+        # Если ни один scenario не должен суммаризироваться — выходим, но пересобираем applied.
+        if not by_source:
+            return {
+                "tools_context": {
+                    **tools_context,
+                    "instruction_blocks": keep_blocks,
+                    "applied": [{"kind": "scenario", "name": s} for s in sorted(applied_sources)],
+                }
             }
-            data = await llm_chat_json(
-                [{"role": "system", "content": system}, {"role": "user", "content": user}],
-                schema,
-                "scenario_imperatives",
-            )
-            if not isinstance(data, dict):
-                return {"agent_imperatives": [], "judge_rules": []}
-            return data
 
-        results = await asyncio.gather(*(summarize_one(src, texts) for src, texts in by_source.items()))
+        # Сценарии без условий уже сжаты параллельно с conditions_decide (если их тексты не изменились).
+        summaries: Dict[str, Dict[str, Any]] = {}
+        for src, texts in by_source.items():
+            done = (state.get("unconditional_imperatives") or {}).get(src)
+            if done is not None and done[0] == texts:
+                summaries[src] = done[1]
+        pending = {src: texts for src, texts in by_source.items() if src not in summaries}
+        if pending:
+            summaries.update(await _summarize_scenarios(state, pending))
+        results = [summaries[src] for src in by_source]
 
-        # Удаляем raw-блоки из итоговых instruction_blocks и добавляем сжатые required/rule.
-        keep_blocks = [b for b in blocks if not (b.get("target") == "agent" and b.get("kind") == "raw")]
-        out_blocks: List[InstructionBlock] = list(keep_blocks)
+        # raw-блоки в итоговые instruction_blocks не попадают: вместо них — сжатые required/rule.
+        out_blocks = keep_blocks
 
         for (source, _texts), data in zip(by_source.items(), results, strict=False):
             imperatives = data.get("agent_imperatives") if isinstance(data, dict) else []
@@ -419,58 +674,59 @@ def build_tools_subgraph(
                 fallback = [t.strip() for t in by_source.get(source, []) if t.strip()][:3]
                 cleaned_imperatives = fallback
 
+            if cleaned_imperatives and source in names:
+                applied_sources.add(source)
             for idx, text in enumerate(cleaned_imperatives[:8], start=1):
                 out_blocks.append(
-                    {
-                        "id": f"scenario:{source}:imperative:{idx}",
-                        "source": source,
-                        "target": "agent",
-                        "kind": "required",
-                        "priority": 10,
-                        "text": text,
-                    }
+                    InstructionBlock(
+                        id=f"scenario:{source}:imperative:{idx}",
+                        source=source,
+                        target="agent",
+                        kind="required",
+                        priority=10,
+                        text=text,
+                    )
                 )
 
             cleaned_rules = [str(x).strip() for x in (rules or []) if str(x).strip()]
             for idx, text in enumerate(cleaned_rules[:8], start=1):
                 out_blocks.append(
-                    {
-                        "id": f"scenario:{source}:judge_rule:summarized:{idx}",
-                        "source": source,
-                        "target": "judge",
-                        "kind": "rule",
-                        "priority": 10,
-                        "text": text,
-                    }
+                    InstructionBlock(
+                        id=f"scenario:{source}:judge_rule:summarized:{idx}",
+                        source=source,
+                        target="judge",
+                        kind="rule",
+                        priority=10,
+                        text=text,
+                    )
                 )
 
-        tools_context["instruction_blocks"] = out_blocks
-        applied_sources: List[str] = []
-        if scenario_names:
-            for b in out_blocks:
-                src = (b.get("source") or "").strip()
-                if src and src in scenario_names and b.get("target") == "agent" and b.get("kind") == "required":
-                    applied_sources.append(src)
-        tools_context["applied"] = [{"kind": "scenario", "name": s} for s in sorted(set(applied_sources))]
         logger.info(
             "scenario_imperatives_v1_0 sources=%s raw_blocks=%d out_blocks=%d",
             list(by_source.keys()),
-            len(raw_blocks),
+            raw_count,
             len(out_blocks),
         )
-        return {"tools_context": tools_context}
+        return {
+            "tools_context": {
+                **tools_context,
+                "instruction_blocks": out_blocks,
+                "applied": [{"kind": "scenario", "name": s} for s in sorted(applied_sources)],
+            }
+        }
 
     graph.add_node("init_tools_state", init_tools_state)
     graph.add_node("scenario_map", scenario_map_node)
-    graph.add_node("scenario_reduce", scenario_reduce_node)
     graph.add_node("conditions_decide", conditions_decide_node)
+    graph.add_node("scenario_summarize_unconditional", scenario_summarize_unconditional)
     graph.add_node("scenario_summarize", scenario_summarize_to_imperatives)
 
     graph.set_entry_point("init_tools_state")
     graph.add_edge("init_tools_state", "scenario_map")
-    graph.add_edge("scenario_map", "scenario_reduce")
-    graph.add_edge("scenario_reduce", "conditions_decide")
-    graph.add_edge("conditions_decide", "scenario_summarize")
+    # Сценарии без условий сжимаются параллельно с решениями по условиям; scenario_summarize ждёт обе ветки.
+    graph.add_edge("scenario_map", "conditions_decide")
+    graph.add_edge("scenario_map", "scenario_summarize_unconditional")
+    graph.add_edge(["conditions_decide", "scenario_summarize_unconditional"], "scenario_summarize")
     graph.add_edge("scenario_summarize", END)
 
     return graph.compile()
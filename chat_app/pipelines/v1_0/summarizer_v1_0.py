@@ -1,27 +1,39 @@
 from __future__ import annotations
 
-import json
 import logging
-import re
 from typing import Any, Dict, List, TypedDict
 
-import anyio
 from langgraph.graph import END, StateGraph
-from openai import OpenAI
-from openai import APIStatusError, RateLimitError
 
 from chat_app.config import settings
+from chat_app.llm_client import LazyJson, chat_json_completion, create_chat_completion
 from chat_app.memory import BaseConversationMemory
 from chat_app.schemas import HistoryItem, MessageRole
-from chat_app.runtime_config import (
-    get_effective_openai_api_key,
-    get_effective_openai_api_keys,
-    mark_openai_api_key_rate_limited,
-)
 
 
 logger = logging.getLogger("chat_app.summarizer_v1_0")
 
+_SUMMARY_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["summary"],
+    "properties": {"summary": {"type": "string"}},
+}
+
+_SUMMARY_SYSTEM = (
+    "Ты помогаешь составлять краткое резюме диалога поддержки. "
+    "На основе истории сообщений между пользователем (user) и агентом (assistant) "
+    "сделай сжатое повествовательное резюме на русском в 1–5 предложениях. "
+    "Пиши в форме: «Вы спрашивали ..., я объяснил ...». "
+    "Не используй формат «Пользователь: ...», «Агент: ...» и не перечисляй все сообщения. "
+    "Верни только текст резюме без заголовков (например, «Резюме:») и без списков. "
+    "Не добавляй никаких пояснений про то, что это резюме — просто сам текст резюме. "
+    "Не цитируй дословно токсичные/неприличные/оскорбительные фразы пользователя; "
+    "обсценную лексику не повторяй вообще — если важно, напиши нейтрально «пользователь выражался грубо» или опусти. "
+    "Не включай персональные данные и уникальные идентификаторы (имена, телефоны, почты, ID) — если встречаются, опусти. "
+    "Верни СТРОГО JSON без лишнего текста формата: {\"summary\": \"...\"}."
+)
+
 
 class _OpenRouterClient:
     def __init__(self) -> None:
@@ -33,57 +45,25 @@ class _OpenRouterClient:
         *,
         temperature: float = 0.1,
         response_format: Dict[str, Any] | None = None,
+        max_tokens: int | None = None,
     ) -> str:
-        keys = get_effective_openai_api_keys()
-        if not keys:
-            raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
-
         payload: Dict[str, Any] = {
             "model": self._model,
             "messages": messages,
             "temperature": temperature,
+            "max_tokens": max_tokens or settings.llm_max_output_tokens,
         }
         if response_format is not None:
             payload["response_format"] = response_format
-        try:
-            logger.info("llm_request_summary_v1_0 payload=%s", json.dumps(payload, ensure_ascii=False))
-        except Exception:  # noqa: BLE001
-            logger.info("llm_request_summary_v1_0 payload=<unserializable>")
-
-        last_exc: Exception | None = None
-        for _attempt in range(max(1, len(keys))):
-            def _call() -> Any:
-                api_key = get_effective_openai_api_key()
-                if not api_key:
-                    raise RuntimeError("LLM API key (OPENAI_API_KEY) is not set")
-                client = OpenAI(api_key=api_key, base_url=settings.llm_base_url)
-                return client.chat.completions.create(**payload)
-
-            try:
-                response = await anyio.to_thread.run_sync(_call)
-                break
-            except RateLimitError as exc:
-                last_exc = exc
-                mark_openai_api_key_rate_limited()
-                continue
-            except APIStatusError as exc:
-                last_exc = exc
-                if getattr(exc, "status_code", None) == 429:
-                    mark_openai_api_key_rate_limited()
-                    continue
-                raise
-        else:
-            assert last_exc is not None
-            raise last_exc
+        # Payload сериализуется только при включённом DEBUG (и без середины длинной истории).
+        logger.debug("llm_request_summary_v1_0 payload=%s", LazyJson(payload, tail_messages=2))
+
+        response = await create_chat_completion(payload)
 
         choice = response.choices[0]
         content = getattr(choice.message, "content", "") or ""
-        logger.info(
-            "llm_response_summary_v1_0 model=%s chars=%d content=%s",
-            self._model,
-            len(content),
-            content,
-        )
+        logger.info("llm_response_summary_v1_0 model=%s chars=%d", self._model, len(content))
+        logger.debug("llm_response_summary_v1_0_content content=%s", content)
         return content
 
     async def chat_json(
@@ -93,28 +73,16 @@ class _OpenRouterClient:
         schema: Dict[str, Any],
         name: str,
         temperature: float = 0.1,
+        max_tokens: int | None = None,
     ) -> Dict[str, Any]:
-        rf_schema = {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}
-        try:
-            raw = await self.chat(messages, temperature=temperature, response_format=rf_schema)  # type: ignore[arg-type]
-            return json.loads((raw or "").strip())
-        except Exception:  # noqa: BLE001
-            pass
-
-        try:
-            raw = await self.chat(messages, temperature=temperature, response_format={"type": "json_object"})  # type: ignore[arg-type]
-            return json.loads((raw or "").strip())
-        except Exception:  # noqa: BLE001
-            raw = await self.chat(messages, temperature=temperature)
-
-        text = (raw or "").strip()
-        match = re.search(r"\{.*\}", text, flags=re.DOTALL)
-        if not match:
-            return {}
-        try:
-            return json.loads(match.group(0))
-        except Exception:  # noqa: BLE001
-            return {}
+        return await chat_json_completion(
+            lambda response_format: self.chat(
+                messages, temperature=temperature, response_format=response_format, max_tokens=max_tokens
+            ),
+            model=self._model,
+            schema=schema,
+            name=name,
+        )
 
 
 class Summarizer:
@@ -129,6 +97,7 @@ class Summarizer:
         class SummaryState(TypedDict, total=False):
             conversation_id: str
             history: List[HistoryItem]
+            history_len: int
             messages: List[Dict[str, str]]
             skip: bool
             summary: str
@@ -137,8 +106,8 @@ class Summarizer:
 
         async def load_history(state: Dict[str, Any]) -> Dict:
             conversation_id = state["conversation_id"]
-            history = memory.get_history(conversation_id).history
-            return {"history": history}
+            history, history_len = await memory.get_history_tail(conversation_id, settings.history_tail_limit)
+            return {"history": history, "history_len": history_len}
 
         async def build_messages(state: Dict[str, Any]) -> Dict:
             items: List[HistoryItem] = state.get("history") or []
@@ -153,22 +122,7 @@ class Summarizer:
             dialog_text = "\n".join(dialog_lines)
 
             messages = [
-                {
-                    "role": "system",
-                    "content": (
-                        "Ты помогаешь составлять краткое резюме диалога поддержки. "
-                        "На основе истории сообщений между пользователем (user) и агентом (assistant) "
-                        "сделай сжатое повествовательное резюме на русском в 1–5 предложениях. "
-                        "Пиши в форме: «Вы спрашивали ..., я объяснил ...». "
-                        "Не используй формат «Пользователь: ...», «Агент: ...» и не перечисляй все сообщения. "
-                        "Верни только текст резюме без заголовков (например, «Резюме:») и без списков. "
-                        "Не добавляй никаких пояснений про то, что это резюме — просто сам текст резюме. "
-                        "Не цитируй дословно токсичные/неприличные/оскорбительные фразы пользователя; "
-                        "обсценную лексику не повторяй вообще — если важно, напиши нейтрально «пользователь выражался грубо» или опусти. "
-                        "Не включай персональные данные и уникальные идентификаторы (имена, телефоны, почты, ID) — если встречаются, опусти. "
-                        "Верни СТРОГО JSON без лишнего текста формата: {\"summary\": \"...\"}."
-                    ),
-                },
+                {"role": "system", "content": _SUMMARY_SYSTEM},
                 {"role": "user", "content": f"История диалога:\n{dialog_text}"},
             ]
             return {"messages": messages, "skip": False}
@@ -176,13 +130,13 @@ class Summarizer:
         async def llm_summary(state: Dict[str, Any]) -> Dict:
             if state.get("skip"):
                 return {"summary": ""}
-            schema = {
-                "type": "object",
-                "additionalProperties": False,
-                "required": ["summary"],
-                "properties": {"summary": {"type": "string"}},
-            }
-            data = await self._llm.chat_json(state["messages"], schema=schema, name="dialog_summary", temperature=0.1)
+            data = await self._llm.chat_json(
+                state["messages"],
+                schema=_SUMMARY_SCHEMA,
+                name="dialog_summary",
+                temperature=0.1,
+                max_tokens=512,
+            )
             summary = data.get("summary") if isinstance(data, dict) else ""
             return {"summary": str(summary or "").strip()}
 
@@ -190,9 +144,10 @@ class Summarizer:
             if state.get("skip"):
                 return {}
             conversation_id = state["conversation_id"]
-            conv_state = memory.get_state(conversation_id)
+            conv_state = await memory.get_state(conversation_id)
             conv_state.summary = state.get("summary") or ""
-            memory.save_state(conv_state)
+            conv_state.last_summary_history_len = int(state.get("history_len") or 0)
+            await memory.save_state(conv_state)
             return {}
 
         graph.add_node("load_history", load_history)
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
+import hashlib
+import itertools
 import json
 import logging
+import time
 from typing import Any, Dict
 
+import anyio.to_thread
 import redis
 
 from .config import settings
@@ -13,26 +17,68 @@ logger = logging.getLogger("chat_app.runtime_config")
 
 RUNTIME_CONFIG_KEY = "runtime_config:v1"
 OPENAI_KEY_ROTATION_COUNTER_KEY = "runtime_config:openai_api_key_rotation_counter:v1"
+# Hash: fingerprint ключа -> unix-время, до которого ключ не используется после 429.
+OPENAI_KEY_COOLDOWNS_KEY = "runtime_config:openai_api_key_cooldowns:v1"
+# Кулдаун ключа, если провайдер не прислал Retry-After.
+OPENAI_KEY_DEFAULT_COOLDOWN_S = 10.0
+_COOLDOWNS_TTL_S = 3600
+# Ключи, кулдауны и версия пайплайна нужны на каждый запрос: чтения кэшируются на короткое
+# время, а из event loop синхронный Redis вызывается только через *_async-обёртки.
+_OVERRIDES_TTL_S = 2.0
+_COOLDOWNS_CACHE_TTL_S = 1.0
+# После неудачного подключения к Redis новая попытка — не раньше чем через столько секунд.
+_REDIS_RETRY_S = 30.0
+# Таймауты сокета: зависший Redis не должен держать поток пула (и запрос) дольше секунды.
+_REDIS_SOCKET_TIMEOUT_S = 1.0
 
 _redis_client: redis.Redis | None = None
+_redis_retry_at = 0.0
+# Фоллбек для кулдаунов, когда Redis недоступен (в пределах процесса).
+_local_cooldowns: Dict[str, float] = {}
+# Счётчик round-robin выбора ключа для параллельных запросов (next() атомарен под GIL).
+_round_robin = itertools.count()
+# (expires_at по time.monotonic(), значение)
+_overrides_cache: tuple[float, Dict[str, Any]] = (0.0, {})
+_cooldowns_cache: tuple[float, Dict[str, float]] = (0.0, {})
 
 
 def _get_redis() -> redis.Redis | None:
-    global _redis_client  # noqa: PLW0603
+    global _redis_client, _redis_retry_at  # noqa: PLW0603
     if _redis_client is not None:
         return _redis_client
+    now = time.monotonic()
+    if now < _redis_retry_at:
+        return None
     try:
-        client = redis.Redis.from_url(settings.redis_url, decode_responses=True)
+        client = redis.Redis.from_url(
+            settings.redis_url,
+            decode_responses=True,
+            socket_connect_timeout=_REDIS_SOCKET_TIMEOUT_S,
+            socket_timeout=_REDIS_SOCKET_TIMEOUT_S,
+        )
         client.ping()
         _redis_client = client
         return _redis_client
     except Exception as exc:  # noqa: BLE001
-        logger.warning("runtime config redis unavailable: %r", exc)
+        logger.warning("runtime config redis unavailable retry_in_s=%.0f error=%r", _REDIS_RETRY_S, exc)
         _redis_client = None
+        _redis_retry_at = now + _REDIS_RETRY_S
         return None
 
 
 def get_runtime_overrides() -> Dict[str, Any]:
+    """Runtime overrides from Redis, cached for _OVERRIDES_TTL_S (callers must not mutate the dict)."""
+    global _overrides_cache  # noqa: PLW0603
+    now = time.monotonic()
+    expires_at, cached = _overrides_cache
+    if now < expires_at:
+        return cached
+    data = _read_runtime_overrides()
+    _overrides_cache = (now + _OVERRIDES_TTL_S, data)
+    return data
+
+
+def _read_runtime_overrides() -> Dict[str, Any]:
     client = _get_redis()
     if client is None:
         return {}
@@ -47,12 +93,86 @@ def get_runtime_overrides() -> Dict[str, Any]:
         return {}
 
 
+def _api_key_fingerprint(api_key: str) -> str:
+    # Сами ключи в хэш кулдаунов не пишем.
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def _get_api_key_cooldowns() -> Dict[str, float]:
+    global _cooldowns_cache  # noqa: PLW0603
+    now = time.monotonic()
+    expires_at, cached = _cooldowns_cache
+    if now < expires_at:
+        return cached
+    cooldowns = _read_api_key_cooldowns()
+    _cooldowns_cache = (now + _COOLDOWNS_CACHE_TTL_S, cooldowns)
+    return cooldowns
+
+
+def _read_api_key_cooldowns() -> Dict[str, float]:
+    client = _get_redis()
+    if client is None:
+        return dict(_local_cooldowns)
+    try:
+        raw = client.hgetall(OPENAI_KEY_COOLDOWNS_KEY) or {}
+        return {k: float(v) for k, v in raw.items()}
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("failed to read openai key cooldowns: %r", exc)
+        return dict(_local_cooldowns)
+
+
 def get_effective_openai_api_key() -> str | None:
+    """
+    Current key of the rotation, skipping keys that are still cooling down after a 429.
+
+    Если на кулдауне все ключи — возвращается тот, что освободится раньше всех.
+    """
     keys = get_effective_openai_api_keys()
     if not keys:
         return None
-    idx = get_openai_api_key_rotation_index()
-    return keys[idx % len(keys)]
+    return _first_available_key(keys, get_openai_api_key_rotation_index())
+
+
+def choose_openai_api_key() -> str | None:
+    """
+    Round-robin key choice for a single LLM request, skipping keys on cooldown.
+
+    В отличие от get_effective_openai_api_key (общий для всех "текущий" ключ), параллельные
+    запросы распределяются по всем ключам и используют их квоты одновременно.
+    """
+    keys = get_effective_openai_api_keys()
+    if not keys:
+        return None
+    if len(keys) == 1:
+        return keys[0]
+    return _first_available_key(keys, next(_round_robin))
+
+
+async def choose_openai_api_key_async() -> str | None:
+    """choose_openai_api_key for the event loop: when the caches have expired, Redis is read in a worker thread."""
+    if _key_choice_cached():
+        return choose_openai_api_key()
+    return await anyio.to_thread.run_sync(choose_openai_api_key)
+
+
+def _key_choice_cached() -> bool:
+    now = time.monotonic()
+    if now >= _overrides_cache[0]:
+        return False
+    # С одним ключом кулдауны не читаются.
+    return len(get_effective_openai_api_keys()) <= 1 or now < _cooldowns_cache[0]
+
+
+def _first_available_key(keys: list[str], start: int) -> str:
+    ordered = [keys[(start + i) % len(keys)] for i in range(len(keys))]
+    cooldowns = _get_api_key_cooldowns()
+    if not cooldowns:
+        return ordered[0]
+    now = time.time()
+    for key in ordered:
+        if cooldowns.get(_api_key_fingerprint(key), 0.0) <= now:
+            return key
+    return min(ordered, key=lambda k: cooldowns.get(_api_key_fingerprint(k), 0.0))
 
 
 def get_effective_openai_api_keys() -> list[str]:
@@ -72,6 +192,13 @@ def get_effective_openai_api_keys() -> list[str]:
     return [p for p in parts if p]
 
 
+async def get_effective_openai_api_keys_async() -> list[str]:
+    """get_effective_openai_api_keys for the event loop (Redis read in a worker thread on cache expiry)."""
+    if time.monotonic() < _overrides_cache[0]:
+        return get_effective_openai_api_keys()
+    return await anyio.to_thread.run_sync(get_effective_openai_api_keys)
+
+
 def get_openai_api_key_rotation_index() -> int:
     """
     Current rotation counter (not modulo). Modulo is applied by consumers.
@@ -88,15 +215,34 @@ def get_openai_api_key_rotation_index() -> int:
         return 0
 
 
-def mark_openai_api_key_rate_limited() -> None:
+def mark_openai_api_key_rate_limited(api_key: str | None = None, *, retry_after_s: float | None = None) -> None:
     """
-    Advances to the next key (if multiple are configured).
-    No-op when Redis is unavailable or only one key is configured.
+    Puts api_key on cooldown (Retry-After or OPENAI_KEY_DEFAULT_COOLDOWN_S) and advances
+    to the next key (if multiple are configured).
+    Rotation is a no-op when Redis is unavailable or only one key is configured.
     """
+    global _cooldowns_cache  # noqa: PLW0603
+    client = _get_redis()
+    if api_key:
+        # Свой 429 должен сразу влиять на выбор ключа, не дожидаясь истечения кэша.
+        _cooldowns_cache = (0.0, {})
+        cooldown = retry_after_s if retry_after_s is not None else OPENAI_KEY_DEFAULT_COOLDOWN_S
+        retry_at = time.time() + max(0.0, cooldown)
+        fingerprint = _api_key_fingerprint(api_key)
+        if client is None:
+            _local_cooldowns[fingerprint] = retry_at
+        else:
+            try:
+                pipe = client.pipeline()
+                pipe.hset(OPENAI_KEY_COOLDOWNS_KEY, fingerprint, retry_at)
+                pipe.expire(OPENAI_KEY_COOLDOWNS_KEY, _COOLDOWNS_TTL_S)
+                pipe.execute()
+            except Exception as exc:  # noqa: BLE001
+                logger.warning("failed to store openai key cooldown: %r", exc)
+
     keys = get_effective_openai_api_keys()
     if len(keys) <= 1:
         return
-    client = _get_redis()
     if client is None:
         return
     try:
@@ -105,9 +251,25 @@ def mark_openai_api_key_rate_limited() -> None:
         logger.warning("failed to advance openai key rotation index: %r", exc)
 
 
+async def mark_openai_api_key_rate_limited_async(
+    api_key: str | None = None, *, retry_after_s: float | None = None
+) -> None:
+    """mark_openai_api_key_rate_limited for the event loop: Redis writes go to a worker thread."""
+    await anyio.to_thread.run_sync(
+        lambda: mark_openai_api_key_rate_limited(api_key, retry_after_s=retry_after_s)
+    )
+
+
 def get_effective_agent_pipeline_version() -> str:
     overrides = get_runtime_overrides()
     v = overrides.get("AGENT_PIPELINE_VERSION")
     if isinstance(v, str) and v.strip():
         return v.strip()
     return settings.agent_pipeline_version
+
+
+async def get_effective_agent_pipeline_version_async() -> str:
+    """get_effective_agent_pipeline_version for the event loop (Redis read in a worker thread on cache expiry)."""
+    if time.monotonic() < _overrides_cache[0]:
+        return get_effective_agent_pipeline_version()
+    return await anyio.to_thread.run_sync(get_effective_agent_pipeline_version)
@@ -3,7 +3,7 @@ from __future__ import annotations
 import json
 import logging
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Tuple
 
 from .config import settings
 from .schemas import ScenarioDefinition
@@ -21,9 +21,37 @@ class ScenarioRegistry:
 
     def __init__(self) -> None:
         self._scenarios: Dict[str, ScenarioDefinition] = {}
+        # Монотонный номер ревизии + кэшированные снимки; всё обновляется на add/remove.
+        self._revision = 0
+        self._snapshot: Tuple[ScenarioDefinition, ...] = ()
+        self._enabled_snapshot: Tuple[ScenarioDefinition, ...] = ()
+
+    def _invalidate(self) -> None:
+        self._revision += 1
+        self._snapshot = tuple(self._scenarios.values())
+        self._enabled_snapshot = tuple(s for s in self._snapshot if s.enabled)
+
+    @property
+    def revision(self) -> int:
+        return self._revision
+
+    def snapshot(self) -> Tuple[ScenarioDefinition, ...]:
+        """Immutable tuple of registered scenarios, rebuilt only when the registry changes."""
+        return self._snapshot
+
+    def enabled_snapshot(self) -> Tuple[ScenarioDefinition, ...]:
+        """
+        Enabled scenarios in registration order, for the per-turn hot path.
+
+        Сценарии не мутируются на месте (PATCH /scenarios собирает копию и вызывает add),
+        поэтому снимок остаётся актуальным до следующего add/remove.
+        """
+        return self._enabled_snapshot
 
     def add(self, scenario: ScenarioDefinition) -> None:
+        scenario.precompute()
         self._scenarios[scenario.name] = scenario
+        self._invalidate()
 
     def get(self, name: str) -> ScenarioDefinition | None:
         return self._scenarios.get(name)
@@ -32,7 +60,8 @@ class ScenarioRegistry:
         return dict(self._scenarios)
 
     def remove(self, name: str) -> None:
-        self._scenarios.pop(name, None)
+        if self._scenarios.pop(name, None) is not None:
+            self._invalidate()
 
     def load_default_from_disk(self) -> None:
         """
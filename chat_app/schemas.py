@@ -2,9 +2,9 @@ from __future__ import annotations
 
 from datetime import datetime
 from enum import Enum
-from typing import Any, Dict, List, Literal, Optional
+from typing import Any, Dict, List, Literal, NamedTuple, Optional, Tuple
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 
 class MessageRole(str, Enum):
@@ -80,6 +80,8 @@ class ConversationState(BaseModel):
     message_index: int = 0
     user_profile: UserProfile = Field(default_factory=UserProfile)
     summary: str = ""
+    # Длина истории на момент последнего обновления summary (чтобы не пересчитывать его каждый ход).
+    last_summary_history_len: int = 0
     scenario_runs: List[Dict[str, Any]] = Field(default_factory=list)
 
 
@@ -104,10 +106,82 @@ class ScenarioNode(BaseModel):
     children: Optional[List["ScenarioNode"]] = None
     else_children: Optional[List["ScenarioNode"]] = None
 
+    _sort_key: Optional[Tuple[int, ...]] = PrivateAttr(default=None)
+
+    @property
+    def sort_key(self) -> Tuple[int, ...]:
+        """Dotted numeric id as a tuple ("1.2" -> (1, 2)); parsed once per node."""
+        if self._sort_key is None:
+            # isdecimal(), а не isdigit(): "²" — digit, но int() его не примет.
+            self._sort_key = tuple(int(part) if part.isdecimal() else 0 for part in self.id.split("."))
+        return self._sort_key
+
 
 ScenarioNode.model_rebuild()
 
 
+def scenario_node_sort_key(node: ScenarioNode) -> Tuple[int, ...]:
+    """Orders nodes by dotted numeric id ("1", "1.2", "10"); non-numeric parts sort as 0."""
+    return node.sort_key
+
+
+# Виды узлов скомпилированного сценария (ScenarioDefinition.program).
+NODE_END = 0
+NODE_TOOL = 1
+NODE_TEXT = 2
+NODE_IF = 3
+
+
+class CompiledScenarioNode(NamedTuple):
+    """Scenario node with its kind resolved and both branches pre-sorted and compiled."""
+
+    kind: int
+    node: ScenarioNode
+    children: Tuple["CompiledScenarioNode", ...] = ()
+    else_children: Tuple["CompiledScenarioNode", ...] = ()
+    # Для if: тексты text-детей веток в исходном порядке (when_true / when_false условного блока).
+    true_texts: Tuple[str, ...] = ()
+    false_texts: Tuple[str, ...] = ()
+    # Для tool: имена tools подряд идущих tool-узлов одного уровня (без повторов, в порядке id).
+    tools: Tuple[str, ...] = ()
+
+
+def compile_scenario_nodes(nodes: List[ScenarioNode] | None) -> Tuple[CompiledScenarioNode, ...]:
+    """
+    Sorts nodes by id and resolves their kinds, recursively.
+
+    Узлы, которые движок всё равно пропускает (text без текста, tool без имени), отбрасываются;
+    всё после end на том же уровне недостижимо и тоже не попадает в программу.
+    """
+    program: List[CompiledScenarioNode] = []
+    for node in sorted(nodes or [], key=scenario_node_sort_key):
+        if node.type == "end":
+            program.append(CompiledScenarioNode(NODE_END, node))
+            break
+        if node.type == "tool" and node.tool:
+            last = program[-1] if program else None
+            if last is not None and last.kind == NODE_TOOL:
+                # Соседние tool-узлы — один шаг: движок может вызвать их параллельно.
+                if node.tool not in last.tools:
+                    program[-1] = last._replace(tools=(*last.tools, node.tool))
+            else:
+                program.append(CompiledScenarioNode(NODE_TOOL, node, tools=(node.tool,)))
+        elif node.type == "text" and node.text:
+            program.append(CompiledScenarioNode(NODE_TEXT, node))
+        elif node.type == "if":
+            program.append(
+                CompiledScenarioNode(
+                    NODE_IF,
+                    node,
+                    compile_scenario_nodes(node.children),
+                    compile_scenario_nodes(node.else_children),
+                    tuple(c.text for c in node.children or () if c.type == "text" and c.text),
+                    tuple(c.text for c in node.else_children or () if c.type == "text" and c.text),
+                )
+            )
+    return tuple(program)
+
+
 class ScenarioDefinition(BaseModel):
     """Top-level scenario definition loaded from JSON or API."""
 
@@ -121,6 +195,51 @@ class ScenarioDefinition(BaseModel):
     summary: Optional[str] = None
     admin_message: Optional[str] = None
 
+    # Кэш отсортированных узлов верхнего уровня (сценарии статичны; заполняется в registry.add).
+    _sorted_code: Optional[Tuple[ScenarioNode, ...]] = PrivateAttr(default=None)
+    # Дерево узлов, отсортированное и разобранное по видам один раз (v1.0 scenario engine).
+    _program: Tuple[CompiledScenarioNode, ...] = PrivateAttr(default=())
+    # meta.apply_only_message_index, разобранный один раз (None — сценарий может сработать на любом ходе).
+    _only_message_index: Optional[int] = PrivateAttr(default=None)
+    # meta.parallel_tools: соседние tool-узлы можно вызывать параллельно (по умолчанию да).
+    _parallel_tools: bool = PrivateAttr(default=True)
+
+    def precompute(self) -> None:
+        """Caches derived structures used on every chat turn."""
+        self._sorted_code = tuple(sorted(self.code, key=scenario_node_sort_key))
+        self._program = compile_scenario_nodes(self.code)
+        meta = self.meta or {}
+        self._parallel_tools = meta.get("parallel_tools", True) is not False
+        raw = meta.get("apply_only_message_index")
+        try:
+            self._only_message_index = int(raw) if raw is not None else None
+        except (TypeError, ValueError):
+            self._only_message_index = None
+
+    def triggers_on(self, message_index: int) -> bool:
+        """Cheap precondition: False if the scenario policy rules out this turn."""
+        if self._sorted_code is None:
+            self.precompute()
+        return self._only_message_index is None or self._only_message_index == message_index
+
+    @property
+    def sorted_code(self) -> Tuple[ScenarioNode, ...]:
+        if self._sorted_code is None:
+            self.precompute()
+        return self._sorted_code  # type: ignore[return-value]
+
+    @property
+    def program(self) -> Tuple[CompiledScenarioNode, ...]:
+        if self._sorted_code is None:
+            self.precompute()
+        return self._program
+
+    @property
+    def parallel_tools(self) -> bool:
+        if self._sorted_code is None:
+            self.precompute()
+        return self._parallel_tools
+
 
 class ScenarioPatchRequest(BaseModel):
     enabled: Optional[bool] = None
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from redis import asyncio as aioredis  # type: ignore
+except Exception:  # noqa: BLE001
+    aioredis = None  # type: ignore[assignment]
+
+try:
+    import orjson  # type: ignore
+except Exception:  # noqa: BLE001
+    orjson = None  # type: ignore[assignment]
+
+from chat_app.config import settings
+from chat_app.schemas import ScenarioDefinition, ToolSpec
+from chat_app.sgr.converter import sgr_convert_text
+from chat_app.sgr.langchain_chain.pipeline import SgrConvertError
+
+
+logger = logging.getLogger("chat_app.sgr.cache")
+
+_KEY_PREFIX = "sgr:conv:"
+
+SgrResult = Tuple[ScenarioDefinition, Dict[str, Any], List[str]]
+
+_redis_client: Any = None
+
+
+def _get_redis() -> Any:
+    global _redis_client  # noqa: PLW0603
+    if _redis_client is None and aioredis is not None:
+        _redis_client = aioredis.Redis.from_url(settings.redis_url, decode_responses=False)
+    return _redis_client
+
+
+def _dumps(data: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, ensure_ascii=False, default=str).encode("utf-8")
+
+
+def _loads(raw: bytes) -> Dict[str, Any]:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _cache_key(
+    *,
+    text: str,
+    available_tools: List[ToolSpec],
+    name_hint: Optional[str],
+    strict: bool,
+    return_diagnostics: bool,
+) -> str:
+    # Всё, что влияет на результат конвертации: текст, опции, модель и набор инструментов.
+    tools_fingerprint = [t.model_dump(mode="json") for t in available_tools or []]
+    h = hashlib.blake2b(digest_size=16)
+    h.update((text or "").encode("utf-8"))
+    h.update(b"\x00")
+    h.update(_dumps({
+        "name_hint": name_hint,
+        "strict": bool(strict),
+        "return_diagnostics": bool(return_diagnostics),
+        "model": settings.sgr_model,
+        "tools": tools_fingerprint,
+    }))
+    return _KEY_PREFIX + h.hexdigest()
+
+
+async def _cache_get(key: str) -> Dict[str, Any] | None:
+    client = _get_redis()
+    if client is None:
+        return None
+    try:
+        raw = await client.get(key)
+        return _loads(raw) if raw else None
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("sgr_cache_get_failed key=%s error=%r", key, exc)
+        return None
+
+
+async def _cache_set(key: str, payload: Dict[str, Any]) -> None:
+    client = _get_redis()
+    if client is None:
+        return
+    try:
+        await client.set(key, _dumps(payload), ex=settings.sgr_cache_ttl_s)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("sgr_cache_set_failed key=%s error=%r", key, exc)
+
+
+def _is_deterministic_failure(exc: SgrConvertError) -> bool:
+    # Повторяемы только отказы валидации: статическая проверка сценария и разбор/валидация
+    # ответа LLM (ValueError, в т.ч. pydantic ValidationError и JSONDecodeError). Таймауты,
+    # ошибки API и отсутствие ключа оборачиваются в тот же SgrConvertError, но кэшировать их нельзя.
+    return exc.failed_step == "10_static_validation" or isinstance(exc.__cause__, ValueError)
+
+
+async def sgr_convert_text_cached(
+    *,
+    text: str,
+    available_tools: List[ToolSpec],
+    name_hint: Optional[str] = None,
+    strict: bool = True,
+    return_diagnostics: bool = True,
+    fresh: bool = False,
+) -> Tuple[SgrResult, bool]:
+    """
+    sgr_convert_text with a Redis-backed result cache.
+
+    Returns (result, cache_hit). Кэшируются и успешные результаты, и SgrConvertError (422):
+    повторная конвертация того же текста не вызывает LLM. fresh=True — обойти кэш
+    (результат всё равно перезаписывается). Транзитные ошибки LLM (429/5xx/таймауты, нет ключа)
+    не кэшируются — см. _is_deterministic_failure.
+    """
+    enabled = settings.sgr_cache_ttl_s > 0
+    key = _cache_key(
+        text=text,
+        available_tools=available_tools,
+        name_hint=name_hint,
+        strict=strict,
+        return_diagnostics=return_diagnostics,
+    )
+
+    if enabled and not fresh:
+        cached = await _cache_get(key)
+        if cached is not None:
+            if cached.get("status") == "error":
+                err = cached.get("error") or {}
+                exc = SgrConvertError(
+                    trace_id=str(err.get("trace_id") or ""),
+                    failed_step=str(err.get("failed_step") or ""),
+                    diagnostics=err.get("diagnostics") or {},
+                    last_llm_raw=str(err.get("last_llm_raw") or ""),
+                )
+                exc.cache_hit = True  # type: ignore[attr-defined]
+                raise exc
+            scenario = ScenarioDefinition.model_validate(cached.get("scenario") or {})
+            return (scenario, cached.get("diagnostics") or {}, list(cached.get("questions") or [])), True
+
+    try:
+        scenario, diagnostics, questions = await sgr_convert_text(
+            text=text,
+            available_tools=available_tools,
+            name_hint=name_hint,
+            strict=strict,
+            return_diagnostics=return_diagnostics,
+        )
+    except SgrConvertError as exc:
+        if enabled and _is_deterministic_failure(exc):
+            await _cache_set(key, {"status": "error", "error": exc.to_422()})
+        raise
+
+    if enabled:
+        await _cache_set(
+            key,
+            {
+                "status": "ok",
+                "scenario": scenario.model_dump(mode="json"),
+                "diagnostics": diagnostics,
+                "questions": questions,
+            },
+        )
+    return (scenario, diagnostics, questions), False
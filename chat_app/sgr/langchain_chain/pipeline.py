@@ -19,7 +19,7 @@ from pydantic import BaseModel
 from chat_app.config import settings
 from chat_app.schemas import ScenarioDefinition, ToolSpec
 from chat_app.runtime_config import get_effective_openai_api_key
-from chat_app.runtime_config import get_effective_openai_api_keys, mark_openai_api_key_rate_limited
+from chat_app.runtime_config import get_effective_openai_api_keys_async, mark_openai_api_key_rate_limited_async
 
 from .models import (
     Step1ExtractIntents,
@@ -142,7 +142,7 @@ async def _call_llm_step(
     headers: Dict[str, Any] = {}
     resp_payload: Dict[str, Any] = {}
 
-    keys = get_effective_openai_api_keys()
+    keys = await get_effective_openai_api_keys_async()
     if not keys:
         raise RuntimeError("OPENAI_API_KEY is not set")
 
@@ -166,12 +166,12 @@ async def _call_llm_step(
             break
         except RateLimitError as exc:
             last_exc = exc
-            mark_openai_api_key_rate_limited()
+            await mark_openai_api_key_rate_limited_async()
             continue
         except APIStatusError as exc:
             last_exc = exc
             if getattr(exc, "status_code", None) == 429:
-                mark_openai_api_key_rate_limited()
+                await mark_openai_api_key_rate_limited_async()
                 continue
             raise
         except Exception as exc:  # noqa: BLE001
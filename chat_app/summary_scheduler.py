@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Set
+from weakref import WeakValueDictionary
+
+from .config import settings
+from .memory import BaseConversationMemory
+
+
+logger = logging.getLogger("chat_app.summary_scheduler")
+
+SummaryUpdate = Callable[[BaseConversationMemory, str], Awaitable[None]]
+
+
+class SummaryScheduler:
+    """
+    Fire-and-forget summary updates, at most one in flight per conversation.
+
+    Задача запускается через asyncio.create_task после записи хода и не задерживает ответ.
+    Под per-conversation lock условие SUMMARY_DELTA_THRESHOLD перепроверяется по свежему
+    состоянию: параллельные ходы одного диалога не пересчитывают summary дважды.
+    """
+
+    def __init__(self, memory: BaseConversationMemory, update: SummaryUpdate, *, tag: str) -> None:
+        self._memory = memory
+        self._update = update
+        self._tag = tag
+        # Lock живёт, пока его держит или ждёт хотя бы одна задача.
+        self._locks: WeakValueDictionary[str, asyncio.Lock] = WeakValueDictionary()
+        # Сильные ссылки на задачи, иначе event loop может собрать их до завершения.
+        self._tasks: Set[asyncio.Task[None]] = set()
+
+    def schedule(self, conversation_id: str) -> None:
+        task = asyncio.create_task(self._run(conversation_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _is_due(self, conversation_id: str) -> bool:
+        history_len = await self._memory.get_history_len(conversation_id)
+        state = await self._memory.get_state(conversation_id)
+        if history_len - state.last_summary_history_len < settings.summary_delta_threshold:
+            logger.info(
+                "summary_skip_%s conversation_id=%s history_len=%d last_summary_history_len=%d",
+                self._tag,
+                conversation_id,
+                history_len,
+                state.last_summary_history_len,
+            )
+            return False
+        return True
+
+    async def _run(self, conversation_id: str) -> None:
+        lock = self._locks.get(conversation_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[conversation_id] = lock
+        async with lock:
+            try:
+                if not await self._is_due(conversation_id):
+                    return
+                logger.info("summary_launch_%s conversation_id=%s", self._tag, conversation_id)
+                await self._update(self._memory, conversation_id)
+            except Exception as exc:  # noqa: BLE001
+                logger.error(
+                    "summary_update_failed_%s conversation_id=%s error=%r",
+                    self._tag,
+                    conversation_id,
+                    exc,
+                )
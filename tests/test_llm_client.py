@@ -0,0 +1,38 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from chat_app import llm_client
+
+
+class AsyncClientCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self) -> None:
+        await llm_client.aclose_async_clients()
+
+    async def test_evicted_client_is_closed(self) -> None:
+        with (
+            mock.patch.object(llm_client, "_MAX_ASYNC_CLIENTS", 1),
+            mock.patch.object(llm_client, "_EVICTED_CLIENT_CLOSE_DELAY_S", 0.0),
+        ):
+            first = llm_client.get_async_client("k1", "http://127.0.0.1:1/v1")
+            self.assertIs(llm_client.get_async_client("k1", "http://127.0.0.1:1/v1"), first)
+            second = llm_client.get_async_client("k2", "http://127.0.0.1:1/v1")
+            await asyncio.sleep(0.01)
+
+        self.assertTrue(first.is_closed())
+        self.assertFalse(second.is_closed())
+        self.assertIsNot(llm_client.get_async_client("k1", "http://127.0.0.1:1/v1"), first)
+
+    async def test_shutdown_closes_cached_and_pending_evicted_clients(self) -> None:
+        with mock.patch.object(llm_client, "_MAX_ASYNC_CLIENTS", 1):
+            evicted = llm_client.get_async_client("k1", "http://127.0.0.1:1/v1")
+            cached = llm_client.get_async_client("k2", "http://127.0.0.1:1/v1")
+        self.assertFalse(evicted.is_closed())
+
+        await llm_client.aclose_async_clients()
+        self.assertTrue(evicted.is_closed())
+        self.assertTrue(cached.is_closed())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from chat_app.memory import InMemoryConversationMemory
+from chat_app.schemas import ConversationState, HistoryItem, MessageRole
+
+
+class InMemoryRevisionTest(unittest.IsolatedAsyncioTestCase):
+    async def test_revision_is_not_reused_after_eviction(self) -> None:
+        memory = InMemoryConversationMemory(max_conversations=1)
+        await memory.append_history("a", HistoryItem(role=MessageRole.USER, content="привет"))
+        await memory.save_state(ConversationState(conversation_id="a", message_index=1))
+        seen = await memory.get_revision("a")
+
+        # Второй диалог вытесняет первый из LRU.
+        await memory.append_history("b", HistoryItem(role=MessageRole.USER, content="hi"))
+        self.assertEqual(await memory.get_revision("a"), 0)
+        self.assertEqual(memory.memory_stats()["evictions"], 1)
+
+        # Диалог создаётся заново: ревизия не должна совпасть с той, что уже ушла в ETag.
+        await memory.append_history("a", HistoryItem(role=MessageRole.USER, content="другое"))
+        self.assertGreater(await memory.get_revision("a"), seen)
+
+    async def test_revision_grows_on_every_write(self) -> None:
+        memory = InMemoryConversationMemory()
+        self.assertEqual(await memory.get_revision("a"), 0)
+        await memory.save_state(ConversationState(conversation_id="a"))
+        first = await memory.get_revision("a")
+        await memory.append_history("a", HistoryItem(role=MessageRole.USER, content="x"))
+        self.assertGreater(await memory.get_revision("a"), first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from chat_app.pipelines.v1_0.subgraphs.scenario_engine import _render_branch, _render_template
+from chat_app.schemas import ConversationState
+
+
+class RenderCacheTypedKeyTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.state = {"conv_state": ConversationState(conversation_id="c", message_index=1)}
+
+    def render(self, text: str, data: dict) -> str:
+        return _render_template(text, state=self.state, tool_results={"crm": data})
+
+    def test_equal_values_of_different_types_are_not_conflated(self) -> None:
+        text = "Возраст: {=@crm.age=}, VIP: {=@crm.vip=}"
+        self.assertEqual(self.render(text, {"age": 30, "vip": True}), "Возраст: 30, VIP: True")
+        self.assertEqual(self.render(text, {"age": 30.0, "vip": 1}), "Возраст: 30.0, VIP: 1")
+        self.assertEqual(self.render(text, {"age": 30, "vip": True}), "Возраст: 30, VIP: True")
+
+    def test_branch_cache_is_typed(self) -> None:
+        texts = ("{=@crm=}",)
+        first = _render_branch(texts, state=self.state, tool_results={"crm": {"bonus": 1}})
+        second = _render_branch(texts, state=self.state, tool_results={"crm": {"bonus": True}})
+        self.assertEqual(first, ["{'bonus': 1}"])
+        self.assertEqual(second, ["{'bonus': True}"])
+
+    def test_profile_age_type_is_part_of_the_key(self) -> None:
+        text = "{=dialog.age=}"
+        profile = self.state["conv_state"].user_profile
+        profile.age = 30
+        self.assertEqual(_render_template(text, state=self.state, tool_results={}), "30")
+        profile.age = 30.0
+        self.assertEqual(_render_template(text, state=self.state, tool_results={}), "30.0")
+
+
+if __name__ == "__main__":
+    unittest.main()